@@ -1,12 +1,37 @@
 # -*- coding: utf-8 -*-
+from AccessControl import ClassSecurityInfo
+from AccessControl import getSecurityManager
+from AccessControl.class_init import InitializeClass
 from AccessControl.ZopeGuards import guarded_getattr
+from plone.namedfile.interfaces import INamedField
+from plone.namedfile.upload import parse_upload_metadata
+from plone.namedfile.upload import StagedUpload
+from plone.namedfile.upload import TUS_VERSION
+from plone.namedfile.upload import UploadConflict
+from plone.namedfile.upload import UploadTooLarge
+from plone.namedfile.utils import handle_request_range
+from plone.namedfile.utils import is_not_modified
+from plone.namedfile.utils import offload_data
 from plone.namedfile.utils import set_headers
+from plone.namedfile.utils import set_validators
 from plone.namedfile.utils import stream_data
 from plone.rfc822.interfaces import IPrimaryFieldInfo
+from plone.supermodel.utils import mergedTaggedValueDict
 from Products.Five.browser import BrowserView
+from zope.event import notify
 from zope.interface import implementer
+from zope.interface import providedBy
+from zope.lifecycleevent import ObjectModifiedEvent
 from zope.publisher.interfaces import IPublishTraverse
 from zope.publisher.interfaces import NotFound
+from zope.schema import ValidationError
+from zope.security import checkPermission
+
+
+try:
+    from plone.autoform.interfaces import WRITE_PERMISSIONS_KEY
+except ImportError:
+    WRITE_PERMISSIONS_KEY = None
 
 
 @implementer(IPublishTraverse)
@@ -22,6 +47,14 @@ class Download(BrowserView):
 
     If no `fieldname` is supplied, then a default field is looked up through
     adaption to `plone.rfc822.interfaces.IPrimaryFieldInfo`.
+
+    Byte ranges as asked for with the HTTP ``Range`` header are answered with
+    a ``206 Partial Content`` response. Conditional requests for an unchanged
+    file are answered with ``304 Not Modified``.
+
+    If a `plone.namedfile.interfaces.IBlobOffload` utility is registered,
+    committed blobs are not streamed but delivered by the front-end web
+    server, which then also takes care of range requests.
     """
 
     def __init__(self, context, request):
@@ -42,8 +75,18 @@ class Download(BrowserView):
 
     def __call__(self):
         file = self._getFile()
+        if is_not_modified(file, self.request):
+            # before looking at the size, which may have to open a blob
+            set_validators(file, self.request.response)
+            self.request.response.setStatus(304)
+            return ''
         self.set_headers(file)
-        return stream_data(file)
+        if offload_data(file, self.request.response):
+            return ''
+        request_range = handle_request_range(
+            file, self.request, self.request.response)
+        return stream_data(
+            file, response=self.request.response, **request_range)
 
     def set_headers(self, file):
         if not self.filename:
@@ -81,3 +124,237 @@ class DisplayFile(Download):
     """
     def set_headers(self, file):
         set_headers(file, self.request.response)
+
+
+@implementer(IPublishTraverse)
+class Upload(BrowserView):
+    """Resumable upload of a file or image, via ../context/@@upload/fieldname
+
+    This speaks the tus protocol (https://tus.io), version 1.0.0 with the
+    creation and termination extensions:
+
+    - ``POST ../@@upload/fieldname`` with an ``Upload-Length`` header starts
+      an upload for the field. Its URL, ../@@upload/fieldname/id, is sent in
+      the ``Location`` header. The filename and the content type may be
+      sent as `filename` and `filetype` in the ``Upload-Metadata`` header.
+
+    - ``PATCH`` requests to the URL of the upload, with a content type of
+      ``application/offset+octet-stream``, append their body to the data
+      received so far, the length of which is given in the
+      ``Upload-Offset`` header.
+
+    - ``HEAD`` requests tell the ``Upload-Offset`` to continue from, e.g.
+      after the connection was lost, and ``DELETE`` requests abort the
+      upload.
+
+    Other methods are answered with ``405 Method Not Allowed``.
+
+    The data is staged on disk (see `plone.namedfile.upload`), so the
+    requests don't change the database. When all data was received, a value
+    of the type of the field is created and set on the context.
+    """
+
+    security = ClassSecurityInfo()
+
+    def __init__(self, context, request):
+        super(Upload, self).__init__(context, request)
+        self.fieldname = None
+        self.upload_id = None
+
+    def publishTraverse(self, request, name):
+
+        if self.fieldname is None:  # ../@@upload/fieldname
+            self.fieldname = name
+        elif self.upload_id is None:  # ../@@upload/fieldname/id
+            self.upload_id = name
+        else:
+            raise NotFound(self, name, request)
+
+        return self
+
+    def __call__(self):
+        """Start an upload.
+        """
+        if self.request.get('REQUEST_METHOD', 'GET') != 'POST' or (
+            self.upload_id is not None
+        ):
+            # uploads are created by POST requests to the URL of the field
+            # only, anything else reaching the view is not allowed
+            if self.upload_id is None:
+                allowed = 'POST, OPTIONS'
+            else:
+                allowed = 'HEAD, PATCH, DELETE, OPTIONS'
+            self.request.response.setHeader('Allow', allowed)
+            return self._respond(405)
+        if self._unsupportedVersion():
+            return ''
+        field = self._getField()
+        if not self._canWrite(field):
+            return self._respond(403)
+        try:
+            length = int(self.request.getHeader('Upload-Length'))
+            if length < 0:
+                raise ValueError(length)
+            metadata = parse_upload_metadata(
+                self.request.getHeader('Upload-Metadata'))
+        except (TypeError, ValueError):
+            return self._respond(400)
+        try:
+            upload = StagedUpload.create(
+                length,
+                fieldname=self.fieldname,
+                filename=metadata.get('filename', metadata.get('name')),
+                contentType=metadata.get('filetype', metadata.get('type')),
+                context=self._getContextPath(),
+                user=getSecurityManager().getUser().getId(),
+            )
+        except UploadTooLarge:
+            return self._respond(413)
+        self.request.response.setHeader(
+            'Location', '{0}/{1}'.format(self.request.getURL(), upload.id))
+        if not length:
+            return self._finish(field, upload, 201)
+        return self._respond(201)
+
+    def HEAD(self):
+        """Tell how much of the upload was received.
+        """
+        if self._unsupportedVersion():
+            return ''
+        upload = self._getUpload()
+        response = self.request.response
+        response.setHeader('Upload-Offset', str(upload.offset))
+        response.setHeader('Upload-Length', str(upload.length))
+        response.setHeader('Cache-Control', 'no-store')
+        return self._respond(200)
+
+    def PATCH(self):
+        """Continue the upload with the data in the body of the request.
+        """
+        if self._unsupportedVersion():
+            return ''
+        upload = self._getUpload()
+        field = self._getField()
+        contentType = self.request.getHeader('Content-Type', '')
+        if contentType.split(';')[0].strip() != (
+            'application/offset+octet-stream'
+        ):
+            return self._respond(415)
+        try:
+            offset = int(self.request.getHeader('Upload-Offset'))
+        except (TypeError, ValueError):
+            return self._respond(400)
+        try:
+            offset = upload.append(self._getBody(), offset)
+        except UploadConflict:
+            return self._respond(409)
+        self.request.response.setHeader('Upload-Offset', str(offset))
+        if offset >= upload.length:
+            return self._finish(field, upload, 204)
+        return self._respond(204)
+
+    def DELETE(self):
+        """Abort the upload.
+        """
+        if self._unsupportedVersion():
+            return ''
+        self._getUpload().remove()
+        return self._respond(204)
+
+    security.declarePublic('OPTIONS')
+
+    def OPTIONS(self):
+        """Tell what the server supports.
+
+        Public, as clients and browsers ask for it before they authenticate,
+        e.g. in CORS preflight requests.
+        """
+        response = self.request.response
+        response.setHeader('Tus-Version', TUS_VERSION)
+        response.setHeader('Tus-Extension', 'creation,termination')
+        return self._respond(204)
+
+    def _respond(self, status):
+        response = self.request.response
+        response.setStatus(status)
+        response.setHeader('Tus-Resumable', TUS_VERSION)
+        return ''
+
+    def _unsupportedVersion(self):
+        version = self.request.getHeader('Tus-Resumable')
+        if version is None or version == TUS_VERSION:
+            return False
+        self.request.response.setHeader('Tus-Version', TUS_VERSION)
+        self._respond(412)
+        return True
+
+    def _getField(self):
+        for iface in providedBy(self.context).flattened():
+            field = iface.get(self.fieldname)
+            if INamedField.providedBy(field):
+                return field.bind(self.context)
+        info = IPrimaryFieldInfo(self.context, None)
+        if info is not None and info.fieldname == self.fieldname:
+            return info.field.bind(self.context)
+        raise NotFound(self, self.fieldname, self.request)
+
+    def _canWrite(self, field):
+        """Check whether the field may be set: it must not be read-only, and
+        the user needs the write permission set for it with plone.autoform,
+        if any.
+        """
+        if field.readonly:
+            return False
+        if WRITE_PERMISSIONS_KEY is None or field.interface is None:
+            return True
+        permission = mergedTaggedValueDict(
+            field.interface, WRITE_PERMISSIONS_KEY).get(field.__name__)
+        return permission is None or checkPermission(permission, self.context)
+
+    def _getContextPath(self):
+        getPhysicalPath = getattr(self.context, 'getPhysicalPath', None)
+        if getPhysicalPath is None:
+            return None
+        return '/'.join(getPhysicalPath())
+
+    def _getUpload(self):
+        upload = None
+        if self.upload_id is not None:
+            upload = StagedUpload.get(self.upload_id)
+        if (
+            upload is None or
+            upload.info.get('fieldname') != self.fieldname or
+            upload.info.get('context') != self._getContextPath() or
+            upload.info.get('user') != getSecurityManager().getUser().getId()
+        ):
+            raise NotFound(self, self.upload_id, self.request)
+        return upload
+
+    def _getBody(self):
+        body = self.request.get('BODYFILE')
+        if body is None:
+            body = getattr(self.request, 'bodyStream', None)
+        if body is None:
+            body = self.request.stdin
+        seek = getattr(body, 'seek', None)
+        if seek is not None:
+            seek(0)
+        return body
+
+    def _finish(self, field, upload, status):
+        if not self._canWrite(field):
+            upload.remove()
+            return self._respond(403)
+        value = upload.createValue(field._type)
+        try:
+            field.validate(value)
+        except ValidationError:
+            # the staged data is kept until the upload is deleted or expires
+            return self._respond(400)
+        upload.remove()
+        field.set(self.context, value)
+        notify(ObjectModifiedEvent(self.context))
+        return self._respond(status)
+
+
+InitializeClass(Upload)
@@ -3,20 +3,141 @@
 """
 # This file was borrowed from z3c.blobfile and is licensed under the terms of
 # the ZPL.
+from plone.namedfile import settings
+from plone.namedfile.digest import update_digest_index
 from plone.namedfile.interfaces import INamedBlobFile
+from plone.namedfile.interfaces import INamedFile
+from plone.namedfile.utils import get_blob_size
 from ZODB.blob import Blob
 from zope.component import adapter
 from zope.copy.interfaces import ICopyHook
 from zope.copy.interfaces import ResumeCopy
 from zope.interface import implementer
 
+import errno
+import os
 import shutil
+import sys
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request to make a file share the data blocks of another one (a
+# reflink), on Linux file systems supporting it, e.g. btrfs and XFS
+FICLONE = 0x40049409
+
+# errors telling that the kernel or the file system can't copy the data
+_UNSUPPORTED = (
+    errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV,
+    errno.ENOTTY, errno.ENOTSOCK,
+)
+
+# Size of the buffer for copying data through Python
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src, dst, count, offset, offset)
+
+
+def _sendfile(src, dst, offset, count):
+    os.lseek(dst, offset, os.SEEK_SET)
+    return os.sendfile(dst, src, offset, count)
+
+
+# ways of copying data between files in the kernel, as far as available
+_KERNEL_COPIES = [
+    kernel_copy for name, kernel_copy in (
+        ('copy_file_range', _copy_file_range),
+        ('sendfile', _sendfile),
+    )
+    if hasattr(os, name)
+]
+
+
+def copyFile(fsrc, fdst):
+    """Copy all data of the file `fsrc` to the empty file `fdst`.
+
+    The data is shared with a reflink if the file system supports it, or
+    copied by the kernel with ``os.copy_file_range`` or ``os.sendfile``.
+    Otherwise it is copied through Python.
+    """
+    src, dst = fsrc.fileno(), fdst.fileno()
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(dst, FICLONE, src)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    size = os.fstat(src).st_size
+    copied = 0
+    for kernel_copy in _KERNEL_COPIES:
+        try:
+            while copied < size:
+                length = kernel_copy(
+                    src, dst, copied, min(size - copied, 1 << 30))
+                if not length:
+                    break
+                copied += length
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            continue
+        break
+    # copy whatever is left, e.g. data appended meanwhile
+    fsrc.seek(copied)
+    fdst.seek(copied)
+    shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+
+
+def copyBlob(blob):
+    """Return a new blob holding a copy of the data of `blob`.
+    """
+    new_blob = Blob()
+    with blob.open('r') as fsrc:
+        with new_blob.open('w') as fdst:
+            copyFile(fsrc, fdst)
+    return new_blob
 
 
 @implementer(ICopyHook)
 @adapter(INamedBlobFile)
 class BlobFileCopyHook(object):
-    """A copy hook that fixes the blob after copying"""
+    """A copy hook that fixes the blob after copying.
+
+    With the `LAZY_BLOB_COPIES` setting and a digest index, the copy shares
+    a committed blob with the original instead.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    def __call__(self, toplevel, register):
+        register(self._copyBlob)
+        raise ResumeCopy
+
+    def _copyBlob(self, translate):
+        target = translate(self.context)
+        if not (settings.LAZY_BLOB_COPIES and target._useBlobOf(self.context)):
+            target._blob = copyBlob(self.context._blob)
+            if target._blob_shared:
+                # the copy has a blob of its own
+                target._blob_shared = False
+        if target._size is None:
+            # not known for the original, which is left alone
+            target._size = get_blob_size(target._blob)
+        update_digest_index(target, None, target._digest)
+
+
+@implementer(ICopyHook)
+@adapter(INamedFile)
+class FileCopyHook(object):
+    """A copy hook that fixes the blob after copying a NamedFile or
+    NamedImage storing its data in a blob, and indexes the copy"""
 
     def __init__(self, context):
         self.context = context
@@ -27,9 +148,6 @@ class BlobFileCopyHook(object):
 
     def _copyBlob(self, translate):
         target = translate(self.context)
-        target._blob = Blob()
-        fsrc = self.context._blob.open('r')
-        fdst = target._blob.open('w')
-        shutil.copyfileobj(fsrc, fdst)
-        fdst.close()
-        fsrc.close()
+        if isinstance(self.context._data, Blob):
+            target._data = copyBlob(self.context._data)
+        update_digest_index(target, None, target._digest)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""SHA-256 digests of file and image data, and an index of values by
+digest.
+"""
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from persistent import Persistent
+from plone.namedfile.interfaces import IDigestIndex
+from plone.namedfile.interfaces import INamedFile
+from plone.namedfile.interfaces import INamedImage
+from plone.namedfile.utils import iter_file_data
+from plone.namedfile.utils import iter_named_fields
+from ZODB.POSException import POSKeyError
+from zope.component import queryUtility
+from zope.interface import implementer
+
+import hashlib
+
+
+def compute_digest(value):
+    """Compute the digest of the data of a file or image value.
+
+    The data is read piece by piece, so this works for data of any size.
+    """
+    hash = hashlib.sha256()
+    for data in iter_file_data(value):
+        hash.update(data)
+    return hash.hexdigest()
+
+
+def update_digest_index(value, old, new):
+    """Move the value from the `old` to the `new` digest in the digest index,
+    if there is one. Either digest may be None.
+    """
+    if old == new:
+        return
+    index = queryUtility(IDigestIndex)
+    if index is None:
+        return
+    if old is not None:
+        index.remove(old, value)
+    if new is not None:
+        index.add(new, value)
+
+
+def remove_values(obj, event):
+    """Take the file and image values of removed content out of the digest
+    index, so they are no longer found or counted as sharing a blob.
+    """
+    index = queryUtility(IDigestIndex)
+    if index is None:
+        return
+    for name, storage in iter_named_fields(obj):
+        value = getattr(storage, name, None)
+        if not (INamedFile.providedBy(value) or INamedImage.providedBy(value)):
+            continue
+        if value._digest is not None:
+            index.remove(value._digest, value)
+        blob = getattr(value, '_blob', None)
+        if blob is not None:
+            index.releaseBlob(blob, value)
+
+
+@implementer(IDigestIndex)
+class DigestIndex(Persistent):
+    """Index of file and image values by the digest of their data.
+
+    The oids of the values are kept in a BTree set for each digest, so
+    adding or removing a value changes a single bucket, and values which
+    were removed from the database are left out of the results. With
+    `deduplicate`, blob based values with the same data share a blob; the
+    oids of the values sharing a blob are kept in the same way.
+
+    Values which are not stored yet have no oid. They are kept with the
+    transaction until it is committed, and only indexed if they are stored
+    by then.
+    """
+
+    deduplicate = False
+
+    def __init__(self, deduplicate=False):
+        # oids of the values, by digest
+        self._values = OOBTree()
+        # oids of the values sharing a blob, by the oid of the blob
+        self._blob_values = OOBTree()
+        self.deduplicate = deduplicate
+
+    def _load(self, oid):
+        if self._p_jar is None:
+            return None
+        try:
+            return self._p_jar.get(oid)
+        except POSKeyError:
+            # removed from the database
+            return None
+
+    def _pending(self, create=False):
+        """Return the values indexed in the current transaction which were
+        not stored, as lists by the name of the tree and the key they are
+        indexed under.
+        """
+        if self._p_jar is None:
+            return None
+        transaction = self._p_jar.transaction_manager.get()
+        try:
+            return transaction.data(self)
+        except KeyError:
+            if not create:
+                return None
+        pending = {}
+        transaction.set_data(self, pending)
+        transaction.addBeforeCommitHook(self._indexPending, (pending,))
+        return pending
+
+    def _indexPending(self, pending):
+        if not any(pending.values()):
+            return
+        # gives the values which are stored an oid
+        self._p_jar.transaction_manager.get().savepoint(optimistic=True)
+        for (name, key), values in pending.items():
+            for value in values:
+                if value._p_oid is not None:
+                    self._insert(name, key, value)
+        pending.clear()
+
+    def _insert(self, name, key, value):
+        """Add the value to the set under `key` in the tree `name`.
+        """
+        if value._p_oid is None:
+            # adding the value to the database would keep it there even if
+            # it is never stored
+            pending = self._pending(create=True)
+            if pending is not None:
+                values = pending.setdefault((name, key), [])
+                if not any(other is value for other in values):
+                    values.append(value)
+            return
+        tree = getattr(self, name)
+        oids = tree.get(key)
+        if oids is None:
+            oids = tree[key] = OOTreeSet()
+        oids.insert(value._p_oid)
+
+    def _remove(self, name, key, value):
+        """Remove the value from the set under `key` in the tree `name`.
+        """
+        pending = self._pending()
+        if pending and (name, key) in pending:
+            pending[(name, key)] = [
+                other for other in pending[(name, key)] if other is not value]
+        _discard(getattr(self, name), key, value._p_oid)
+
+    def _iterValues(self, name, key):
+        """Iterate over the values in the set under `key` in the tree
+        `name`, including those which are not stored yet.
+        """
+        oids = getattr(self, name).get(key, ())
+        for oid in oids:
+            value = self._load(oid)
+            if value is not None:
+                yield value
+        for value in (self._pending() or {}).get((name, key), ()):
+            if value._p_oid is None or value._p_oid not in oids:
+                yield value
+
+    def add(self, digest, value):
+        self._insert('_values', digest, value)
+
+    def remove(self, digest, value):
+        self._remove('_values', digest, value)
+
+    def values(self, digest):
+        return list(self._iterValues('_values', digest))
+
+    def __contains__(self, digest):
+        for value in self._iterValues('_values', digest):
+            return True
+        return False
+
+    def shareBlob(self, blob, value):
+        if blob._p_oid is not None:
+            self._insert('_blob_values', blob._p_oid, value)
+
+    def releaseBlob(self, blob, value):
+        if blob._p_oid is not None:
+            self._remove('_blob_values', blob._p_oid, value)
+
+    def blobReferences(self, blob, limit=None):
+        if blob._p_oid is None:
+            # a blob nobody shares belongs to a single value
+            return 1
+        # only count the values which still exist and use the blob, loading
+        # no more of them than needed
+        count = 0
+        for value in self._iterValues('_blob_values', blob._p_oid):
+            other = getattr(value, '_blob', None)
+            if getattr(other, '_p_oid', None) == blob._p_oid:
+                count += 1
+                if count == limit:
+                    break
+        return count or 1
+
+
+def _discard(tree, key, oid):
+    """Remove the `oid` from the set of oids stored under `key` in the
+    `tree`, and the set if it is empty then.
+    """
+    oids = tree.get(key)
+    if oids is None or oid is None or oid not in oids:
+        return
+    oids.remove(oid)
+    if not oids:
+        del tree[key]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Scaling of images in separate processes.
+
+Register `ProcessScalingExecutor` as a utility to scale images in child
+processes instead of the threads serving requests. Each job runs in a
+process of its own, which is killed if it takes longer than
+`SCALING_TIMEOUT` seconds, and can't allocate more than
+`SCALING_MEMORY_LIMIT` bytes. Images stored in blobs are passed by the path
+of the blob file, not by their data.
+
+Where the platform supports it, the processes are forked from a small
+server process, not from the multithreaded Zope process, which is only
+forked on Python 2.
+"""
+from plone.namedfile import settings
+from plone.namedfile.interfaces import IImageScalingExecutor
+from plone.namedfile.scaling import scale_image
+from zope.interface import implementer
+
+import multiprocessing
+import os
+import threading
+
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class ScalingError(Exception):
+    """Scaling the image failed in the child process.
+    """
+
+
+class ScalingTimeout(ScalingError):
+    """Scaling the image took longer than the timeout.
+    """
+
+
+def _scale_file(filename, scales, quality):
+    with open(filename, 'rb') as fp:
+        return scale_image(fp, scales, quality)
+
+
+def _context():
+    """Return the multiprocessing context making the child processes.
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        # Python 2 can only fork
+        return multiprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return get_context('forkserver')
+    return get_context('spawn')
+
+
+def _address_space():
+    """Return the size of the virtual memory of this process in bytes, or
+    None if it is not known.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[0])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def _limit_memory(memory_limit):
+    # the address space counts the memory the process uses already
+    used = _address_space()
+    if used is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = used + memory_limit
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _run(connection, memory_limit, function, args):
+    # runs in the child process
+    if memory_limit is not None and resource is not None:
+        _limit_memory(memory_limit)
+    try:
+        result = function(*args)
+    except Exception as e:
+        result = e
+    try:
+        connection.send(result)
+    except Exception as e:
+        # e.g. an exception which can't be pickled
+        connection.send(ScalingError(repr(e)))
+    connection.close()
+
+
+@implementer(IImageScalingExecutor)
+class ProcessScalingExecutor(object):
+    """Scales images in child processes, at most `processes` at a time.
+    """
+
+    def __init__(self, processes=None, timeout=None, memory_limit=None):
+        if processes is None:
+            processes = settings.SCALING_PROCESSES
+        if timeout is None:
+            timeout = settings.SCALING_TIMEOUT
+        if memory_limit is None:
+            memory_limit = settings.SCALING_MEMORY_LIMIT
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._slots = threading.BoundedSemaphore(processes)
+
+    def __call__(self, image, scales, quality):
+        filename = getattr(image, 'name', None)
+        if isinstance(filename, str) and os.path.isfile(filename):
+            # a blob file, which the child process can open itself
+            return self.run(_scale_file, filename, scales, quality)
+        if hasattr(image, 'read'):
+            image = image.read()
+        return self.run(scale_image, image, scales, quality)
+
+    def run(self, function, *args):
+        """Return the result of calling `function` with the `args` in a
+        child process. Exceptions raised by it are raised again.
+        """
+        with self._slots:
+            context = _context()
+            receiver, sender = context.Pipe(False)
+            process = context.Process(
+                target=_run,
+                args=(sender, self.memory_limit, function, args),
+            )
+            process.daemon = True
+            process.start()
+            # only the child writes, so reading fails when it is gone
+            sender.close()
+            try:
+                if not receiver.poll(self.timeout):
+                    process.terminate()
+                    process.join()
+                    raise ScalingTimeout(self.timeout)
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    process.join()
+                    raise ScalingError(
+                        'process exited with {0}'.format(process.exitcode))
+            finally:
+                receiver.close()
+            process.join()
+        if isinstance(result, Exception):
+            raise result
+        return result
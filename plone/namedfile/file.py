@@ -2,20 +2,32 @@
 # The implementations in this file are largely borrowed
 # from zope.app.file and z3c.blobfile
 # and are licensed under the ZPL.
-from io import StringIO
+from bisect import bisect_right
+from contextlib import contextmanager
 from persistent import Persistent
+from plone.namedfile import settings
+from plone.namedfile.copy import copyBlob
+from plone.namedfile.digest import compute_digest
+from plone.namedfile.digest import update_digest_index
+from plone.namedfile.imageinfo import getImageInfo
+from plone.namedfile.ingest import IngestingBlob
+from plone.namedfile.interfaces import IBlobby
+from plone.namedfile.interfaces import IDigestIndex
 from plone.namedfile.interfaces import INamedBlobFile
 from plone.namedfile.interfaces import INamedBlobImage
 from plone.namedfile.interfaces import INamedFile
 from plone.namedfile.interfaces import INamedImage
-from plone.namedfile.interfaces import IStorage
+from plone.namedfile.utils import blob_buffer
+from plone.namedfile.utils import get_blob_size
 from plone.namedfile.utils import get_contenttype
+from plone.namedfile.utils import get_storable
+from plone.namedfile.utils import iter_file_data
 from ZODB.blob import Blob
-from zope.component import getUtility
+from zope.component import queryUtility
 from zope.interface import implementer
 from zope.schema.fieldproperty import FieldProperty
 
-import struct
+import hashlib
 import transaction
 
 
@@ -25,19 +37,96 @@ MAX_INFO_BYTES = 1 << 16
 
 
 class FileChunk(Persistent):
-    """Wrapper for possibly large data"""
+    """Wrapper for possibly large data
+
+    The chunk at the head of a chain of chunks may carry an index of the
+    chain: the offsets at which its chunks start, followed by the length of
+    the chain, and the chunks themselves. It allows getting the length of
+    the chain and locating the chunk holding a given byte without loading
+    the other chunks from the database.
+    """
 
     next = None
+    _offsets = None
+    _chunks = None
 
     def __init__(self, data):
         self._data = data
 
+    def _getIndex(self):
+        """Return the offsets and the chunks of the chain starting here.
+
+        Chains without a stored index are walked once. The result is kept
+        in a volatile attribute: building an index must not cause a write
+        when the data is only read.
+        """
+        if self._offsets is not None:
+            return self._offsets, self._chunks
+        index = getattr(self, '_v_index', None)
+        if index is not None:
+            return index
+        offsets = [0]
+        chunks = []
+        chunk = self
+        while chunk is not None:
+            chunks.append(chunk)
+            offsets.append(offsets[-1] + len(chunk._data))
+            next = chunk.next
+            if chunk is not self:
+                chunk._p_deactivate()
+            chunk = next
+        index = self._v_index = (tuple(offsets), tuple(chunks))
+        return index
+
+    def _setIndex(self, offsets, chunks):
+        if len(chunks) > 1:
+            self._offsets = tuple(offsets)
+            self._chunks = tuple(chunks)
+
+    def updateIndex(self):
+        """Store the index of the chain starting with this chunk.
+        """
+        offsets, chunks = self._getIndex()
+        self._setIndex(offsets, chunks)
+
+    def locate(self, position):
+        """Return the chunk of the chain holding the byte at `position`,
+        together with the offset the chunk starts at.
+        """
+        offsets, chunks = self._getIndex()
+        i = bisect_right(offsets, position, 0, len(chunks)) - 1
+        return chunks[max(i, 0)], offsets[max(i, 0)]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            size = len(self)
+            if key < 0:
+                key += size
+            if not 0 <= key < size:
+                raise IndexError('chunk index out of range')
+            chunk, offset = self.locate(key)
+            return chunk._data[key - offset]
+        start, stop, step = key.indices(len(self))
+        if stop <= start:
+            return self._data[0:0]
+        chunk, offset = self.locate(start)
+        result = []
+        while chunk is not None and offset < stop:
+            data = chunk._data
+            result.append(data[max(start - offset, 0):stop - offset])
+            offset += len(data)
+            chunk = chunk.next
+        data = self._data[0:0].join(result)
+        if step != 1:
+            data = data[::step]
+        return data
+
     def __getslice__(self, i, j):
-        return self._data[i:j]
+        return self.__getitem__(slice(max(i, 0), max(j, 0)))
 
     def __len__(self):
-        data = str(self)
-        return len(data)
+        offsets, chunks = self._getIndex()
+        return offsets[-1]
 
     def __str__(self):
         next = self.next
@@ -61,6 +150,14 @@ except ImportError:
     pass
 
 
+def iterChunks(chunk):
+    """Iterate over the chain of chunks starting with `chunk`.
+    """
+    while chunk is not None:
+        yield chunk
+        chunk = chunk.next
+
+
 @implementer(INamedFile)
 class NamedFile(Persistent):
     """A non-BLOB file that stores a filename
@@ -154,6 +251,9 @@ class NamedFile(Persistent):
 
     filename = FieldProperty(INamedFile['filename'])
 
+    # SHA-256 digest of the data, None if not known yet
+    _digest = None
+
     def __init__(self, data='', contentType='', filename=None):
         if (
             filename is not None and
@@ -167,9 +267,74 @@ class NamedFile(Persistent):
     def _getData(self):
         if isinstance(self._data, tuple(FILECHUNK_CLASSES)):
             return str(self._data)
+        elif isinstance(self._data, Blob):
+            with self._data.open('r') as fp:
+                return fp.read()
         else:
             return self._data
 
+    @contextmanager
+    def buffer(self):
+        '''See `INamedFile`'''
+        data = self._data
+        if isinstance(data, Blob):
+            with blob_buffer(data) as view:
+                yield view
+            return
+        if isinstance(data, FileChunk) and data.next is None:
+            # no need to join a chain of one chunk
+            data = data._data
+        elif isinstance(data, tuple(FILECHUNK_CLASSES)):
+            data = self._getData()
+        yield memoryview(data)
+
+    def iterChunks(self, start=0, end=None):
+        '''See `INamedFile`'''
+        return iter_file_data(self, start, end)
+
+    def readRange(self, start, length=None):
+        '''See `INamedFile`'''
+        end = None if length is None else start + length
+        return b''.join(self.iterChunks(start, end))
+
+    def _storeInBlob(self, size):
+        """Check whether data of the given size is to be stored in a blob.
+        """
+        threshold = settings.BLOB_THRESHOLD
+        return threshold is not None and size > threshold
+
+    def _setBlobData(self, pieces, size):
+        blob = Blob()
+        hash = hashlib.sha256()
+        with blob.open('w') as fp:
+            for data in pieces:
+                fp.write(data)
+                hash.update(data)
+        self._data, self._size = blob, size
+        self._setDigest(hash.hexdigest())
+
+    def _setDigest(self, digest):
+        old, self._digest = self._digest, digest
+        self._v_digest = None
+        update_digest_index(self, old, digest)
+
+    def getDigest(self):
+        '''See `INamedFile`'''
+        if self._digest is not None:
+            return self._digest
+        # stored by an older version
+        digest = getattr(self, '_v_digest', None)
+        if digest is None:
+            digest = compute_digest(self)
+        if self._p_jar is None or self._p_changed:
+            # the value is written anyway
+            self._setDigest(digest)
+        else:
+            # Don't cause a write when the value is only read, e.g. while
+            # serving a GET request.
+            self._v_digest = digest
+        return digest
+
     def _setData(self, data):
 
         # Handle case when data is a string
@@ -177,7 +342,11 @@ class NamedFile(Persistent):
             data = data.encode('UTF-8')
 
         if isinstance(data, bytes):
+            if self._storeInBlob(len(data)):
+                self._setBlobData([data], len(data))
+                return
             self._data, self._size = FileChunk(data), len(data)
+            self._setDigest(hashlib.sha256(data).hexdigest())
             return
 
         # Handle case when data is None
@@ -186,8 +355,20 @@ class NamedFile(Persistent):
 
         # Handle case when data is already a FileChunk
         if isinstance(data, tuple(FILECHUNK_CLASSES)):
-            size = len(data)
+            if isinstance(data, FileChunk):
+                data.updateIndex()
+                size = len(data)
+            else:
+                size = sum(len(chunk._data) for chunk in iterChunks(data))
+            if self._storeInBlob(size):
+                self._setBlobData(
+                    (chunk._data for chunk in iterChunks(data)), size)
+                return
+            hash = hashlib.sha256()
+            for chunk in iterChunks(data):
+                hash.update(chunk._data)
             self._data, self._size = data, size
+            self._setDigest(hash.hexdigest())
             return
 
         # Handle case when data is a file object
@@ -195,14 +376,21 @@ class NamedFile(Persistent):
         read = data.read
 
         seek(0, 2)
-        size = end = data.tell()
+        size = data.tell()
+
+        if self._storeInBlob(size):
+            seek(0)
+            self._setBlobData(iter(lambda: read(MAXCHUNKSIZE), b''), size)
+            return
 
         if size <= 2 * MAXCHUNKSIZE:
             seek(0)
+            data = read(size)
+            self._setDigest(hashlib.sha256(data).hexdigest())
             if size < MAXCHUNKSIZE:
-                self._data, self._size = read(size), size
+                self._data, self._size = data, size
                 return
-            self._data, self._size = FileChunk(read(size)), size
+            self._data, self._size = FileChunk(data), size
             return
 
         # Make sure we have an _p_jar, even if we are a new object, by
@@ -214,41 +402,55 @@ class NamedFile(Persistent):
         if jar is None:
             # Ugh
             seek(0)
-            self._data, self._size = FileChunk(read(size)), size
+            data = read(size)
+            self._data, self._size = FileChunk(data), size
+            self._setDigest(hashlib.sha256(data).hexdigest())
             return
 
-        # Now we're going to build a linked list from back
-        # to front to minimize the number of database updates
-        # and to allow us to get things out of memory as soon as
-        # possible.
-        next = None
-        while end > 0:
-            pos = end - MAXCHUNKSIZE
-            if pos < MAXCHUNKSIZE:
-                pos = 0  # we always want at least MAXCHUNKSIZE bytes
-            seek(pos)
-            data = FileChunk(read(end - pos))
+        # Now we're going to build a linked list from front to back,
+        # computing the digest while reading the data, and getting things
+        # out of memory as soon as possible. Each chunk is saved together
+        # with an empty chunk following it, which gets its data in the next
+        # step. So only these small placeholders are written twice. The head
+        # of the chain is saved last, with the index of the chain.
+        count = size // MAXCHUNKSIZE
+        seek(0)
+        hash = hashlib.sha256()
+        data = read(size - (count - 1) * MAXCHUNKSIZE)
+        hash.update(data)
+        head = chunk = FileChunk(data)
+        offsets = [0, len(data)]
+        chunks = [head]
+        for i in range(count - 1):
+            next = FileChunk(b'')
 
             # Woooop Woooop Woooop! This is a trick.
             # We stuff the data directly into our jar to reduce the
             # number of updates necessary.
-            jar.add(data)
-
-            # This is needed and has side benefit of getting
-            # the thing registered:
-            data.next = next
+            jar.add(next)
+            chunk.next = next
 
             # Now make it get saved in a sub-transaction!
             transaction.savepoint(optimistic=True)
 
-            # Now make it a ghost to free the memory.  We
-            # don't need it anymore!
-            data._p_changed = None
+            if chunk is not head:
+                # Now make it a ghost to free the memory.  We
+                # don't need it anymore!
+                chunk._p_changed = None
+
+            data = read(MAXCHUNKSIZE)
+            hash.update(data)
+            next._data = data
+            offsets.append(offsets[-1] + len(data))
+            chunks.append(next)
+            chunk = next
 
-            next = data
-            end = pos
+        transaction.savepoint(optimistic=True)
+        chunk._p_changed = None
 
-        self._data, self._size = next, size
+        head._setIndex(offsets, chunks)
+        self._data, self._size = head, size
+        self._setDigest(hash.hexdigest())
         return
 
     def getSize(self):
@@ -266,7 +468,8 @@ class NamedImage(NamedFile):
     filename = FieldProperty(INamedFile['filename'])
 
     def __init__(self, data='', contentType='', filename=None):
-        self.contentType, self._width, self._height = getImageInfo(data)
+        # the type and dimensions are sniffed when setting the data
+        self.contentType = ''
         self.data = data
         self.filename = filename
 
@@ -288,88 +491,13 @@ class NamedImage(NamedFile):
     data = property(NamedFile._getData, _setData)
 
 
-def getImageInfo(data):  # noqa
-    data = str(data)
-    size = len(data)
-    height = -1
-    width = -1
-    content_type = ''
-
-    # handle GIFs
-    if (size >= 10) and data[:6] in ('GIF87a', 'GIF89a'):
-        # Check to see if content_type is correct
-        content_type = 'image/gif'
-        w, h = struct.unpack('<HH', data[6:10])
-        width = int(w)
-        height = int(h)
-
-    # See PNG 2. Edition spec (http://www.w3.org/TR/PNG/)
-    # Bytes 0-7 are below, 4-byte chunk length, then 'IHDR'
-    # and finally the 4-byte width, height
-    elif (
-        (size >= 24) and data.startswith('\211PNG\r\n\032\n') and
-        (data[12:16] == 'IHDR')
-    ):
-        content_type = 'image/png'
-        w, h = struct.unpack('>LL', data[16:24])
-        width = int(w)
-        height = int(h)
-
-    # Maybe this is for an older PNG version.
-    elif (size >= 16) and data.startswith('\211PNG\r\n\032\n'):
-        # Check to see if we have the right content type
-        content_type = 'image/png'
-        w, h = struct.unpack('>LL', data[8:16])
-        width = int(w)
-        height = int(h)
-
-    # handle JPEGs
-    elif (size >= 2) and data.startswith('\377\330'):
-        content_type = 'image/jpeg'
-        jpeg = StringIO(data)
-        jpeg.read(2)
-        b = jpeg.read(1)
-        try:
-            w = -1
-            h = -1
-            while (b and ord(b) != 0xDA):
-                while (ord(b) != 0xFF):
-                    b = jpeg.read(1)
-                while (ord(b) == 0xFF):
-                    b = jpeg.read(1)
-                if (ord(b) >= 0xC0 and ord(b) <= 0xC3):
-                    jpeg.read(3)
-                    h, w = struct.unpack('>HH', jpeg.read(4))
-                    break
-                else:
-                    jpeg.read(int(struct.unpack('>H', jpeg.read(2))[0]) - 2)
-                b = jpeg.read(1)
-            width = int(w)
-            height = int(h)
-        except struct.error:
-            pass
-        except ValueError:
-            pass
-        except TypeError:
-            pass
-
-    # handle BMPs
-    elif (size >= 30) and data.startswith('BM'):
-        kind = struct.unpack('<H', data[14:16])[0]
-        if kind == 40:  # Windows 3.x bitmap
-            content_type = 'image/x-ms-bmp'
-            width, height = struct.unpack('<LL', data[18:26])
-
-    return content_type, width, height
-
-
 @implementer(INamedBlobFile)
 class NamedBlobFile(Persistent):
     """A file stored in a ZODB BLOB, with a filename"""
 
     filename = FieldProperty(INamedFile['filename'])
 
-    def __init__(self, data='', contentType='', filename=None):
+    def __init__(self, data=b'', contentType='', filename=None):
         if (
             filename is not None and
             contentType in ('', 'application/octet-stream')
@@ -378,27 +506,141 @@ class NamedBlobFile(Persistent):
         self.contentType = contentType
         self._blob = Blob()
         f = self._blob.open('w')
-        f.write('')
+        f.write(b'')
         f.close()
         self._setData(data)
         self.filename = filename
 
+    # Size and SHA-256 digest of the data, found while storing it. They are
+    # None if not known yet.
+    _size = None
+    _digest = None
+
+    # Set if the blob was taken over from another value with the same data,
+    # see `IDigestIndex`. The index knows all values sharing a blob.
+    _blob_shared = False
+
     def open(self, mode='r'):
-        if mode != 'r' and 'size' in self.__dict__:
-            del self.__dict__['size']
-        return self._blob.open(mode)
+        if mode == 'r':
+            return self._blob.open(mode)
+        self._unshareBlob(keep_data=mode != 'w')
+        self._size = self._v_size = None
+        self._setDigest(None)
+        if mode != 'w':
+            return self._blob.open(mode)
+        # find the properties of the data written
+        ingest = IngestingBlob(self._blob, callback=self._ingested)
+        return ingest.open(mode)
 
     def openDetached(self):
         return open(self._blob.committed(), 'rb')
 
     def _setData(self, data):
-        if 'size' in self.__dict__:
-            del self.__dict__['size']
         # Search for a storable that is able to store the data
-        dottedName = '.'.join((data.__class__.__module__,
-                               data.__class__.__name__))
-        storable = getUtility(IStorage, name=dottedName)
-        storable.store(data, self._blob)
+        storable = get_storable(data)
+        self._unshareBlob()
+        ingest = IngestingBlob(self._blob)
+        storable.store(data, ingest)
+        self._ingested(ingest)
+
+    def _consumeFile(self, filename):
+        """Take over the data of the file `filename`, which is moved into
+        the blob.
+
+        The data is not read; its digest is computed when needed.
+        """
+        self._unshareBlob()
+        ingest = IngestingBlob(self._blob)
+        self._blob.consumeFile(filename)
+        self._ingested(ingest)
+
+    def _ingested(self, ingest):
+        """Take over the properties of the data found while it was stored.
+        """
+        if ingest.complete:
+            self._size = ingest.size
+            self._setDigest(ingest.hexdigest())
+            self._shareBlob()
+        else:
+            # the size is cheap to find, the digest is computed when needed
+            self._size = get_blob_size(self._blob)
+            self._setDigest(None)
+
+    def _shareBlob(self):
+        """Use the committed blob of another value with the same data
+        instead of our own, if the digest index deduplicates blobs.
+        """
+        index = queryUtility(IDigestIndex)
+        if index is None or not index.deduplicate:
+            return
+        for other in index.values(self._digest):
+            if (
+                other is self or
+                not IBlobby.providedBy(other) or
+                other._digest != self._digest
+            ):
+                continue
+            if other._blob is self._blob or self._useBlobOf(other):
+                return
+
+    def _useBlobOf(self, other):
+        """Share the blob of the value `other`, if it is committed.
+
+        Returns whether the blob is shared. The digest index keeps track of
+        the values sharing a blob, so this requires one. Either value gets
+        a blob of its own when it is written to.
+        """
+        blob = other._blob
+        if blob._p_oid is None or blob._p_blob_uncommitted is not None:
+            # not committed yet, so it may still change
+            return False
+        index = queryUtility(IDigestIndex)
+        if index is None:
+            return False
+        index.shareBlob(blob, other)
+        index.shareBlob(blob, self)
+        # an uncommitted blob file of our own is removed with the blob
+        self._blob = blob
+        self._blob_shared = True
+        return True
+
+    def _unshareBlob(self, keep_data=False):
+        """Get a blob of our own before writing to it, if it is shared with
+        other values. With `keep_data`, the data is copied to the new blob.
+        """
+        index = queryUtility(IDigestIndex)
+        if index is not None:
+            shared = index.blobReferences(self._blob, limit=2) > 1
+            index.releaseBlob(self._blob, self)
+        else:
+            # the values sharing the blob are not known
+            shared = self._blob_shared
+        if self._blob_shared:
+            self._blob_shared = False
+        if shared:
+            self._blob = copyBlob(self._blob) if keep_data else Blob()
+
+    def _setDigest(self, digest):
+        old, self._digest = self._digest, digest
+        self._v_digest = None
+        update_digest_index(self, old, digest)
+
+    def getDigest(self):
+        '''See `INamedFile`'''
+        if self._digest is not None:
+            return self._digest
+        # stored by an older version, or written in a way not followed
+        digest = getattr(self, '_v_digest', None)
+        if digest is None:
+            digest = compute_digest(self)
+        if self._p_jar is None or self._p_changed:
+            # the value is written anyway
+            self._setDigest(digest)
+        else:
+            # Don't cause a write when the value is only read, e.g. while
+            # serving a GET request.
+            self._v_digest = digest
+        return digest
 
     def _getData(self):
         fp = self._blob.open('r')
@@ -406,18 +648,38 @@ class NamedBlobFile(Persistent):
         fp.close()
         return data
 
+    def buffer(self):
+        '''See `INamedFile`'''
+        return blob_buffer(self._blob)
+
+    def iterChunks(self, start=0, end=None):
+        '''See `INamedFile`'''
+        return iter_file_data(self, start, end)
+
+    def readRange(self, start, length=None):
+        '''See `INamedFile`'''
+        with self._blob.open('r') as fp:
+            fp.seek(start)
+            return fp.read(-1 if length is None else length)
+
     _data = property(_getData, _setData)
     data = property(_getData, _setData)
 
     @property
     def size(self):
-        if 'size' in self.__dict__:
-            return self.__dict__['size']
-        reader = self._blob.open()
-        reader.seek(0, 2)
-        size = int(reader.tell())
-        reader.close()
-        self.__dict__['size'] = size
+        if self._size is not None:
+            return self._size
+        # stored by an older version, or written in a way not followed
+        size = getattr(self, '_v_size', None)
+        if size is None:
+            size = get_blob_size(self._blob)
+        if self._p_jar is None or self._p_changed:
+            # the value is written anyway
+            self._size = size
+        else:
+            # Don't cause a write when the value is only read, e.g. while
+            # serving a GET request.
+            self._v_size = size
         return size
 
     def getSize(self):
@@ -429,45 +691,54 @@ class NamedBlobImage(NamedBlobFile):
     """An image stored in a ZODB BLOB with a filename
     """
 
-    def __init__(self, data='', contentType='', filename=None):
+    def __init__(self, data=b'', contentType='', filename=None):
         super(NamedBlobImage, self).__init__(data, filename=filename)
 
         # Allow override of the image sniffer
         if contentType:
             self.contentType = contentType
 
-    def _setData(self, data):
-        super(NamedBlobImage, self)._setData(data)
-        firstbytes = self.getFirstBytes()
-        res = getImageInfo(firstbytes)
-        if res == ('image/jpeg', -1, -1):
-            # header was longer than firstbytes
-            start = len(firstbytes)
-            length = max(0, MAX_INFO_BYTES - start)
-            firstbytes += self.getFirstBytes(start, length)
-            res = getImageInfo(firstbytes)
+    # Set if the dimensions of the image can not be determined, so that
+    # getImageSize does not look for them again.
+    _dimensions_unknown = False
+
+    def _ingested(self, ingest):
+        super(NamedBlobImage, self)._ingested(ingest)
+        res = ('', -1, -1)
+        head = ingest.head if ingest.complete else b''
+        if head:
+            res = getImageInfo(head)
+        if -1 in res[1:] and (
+            not ingest.complete or ingest.size > len(head)
+        ):
+            # the header is longer than the bytes kept while storing
+            with self.open('r') as fp:
+                res = getImageInfo(fp)
         contentType, self._width, self._height = res
+        self._dimensions_unknown = (self._width, self._height) == (-1, -1)
         if contentType:
             self.contentType = contentType
 
-    data = property(NamedBlobFile._getData, _setData)
-
     def getFirstBytes(self, start=0, length=IMAGE_INFO_BYTES):
         """Returns the first bytes of the file.
 
         Returns an amount which is sufficient to determine the image type.
         """
-        fp = self.open('r')
-        fp.seek(start)
-        firstbytes = fp.read(length)
-        fp.close()
-        return firstbytes
+        return self.readRange(start, length)
 
     def getImageSize(self):
         """See interface `IImage`"""
-        if (self._width, self._height) != (-1, -1):
+        if (
+            (self._width, self._height) != (-1, -1) or
+            self._dimensions_unknown
+        ):
             return (self._width, self._height)
 
-        res = getImageInfo(self.data)
+        # The dimensions were not found when the data was stored, possibly
+        # by an older version. Look again, reading the header only, and
+        # remember the result.
+        with self.open('r') as fp:
+            res = getImageInfo(fp)
         contentType, self._width, self._height = res
+        self._dimensions_unknown = (self._width, self._height) == (-1, -1)
         return (self._width, self._height)
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""Sniff the type and dimensions of images from their header.
+
+The parsers only read the bytes they need from a file-like object. JPEG
+images are examined by seeking from segment to segment using the lengths
+stored in the segment headers, so large embedded thumbnails or metadata do
+not have to be read. Likewise only the boxes holding the image properties
+are read from AVIF and HEIF images, and only the first directory from TIFF
+images. SVG images are recognized by their root element, which has to be
+found within the first `SVG_HEADER_BYTES` bytes.
+
+For other formats, or if the dimensions are not found in the header, the
+image is opened with PIL, if available, which also only reads the header
+but does not decode the image data.
+"""
+from io import BytesIO
+from plone.namedfile.utils import FileChunkReader
+from plone.namedfile.utils import is_chunk_chain
+from ZODB.blob import Blob
+
+import re
+import struct
+
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# Number of bytes read to sniff the type of the image, enough for the
+# fixed size headers of GIF, PNG, BMP and WebP images.
+HEADER_BYTES = 32
+
+# Number of bytes searched for the root element of SVG images.
+SVG_HEADER_BYTES = 4096
+
+# Number of bytes searched for the next marker if a JPEG segment is followed
+# by garbage.
+JPEG_SCAN_BYTES = 512
+
+# JPEG start of frame markers holding the dimensions of the image, for all
+# coding processes (baseline, progressive, lossless, hierarchical and
+# arithmetic coding); 0xC4, 0xC8 and 0xCC are other markers.
+JPEG_SOF_MARKERS = tuple(
+    code for code in range(0xC0, 0xD0) if code not in (0xC4, 0xC8, 0xCC))
+
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = (0x01, ) + tuple(range(0xD0, 0xD9))
+
+# Brands of the ISO base media file format (the ``ftyp`` box) for AVIF and
+# HEIF images.
+AVIF_BRANDS = (b'avif', b'avis')
+HEIC_BRANDS = (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx')
+HEIF_BRANDS = (b'mif1', b'msf1')
+
+# Maximum number of boxes looked at on each level of AVIF and HEIF images,
+# and of directory entries looked at in TIFF images.
+MAX_BOXES = 64
+MAX_TIFF_ENTRIES = 256
+
+# CSS pixels per unit, for the width and height of SVG images
+SVG_UNITS = {
+    b'': 1.0,
+    b'px': 1.0,
+    b'pt': 4.0 / 3,
+    b'pc': 16.0,
+    b'mm': 96 / 25.4,
+    b'cm': 96 / 2.54,
+    b'in': 96.0,
+}
+
+
+def getImageInfo(data):
+    """Return the content type, width and height of the image `data`.
+
+    `data` may be a string, a chain of `FileChunk` objects, a blob or an
+    open file; a file is read from its current position, which is restored
+    afterwards. If the type is unknown, ``('', -1, -1)`` is returned; if the
+    dimensions can not be found, they are -1.
+    """
+    if is_chunk_chain(data):
+        return readImageInfo(FileChunkReader(data))
+    if isinstance(data, Blob):
+        with data.open('r') as fp:
+            return readImageInfo(fp)
+    if all(hasattr(data, name) for name in ('read', 'seek', 'tell')):
+        position = data.tell()
+        try:
+            return readImageInfo(data)
+        finally:
+            data.seek(position)
+    if not isinstance(data, bytes):
+        data = str(data)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+    return readImageInfo(BytesIO(data))
+
+
+def readImageInfo(fp):
+    """Return the content type, width and height of the image in the open
+    file `fp`, starting at its current position.
+    """
+    base = fp.tell()
+
+    def read(offset, length):
+        fp.seek(base + offset)
+        return fp.read(length)
+
+    head = read(0, HEADER_BYTES)
+    info = '', -1, -1
+    for parser in IMAGE_PARSERS:
+        result = parser(head, read)
+        if result is not None:
+            info = result
+            break
+    if -1 in info[1:] and base == 0:
+        info = _pil_info(fp, info)
+    return info
+
+
+def _pil_info(fp, info):
+    """Return the type and dimensions of the image as reported by PIL, or
+    `info` if PIL is not available or can't open the image.
+    """
+    if PILImage is None:
+        return info
+    try:
+        fp.seek(0)
+        # this reads the header only, the image data is decoded on load
+        image = PILImage.open(fp)
+        width, height = image.size
+        content_type = PILImage.MIME.get(image.format, '')
+    except Exception:
+        return info
+    return info[0] or content_type, int(width), int(height)
+
+
+def _gif_info(head, read):
+    if len(head) < 10 or head[:6] not in (b'GIF87a', b'GIF89a'):
+        return None
+    width, height = struct.unpack('<HH', head[6:10])
+    return 'image/gif', int(width), int(height)
+
+
+def _png_info(head, read):
+    # See PNG 2. Edition spec (http://www.w3.org/TR/PNG/)
+    # Bytes 0-7 are the signature, then the 4-byte chunk length, 'IHDR'
+    # and finally the 4-byte width, height
+    if not head.startswith(b'\211PNG\r\n\032\n'):
+        return None
+    if len(head) >= 24 and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>LL', head[16:24])
+    elif len(head) >= 16:
+        # Maybe this is for an older PNG version.
+        width, height = struct.unpack('>LL', head[8:16])
+    else:
+        return None
+    return 'image/png', int(width), int(height)
+
+
+def _jpeg_info(head, read):
+    if not head.startswith(b'\377\330'):
+        return None
+    width = height = -1
+    offset = 2
+    while True:
+        marker = bytearray(read(offset, 2))
+        if len(marker) < 2:
+            break
+        if marker[0] != 0xFF:
+            # garbage between segments, look for the next marker
+            window = read(offset, JPEG_SCAN_BYTES)
+            found = window.find(b'\377')
+            if found < 0:
+                break
+            offset += found
+            continue
+        code = marker[1]
+        if code == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        if code in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if code in (0xD9, 0xDA):
+            # end of image or start of scan: no frame header
+            break
+        segment = read(offset + 2, 7)
+        if len(segment) < 2:
+            break
+        if code in JPEG_SOF_MARKERS:
+            if len(segment) == 7:
+                height, width = struct.unpack('>HH', segment[3:7])
+            break
+        length = struct.unpack('>H', segment[:2])[0]
+        if length < 2:
+            break
+        offset += 2 + length
+    return 'image/jpeg', int(width), int(height)
+
+
+def _bmp_info(head, read):
+    if len(head) < 30 or not head.startswith(b'BM'):
+        return None
+    kind = struct.unpack('<H', head[14:16])[0]
+    if kind == 12:
+        # OS/2 bitmap
+        width, height = struct.unpack('<HH', head[18:22])
+    elif kind >= 40:
+        # Windows 3.x bitmap and later versions, stored top-down if the
+        # height is negative
+        width, height = struct.unpack('<ll', head[18:26])
+        height = abs(height)
+    else:
+        return '', -1, -1
+    return 'image/x-ms-bmp', int(width), int(height)
+
+
+def _webp_info(head, read):
+    if len(head) < 30 or head[:4] != b'RIFF' or head[8:12] != b'WEBP':
+        return None
+    kind = head[12:16]
+    if kind == b'VP8 ':
+        # lossy: the key frame header holds 14 bit dimensions
+        width, height = struct.unpack('<HH', head[26:30])
+        width, height = width & 0x3FFF, height & 0x3FFF
+    elif kind == b'VP8L':
+        # lossless: 14 bit dimensions minus one, after the signature byte
+        bits = struct.unpack('<L', head[21:25])[0]
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+    elif kind == b'VP8X':
+        # extended: 24 bit canvas dimensions minus one
+        width = struct.unpack('<L', head[24:27] + b'\0')[0] + 1
+        height = struct.unpack('<L', head[27:30] + b'\0')[0] + 1
+    else:
+        return 'image/webp', -1, -1
+    return 'image/webp', int(width), int(height)
+
+
+def _iter_boxes(read, start, end):
+    """Iterate over the boxes of an ISO base media file between `start` and
+    `end` (None for the end of the file), yielding their type and the
+    offsets of their payload.
+    """
+    offset = start
+    for i in range(MAX_BOXES):
+        if end is not None and offset + 8 > end:
+            return
+        header = read(offset, 16)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>L4s', header[:8])
+        header_size = 8
+        if size == 1:
+            # 64 bit size
+            if len(header) < 16:
+                return
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            # the box extends to the end
+            yield kind, offset + header_size, end
+            return
+        if size < header_size:
+            return
+        yield kind, offset + header_size, offset + size
+        offset += size
+
+
+def _find_box(read, start, end, kind):
+    for box_kind, box_start, box_end in _iter_boxes(read, start, end):
+        if box_kind == kind:
+            return box_start, box_end
+    return None
+
+
+def _isobmff_info(head, read):
+    if len(head) < 16 or head[4:8] != b'ftyp':
+        return None
+    size = struct.unpack('>L', head[:4])[0]
+    brands = read(8, min(max(size, 16), 256) - 8)
+    major = brands[:4]
+    compatible = [brands[i:i + 4] for i in range(8, len(brands) - 3, 4)]
+    if major in AVIF_BRANDS:
+        content_type = 'image/avif'
+    elif major in HEIC_BRANDS:
+        content_type = 'image/heic'
+    elif major in HEIF_BRANDS:
+        if any(brand in AVIF_BRANDS for brand in compatible):
+            content_type = 'image/avif'
+        elif any(brand in HEIC_BRANDS for brand in compatible):
+            content_type = 'image/heic'
+        else:
+            content_type = 'image/heif'
+    else:
+        # some other kind of media, e.g. a video
+        return None
+
+    # The dimensions are stored in the image spatial extents properties
+    # (meta/iprp/ipco/ispe). There is one for every image item, including
+    # thumbnails and the tiles of grid images, so the largest one is used.
+    width = height = -1
+    box = _find_box(read, 0, None, b'meta')
+    if box is not None:
+        # meta is a full box, with a version and flags before its children
+        box = _find_box(read, box[0] + 4, box[1], b'iprp')
+    if box is not None:
+        box = _find_box(read, box[0], box[1], b'ipco')
+    if box is not None:
+        for kind, start, end in _iter_boxes(read, box[0], box[1]):
+            if kind != b'ispe':
+                continue
+            data = read(start + 4, 8)
+            if len(data) < 8:
+                break
+            w, h = struct.unpack('>LL', data)
+            if w * h > width * height:
+                width, height = w, h
+    return content_type, int(width), int(height)
+
+
+def _tiff_info(head, read):
+    if head[:4] == b'II*\0':
+        order = '<'
+    elif head[:4] == b'MM\0*':
+        order = '>'
+    else:
+        return None
+    width = height = -1
+    # the dimensions are stored in the first image file directory
+    offset = struct.unpack(order + 'L', head[4:8])[0]
+    data = read(offset, 2)
+    if len(data) == 2:
+        count = min(struct.unpack(order + 'H', data)[0], MAX_TIFF_ENTRIES)
+        entries = read(offset + 2, count * 12)
+        for i in range(0, len(entries) - 11, 12):
+            tag, kind = struct.unpack(order + 'HH', entries[i:i + 4])
+            if tag not in (256, 257):
+                continue
+            if kind == 3:
+                # SHORT
+                value = struct.unpack(order + 'H', entries[i + 8:i + 10])[0]
+            elif kind == 4:
+                # LONG
+                value = struct.unpack(order + 'L', entries[i + 8:i + 12])[0]
+            else:
+                continue
+            if tag == 256:
+                width = value
+            else:
+                height = value
+    return 'image/tiff', int(width), int(height)
+
+
+def _ico_info(head, read):
+    if len(head) < 22 or head[:4] != b'\0\0\1\0':
+        return None
+    count = struct.unpack('<H', head[4:6])[0]
+    if not count or bytearray(head[6:22])[3] != 0:
+        # no images or not a valid directory entry
+        return None
+    # use the largest of the images, a size of 0 meaning 256 pixels
+    width = height = -1
+    entries = bytearray(read(6, min(count, 256) * 16))
+    for i in range(0, len(entries) - 15, 16):
+        w = entries[i] or 256
+        h = entries[i + 1] or 256
+        if w * h > width * height:
+            width, height = w, h
+    return 'image/x-icon', int(width), int(height)
+
+
+_svg_root = re.compile(br'<(?:[\w.-]+:)?svg(\s[^>]*)?/?>', re.S)
+_svg_prolog = re.compile(
+    br'<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>|\s+|\xef\xbb\xbf', re.S)
+_svg_attribute = re.compile(br'([\w:.-]+)\s*=\s*(["\'])(.*?)\2', re.S)
+_svg_length = re.compile(
+    br'^\s*([0-9]*\.?[0-9]+(?:[eE][+-]?[0-9]+)?)\s*([a-z]*)\s*$')
+
+
+def _parse_svg_length(value):
+    match = _svg_length.match(value or b'')
+    if match is None or match.group(2) not in SVG_UNITS:
+        # no value, or a relative one
+        return None
+    return float(match.group(1)) * SVG_UNITS[match.group(2)]
+
+
+def _svg_info(head, read):
+    if not head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<'):
+        return None
+    prefix = read(0, SVG_HEADER_BYTES)
+    match = _svg_root.search(prefix)
+    if match is None or _svg_prolog.sub(b'', prefix[:match.start()]):
+        # not an SVG document, e.g. an HTML page with an inline image
+        return None
+    attributes = dict(
+        (name, value)
+        for name, quote, value in _svg_attribute.findall(match.group(1) or b'')
+    )
+    width = _parse_svg_length(attributes.get(b'width'))
+    height = _parse_svg_length(attributes.get(b'height'))
+    viewbox = re.split(br'[\s,]+', attributes.get(b'viewBox', b'').strip())
+    if (width is None or height is None) and len(viewbox) == 4:
+        try:
+            box_width, box_height = float(viewbox[2]), float(viewbox[3])
+        except ValueError:
+            box_width = box_height = 0
+        if box_width > 0 and box_height > 0:
+            if width is None and height is None:
+                width, height = box_width, box_height
+            elif width is None:
+                width = height * box_width / box_height
+            elif height is None:
+                height = width * box_height / box_width
+    width = -1 if width is None else int(round(width))
+    height = -1 if height is None else int(round(height))
+    return 'image/svg+xml', width, height
+
+
+IMAGE_PARSERS = [
+    _gif_info,
+    _png_info,
+    _jpeg_info,
+    _bmp_info,
+    _webp_info,
+    _isobmff_info,
+    _tiff_info,
+    _ico_info,
+    _svg_info,
+]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Find the properties of data while it is stored in a blob.
+
+`NamedBlobFile` hands an `IngestingBlob` instead of its blob to the
+`IStorage` utilities. It passes everything on to the blob, counting and
+hashing the bytes written and keeping the first ones for sniffing the type
+of the data, so the blob does not have to be read again afterwards.
+"""
+import hashlib
+
+
+# Number of bytes kept from the start of the data, for sniffing its type and
+# image dimensions.
+HEAD_BYTES = 1 << 16
+
+
+class IngestingBlob(object):
+    """Stand-in for a blob, watching the data stored in it.
+
+    The results are only `complete` if the data was written from start to
+    end with ``open('w')``; otherwise they have to be found from the blob.
+    If given, `callback` is called with the `IngestingBlob` when a file
+    opened for writing is closed.
+    """
+
+    def __init__(self, blob, callback=None):
+        self.blob = blob
+        self.callback = callback
+        self.complete = False
+        self._reset()
+
+    def _reset(self):
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._head = []
+        self._head_size = 0
+
+    def update(self, data):
+        if not isinstance(data, bytes):
+            # e.g. the buffer of a BytesIO, which is not copied as a whole
+            data = memoryview(data)
+        self.size += len(data)
+        self._hash.update(data)
+        if self._head_size < HEAD_BYTES:
+            data = data[:HEAD_BYTES - self._head_size]
+            if not isinstance(data, bytes):
+                data = data.tobytes()
+            self._head.append(data)
+            self._head_size += len(data)
+
+    @property
+    def head(self):
+        """The first `HEAD_BYTES` bytes of the data.
+        """
+        return b''.join(self._head)
+
+    def hexdigest(self):
+        """The SHA-256 digest of the data.
+        """
+        return self._hash.hexdigest()
+
+    def open(self, mode='r'):
+        fp = self.blob.open(mode)
+        if mode == 'r':
+            return fp
+        if mode != 'w':
+            # appending to or changing existing data
+            self.complete = False
+            return fp
+        self._reset()
+        self.complete = True
+        return IngestingWriter(fp, self)
+
+    def consumeFile(self, filename):
+        # The file is handed over without reading it, so the properties of
+        # the data are found from the blob, the digest only when needed.
+        self._reset()
+        self.blob.consumeFile(filename)
+        self.complete = False
+
+    def __getattr__(self, name):
+        return getattr(self.blob, name)
+
+
+class IngestingWriter(object):
+    """Stand-in for a file opened for writing, passing the data written to
+    an `IngestingBlob`.
+    """
+
+    def __init__(self, fp, ingest):
+        self.fp = fp
+        self.ingest = ingest
+
+    def write(self, data):
+        self.fp.write(data)
+        self.ingest.update(data)
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def seek(self, offset, whence=0):
+        # the data is no longer written in order
+        self.ingest.complete = False
+        return self.fp.seek(offset, whence)
+
+    def truncate(self, size=None):
+        self.ingest.complete = False
+        if size is None:
+            return self.fp.truncate()
+        return self.fp.truncate(size)
+
+    def fileno(self):
+        # the data may be written without passing through here
+        self.ingest.complete = False
+        return self.fp.fileno()
+
+    def close(self):
+        if self.fp.closed:
+            return
+        self.fp.close()
+        if self.ingest.callback is not None:
+            self.ingest.callback(self.ingest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
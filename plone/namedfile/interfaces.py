@@ -9,12 +9,12 @@ HAVE_BLOBS = True
 
 class IFile(Interface):
 
-    contentType = schema.BytesLine(
+    contentType = schema.NativeStringLine(
         title=u'Content Type',
         description=u'The content type identifies the type of data.',
-        default=b'',
+        default='',
         required=False,
-        missing_value=b''
+        missing_value=''
     )
 
     data = schema.Bytes(
@@ -50,6 +50,101 @@ class IAvailableSizes(Interface):
     """
 
 
+class IImageScalingExecutor(Interface):
+    """Runs the scaling of images, e.g. in other processes.
+
+    The default image scaling factory looks up a utility providing this
+    interface. If there is none, images are scaled in the calling thread.
+    """
+
+    def __call__(image, scales, quality):
+        """Return the result of `plone.namedfile.scaling.scale_image` for the
+        image, an open file or its data, and the scales.
+        """
+
+
+class IBlobOffload(Interface):
+    """Settings to hand the delivery of committed blob files over to the
+    front-end web server, instead of streaming them from a Zope thread.
+
+    The download views look up a utility providing this interface. If there
+    is none, files are streamed as usual.
+    """
+
+    header = schema.ASCIILine(
+        title=u'Header',
+        description=u'The response header telling the front-end web server '
+                    u'which file to send, i.e. X-Accel-Redirect for nginx '
+                    u'or X-Sendfile for Apache and lighttpd.',
+        default='X-Accel-Redirect',
+    )
+
+    blob_directory = schema.TextLine(
+        title=u'Blob directory',
+        description=u'The path of the blob directory as seen by Zope. It is '
+                    u'stripped from the path of the blob file. If not set, '
+                    u'the full path is used.',
+        required=False,
+    )
+
+    prefix = schema.ASCIILine(
+        title=u'Prefix',
+        description=u'Prepended to the path of the blob file, i.e. the '
+                    u'internal location of nginx or the blob directory as '
+                    u'seen by the front-end web server.',
+        default='',
+        required=False,
+    )
+
+
+class IDigestIndex(Interface):
+    """Index of file and image values by the digest of their data.
+
+    If a utility providing this interface is registered, for instance as a
+    persistent local utility of a site, values add themselves when their
+    data is stored.
+
+    If `deduplicate` is set, blob based values use the committed blob of
+    another value with the same data, instead of keeping a copy of their
+    own. The index keeps track of the values sharing a blob.
+    """
+
+    deduplicate = schema.Bool(
+        title=u'Deduplicate blobs',
+        description=u'Share the blob of values with the same data.',
+        default=False,
+    )
+
+    def add(digest, value):
+        """Add the value with the given digest.
+        """
+
+    def remove(digest, value):
+        """Remove the value with the given digest.
+        """
+
+    def values(digest):
+        """Return a list of the values with the given digest.
+        """
+
+    def __contains__(digest):
+        """Check whether there are values with the given digest.
+        """
+
+    def shareBlob(blob, value):
+        """Record that the value uses the committed blob, which is shared.
+        """
+
+    def releaseBlob(blob, value):
+        """Record that the value no longer uses the committed blob.
+        """
+
+    def blobReferences(blob, limit=None):
+        """Return the number of values using the committed blob, counting
+        up to `limit` of them if it is given.
+        """
+
+
 try:
     from plone.app.imaging.interfaces import IStableImageScale
 except ImportError:
@@ -72,11 +167,51 @@ class INamedFile(INamed, IFile):
     """A non-BLOB file with a filename
     """
 
+    def getDigest():
+        """Return the SHA-256 digest of the data, as a hexadecimal string.
+        """
+
+    def buffer():
+        """Return a context manager giving a read-only memoryview of the
+        data. The data of blobs is mapped into memory instead of being read.
+        """
+
+    def readRange(start, length=None):
+        """Return `length` bytes of the data from the byte at `start` on,
+        or all bytes from there if `length` is None.
+        """
+
+    def iterChunks(start=0, end=None):
+        """Iterate over the data in pieces, restricted to the bytes from
+        `start` up to (but excluding) `end`. Only the pieces holding these
+        bytes are loaded.
+        """
+
 
 class INamedImage(INamed, IImage):
     """A non-BLOB image with a filename
     """
 
+    def getDigest():
+        """Return the SHA-256 digest of the data, as a hexadecimal string.
+        """
+
+    def buffer():
+        """Return a context manager giving a read-only memoryview of the
+        data. The data of blobs is mapped into memory instead of being read.
+        """
+
+    def readRange(start, length=None):
+        """Return `length` bytes of the data from the byte at `start` on,
+        or all bytes from there if `length` is None.
+        """
+
+    def iterChunks(start=0, end=None):
+        """Iterate over the data in pieces, restricted to the bytes from
+        `start` up to (but excluding) `end`. Only the pieces holding these
+        bytes are loaded.
+        """
+
 
 # Fields
 
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Migrate NamedFile and NamedImage values to blobs.
+
+Values of the non-blob types keep their data in ``FileChunk`` objects inside
+the database. This module converts them to `NamedBlobFile` and
+`NamedBlobImage` values, streaming the data chunk by chunk into the blob.
+Filename, content type and image dimensions are kept, as are the image
+scales stored for the object.
+
+Use `migrate_objects` for a given set of objects or `migrate_site` to walk
+a whole site. Both commit in batches. Objects which were migrated already
+have nothing left to convert, so an interrupted migration can simply be
+started again; `migrate_site` can additionally skip the part of the site
+which was done, given the path of the last committed object.
+
+From the command line, run it as a script of a Zope instance::
+
+    bin/instance run path/to/plone/namedfile/migrate.py [--batch-size=100]
+        [--checkpoint=/tmp/migration.txt] [--field=image ...] /Plone
+"""
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.file import NamedBlobImage
+from plone.namedfile.interfaces import IBlobby
+from plone.namedfile.interfaces import INamedFile
+from plone.namedfile.interfaces import INamedImage
+from plone.namedfile.utils import iter_file_data
+from plone.namedfile.utils import iter_named_fields
+from zope.annotation.interfaces import IAnnotations
+
+import argparse
+import logging
+import os
+import sys
+import time
+import transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+def needs_migration(value):
+    """Check whether the value is a file or image not stored in a blob.
+    """
+    return INamedFile.providedBy(value) and not IBlobby.providedBy(value)
+
+
+def migrate_value(value):
+    """Return a blob based copy of the NamedFile or NamedImage `value`.
+
+    The data is copied chunk by chunk, without ever joining the chunks.
+    """
+    if INamedImage.providedBy(value):
+        blob_value = NamedBlobImage()
+        blob_value._width = value._width
+        blob_value._height = value._height
+    else:
+        blob_value = NamedBlobFile()
+    with blob_value.open('w') as fp:
+        for data in iter_file_data(value):
+            fp.write(data)
+    blob_value.contentType = value.contentType
+    blob_value.filename = value.filename
+    fieldname = getattr(value, 'fieldname', None)
+    if fieldname is not None:
+        # set on image scales
+        blob_value.fieldname = fieldname
+    return blob_value
+
+
+class MigrationReport(object):
+    """Progress of a migration.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.objects = 0
+        self.migrated_objects = 0
+        self.values = 0
+        self.bytes = 0
+        self.last_path = None
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def __str__(self):
+        elapsed = self.elapsed
+        throughput = self.bytes / elapsed / (1 << 20) if elapsed else 0.0
+        return (
+            '{0} objects visited, {1} objects with {2} values migrated, '
+            '{3:.1f} MB in {4:.0f}s ({5:.2f} MB/s)'.format(
+                self.objects,
+                self.migrated_objects,
+                self.values,
+                self.bytes / float(1 << 20),
+                elapsed,
+                throughput,
+            )
+        )
+
+
+def _migrate_scales(obj, report):
+    annotations = IAnnotations(obj, None)
+    if annotations is None:
+        return 0
+    scales = annotations.get('plone.scale')
+    if not scales:
+        return 0
+    count = 0
+    for uid, info in list(scales.items()):
+        value = info.get('data') if isinstance(info, dict) else None
+        if not needs_migration(value):
+            continue
+        blob_value = migrate_value(value)
+        report.bytes += blob_value.getSize()
+        scales[uid] = dict(info, data=blob_value)
+        count += 1
+    return count
+
+
+def migrate_object(obj, fieldnames=None, report=None):
+    """Migrate the file and image values of `obj`, or only those in
+    `fieldnames`, as well as its image scales.
+
+    The values of the file and image fields of the schemas of the object
+    and its behaviors are migrated, wherever they are stored, as are other
+    values stored as attributes of the object.
+
+    Returns the number of migrated values.
+    """
+    if report is None:
+        report = MigrationReport()
+    base = getattr(obj, 'aq_base', obj)
+    attributes = getattr(base, '__dict__', {})
+    candidates = list(iter_named_fields(obj))
+    candidates.extend((name, base) for name in list(attributes))
+    count = 0
+    for name, storage in candidates:
+        if fieldnames is not None and name not in fieldnames:
+            continue
+        value = getattr(storage, name, None)
+        if not needs_migration(value):
+            continue
+        blob_value = migrate_value(value)
+        setattr(storage, name, blob_value)
+        report.bytes += blob_value.getSize()
+        count += 1
+    count += _migrate_scales(base, report)
+    report.values += count
+    return count
+
+
+def _commit(report, checkpoint):
+    transaction.commit()
+    if checkpoint and report.last_path is not None:
+        with open(checkpoint, 'w') as fp:
+            fp.write('/'.join(report.last_path))
+    logger.info(str(report))
+
+
+def migrate_objects(objects, fieldnames=None, batch_size=100,
+                    checkpoint=None, report=None):
+    """Migrate the given objects, committing every `batch_size` objects.
+
+    `objects` may be an iterable of objects or of ``(path, object)`` tuples;
+    the path of the last object of a committed batch is written to the
+    `checkpoint` file. Returns a `MigrationReport`.
+    """
+    if report is None:
+        report = MigrationReport()
+    pending = 0
+    for item in objects:
+        if isinstance(item, tuple):
+            path, obj = item
+        else:
+            path, obj = None, item
+        report.objects += 1
+        if migrate_object(obj, fieldnames, report):
+            report.migrated_objects += 1
+        report.last_path = path
+        pending += 1
+        if pending >= batch_size:
+            # also after batches without changes, to keep the cache small
+            # and the checkpoint close while walking migrated parts
+            _commit(report, checkpoint)
+            pending = 0
+            jar = getattr(obj, '_p_jar', None)
+            if jar is not None:
+                jar.cacheGC()
+    _commit(report, checkpoint)
+    return report
+
+
+def walk(obj, path=(), resume_after=None):
+    """Walk the objects contained in `obj` depth first, yielding
+    ``(path, object)`` tuples.
+
+    Children are visited in the order of their ids, so the paths are
+    yielded in ascending order. With `resume_after`, a path tuple, all
+    objects up to and including that path are skipped without being loaded.
+    """
+    if resume_after is None or path > resume_after:
+        yield path, obj
+    objectIds = getattr(obj, 'objectIds', None)
+    if objectIds is None:
+        return
+    for id in sorted(objectIds()):
+        child_path = path + (id,)
+        if (
+            resume_after is not None and
+            child_path < resume_after and
+            resume_after[:len(child_path)] != child_path
+        ):
+            # the whole subtree was done before
+            continue
+        child = obj._getOb(id, None)
+        if child is None:
+            continue
+        for item in walk(child, child_path, resume_after):
+            yield item
+
+
+def migrate_site(site, fieldnames=None, batch_size=100, checkpoint=None):
+    """Migrate all objects in `site`, committing in batches.
+
+    If the `checkpoint` file exists, the migration resumes after the path
+    recorded in it.
+    """
+    resume_after = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as fp:
+            recorded = fp.read().strip()
+        resume_after = tuple(recorded.split('/')) if recorded else ()
+        logger.info('Resuming after {0}'.format(recorded or '/'))
+    report = migrate_objects(
+        walk(site, resume_after=resume_after),
+        fieldnames=fieldnames,
+        batch_size=batch_size,
+        checkpoint=checkpoint,
+    )
+    logger.info('Migration finished: {0}'.format(report))
+    return report
+
+
+def main(app, argv):
+    parser = argparse.ArgumentParser(
+        description='Migrate NamedFile and NamedImage values to blobs.')
+    parser.add_argument('path', help='path of the site or folder to migrate')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--checkpoint', default=None,
+                        help='file recording the progress, to resume')
+    parser.add_argument('--field', action='append', dest='fieldnames',
+                        help='only migrate this field or attribute '
+                             '(repeatable)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    site = app.unrestrictedTraverse(args.path.strip('/'))
+    report = migrate_site(
+        site,
+        fieldnames=args.fieldnames,
+        batch_size=args.batch_size,
+        checkpoint=args.checkpoint,
+    )
+    print(str(report))
+
+
+if __name__ == '__main__' and 'app' in globals():
+    main(globals()['app'], sys.argv[1:])
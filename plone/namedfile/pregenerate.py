@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Eager creation of image scales.
+
+With the `EAGER_SCALES` setting, the `available_sizes` scales of the images of
+content are made when it is added or modified, instead of when they are
+first viewed. The jobs are queued once the transaction storing the images is
+committed, and done by worker threads in transactions of their own. The
+workers finish their current job and stop when the process exits.
+"""
+from plone.namedfile import settings
+from plone.namedfile.interfaces import INamedImage
+from plone.namedfile.interfaces import INamedImageField
+from plone.namedfile.scaling import ImageScaling
+from ZODB.POSException import ConflictError
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+from zope.interface import providedBy
+from zope.schema import getFields
+
+import atexit
+import collections
+import logging
+import threading
+import transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+def _location(obj):
+    """Return what is needed to load the persistent object in another
+    connection: its oid and its physical path, if it has one.
+    """
+    getPhysicalPath = getattr(obj, 'getPhysicalPath', None)
+    path = tuple(getPhysicalPath()) if getPhysicalPath is not None else None
+    return obj._p_oid, path
+
+
+def _resolve(connection, location):
+    """Load the object at the `location` in the connection. Objects with a
+    path are traversed to from the Zope application, so they are wrapped in
+    their acquisition context. Returns None if the object is gone.
+    """
+    oid, path = location
+    try:
+        if path:
+            app = connection.root().get('Application')
+            if app is not None:
+                return app.unrestrictedTraverse(path)
+        return connection.get(oid)
+    except (AttributeError, KeyError):
+        return None
+
+
+class ScaleJob(object):
+    """Making the missing `available_sizes` scales of the image in the field
+    of a content object.
+    """
+
+    def __init__(self, db, context, fieldname, site=None):
+        self.db = db
+        self.context = context
+        self.fieldname = fieldname
+        self.site = site
+
+    @property
+    def key(self):
+        return (self.db.database_name, self.context[0], self.fieldname)
+
+    def __call__(self):
+        tm = transaction.TransactionManager()
+        connection = self.db.open(transaction_manager=tm)
+        try:
+            for attempt in range(settings.EAGER_SCALES_RETRIES + 1):
+                tm.begin()
+                try:
+                    self._createScales(connection)
+                    tm.commit()
+                    return
+                except ConflictError:
+                    tm.abort()
+                    if attempt == settings.EAGER_SCALES_RETRIES:
+                        raise
+        finally:
+            tm.abort()
+            connection.close()
+            setSite(None)
+
+    def _createScales(self, connection):
+        site = None
+        if self.site is not None:
+            site = _resolve(connection, self.site)
+        setSite(site)
+        context = _resolve(connection, self.context)
+        if getattr(context, self.fieldname, None) is None:
+            # removed meanwhile
+            return
+        ImageScaling(context, None).create_scales(self.fieldname)
+
+
+class ScaleQueue(object):
+    """Queue of jobs done by up to `workers` threads, which are started when
+    needed. A job is only queued once until a worker takes it on.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._jobs = collections.OrderedDict()
+        self._active = 0
+        self._threads = []
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def put(self, job):
+        """Queue the job, unless an equal one is queued already. Returns
+        whether it was queued.
+        """
+        with self._condition:
+            if job.key in self._jobs:
+                return False
+            self._jobs[job.key] = job
+            self._startWorkers()
+            self._condition.notify()
+        return True
+
+    def join(self):
+        """Wait until all jobs are done.
+        """
+        with self._condition:
+            while self._jobs or self._active:
+                self._condition.wait()
+
+    def stop(self, timeout=None):
+        """Drop the queued jobs and stop the workers, waiting up to
+        `timeout` seconds for each of them to finish its current job.
+        Workers are started again for jobs queued later.
+        """
+        with self._condition:
+            self._jobs.clear()
+            workers, self._threads = self._threads, []
+            for thread, stopped in workers:
+                stopped.set()
+            self._condition.notify_all()
+        for thread, stopped in workers:
+            thread.join(timeout)
+
+    def _startWorkers(self):
+        workers = self.workers
+        if workers is None:
+            workers = settings.EAGER_SCALES_WORKERS
+        self._threads = [w for w in self._threads if w[0].is_alive()]
+        while len(self._threads) < min(workers, len(self._jobs)):
+            stopped = threading.Event()
+            thread = threading.Thread(
+                target=self._work,
+                args=(stopped,),
+                name='plone.namedfile scales'
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append((thread, stopped))
+
+    def _work(self, stopped):
+        while True:
+            with self._condition:
+                while not self._jobs and not stopped.is_set():
+                    self._condition.wait()
+                if stopped.is_set():
+                    return
+                key, job = self._jobs.popitem(last=False)
+                self._active += 1
+            try:
+                job()
+            except Exception:
+                logger.exception('Could not create scales: {0!r}'.format(key))
+            finally:
+                with self._condition:
+                    self._active -= 1
+                    self._condition.notify_all()
+
+
+queue = ScaleQueue()
+
+# don't let the workers be killed in the middle of a transaction
+atexit.register(queue.stop)
+
+
+def image_fieldnames(context):
+    """Return the names of the image fields of the context which are set.
+    """
+    fieldnames = []
+    for iface in providedBy(context).flattened():
+        for name, field in getFields(iface).items():
+            if name in fieldnames or not INamedImageField.providedBy(field):
+                continue
+            if INamedImage.providedBy(getattr(context, name, None)):
+                fieldnames.append(name)
+    return fieldnames
+
+
+def queue_scales(context, event):
+    """Queue making the scales of the images of the added or modified
+    content, once the transaction is committed.
+    """
+    if not settings.EAGER_SCALES:
+        return
+    fieldnames = image_fieldnames(context)
+    if fieldnames:
+        transaction.get().addAfterCommitHook(
+            _queue_committed, args=(context, fieldnames, getSite()))
+
+
+def _queue_committed(status, context, fieldnames, site):
+    if not status or getattr(context, '_p_jar', None) is None:
+        return
+    db = context._p_jar.db()
+    if site is not None and getattr(site, '_p_oid', None) is not None:
+        site = _location(site)
+    else:
+        site = None
+    for fieldname in fieldnames:
+        queue.put(ScaleJob(db, _location(context), fieldname, site))
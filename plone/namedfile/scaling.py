@@ -1,28 +1,369 @@
 # -*- coding: utf-8 -*-
+from contextlib import contextmanager
 from datetime import datetime
 from dateutil.tz import tzlocal
+from io import BytesIO
+from persistent import Persistent
+from plone.namedfile import settings
 from plone.namedfile.file import FILECHUNK_CLASSES
 from plone.namedfile.interfaces import IAvailableSizes
+from plone.namedfile.interfaces import IImageScalingExecutor
 from plone.namedfile.interfaces import IStableImageScale
 from plone.rfc822.interfaces import IPrimaryFieldInfo
 from plone.scale.interfaces import IImageScaleFactory
 from plone.scale.interfaces import IScaledImageQuality
-from plone.scale.scale import scaleImage
+from plone.scale.scale import scalePILImage
 from plone.scale.storage import AnnotationStorage
+from uuid import uuid4
 from xml.sax.saxutils import quoteattr
 from ZODB.POSException import ConflictError
+from zope.component import queryAdapter
 from zope.component import queryUtility
 from zope.interface import alsoProvides
 from zope.interface import implementer
 from zope.publisher.interfaces import NotFound
 
 import logging
+import math
+import numbers
+import PIL.Image
+import threading
+import time
 
 
 logger = logging.getLogger(__name__)
 _marker = object()
 _zone = tzlocal()
 
+# quality of JPEG scales, as used by plone.scale
+DEFAULT_QUALITY = 88
+
+# Images are first reduced by an integer factor with the cheap `reduce` of
+# Pillow, as long as they stay this many times larger than the largest scale,
+# and then resampled from there.
+REDUCING_GAP = 2.0
+
+
+def _resize_factor(size, width, height, direction):
+    """Return the factor `scalePILImage` resizes an image of `size` by for
+    a scale, before cropping it.
+    """
+    factors = []
+    if width:
+        factors.append(float(width) / size[0])
+    if height:
+        factors.append(float(height) / size[1])
+    if direction == 'down':
+        return max(factors)
+    return min(factors)
+
+
+def _resize_factors(size, scales):
+    factors = []
+    for scale in scales:
+        try:
+            factors.append(_resize_factor(
+                size, scale.get('width'), scale.get('height'),
+                scale.get('direction', 'thumbnail')))
+        except (TypeError, ValueError):
+            factors.append(None)
+    return factors
+
+
+def open_image(data, scales):
+    """Open and decode the image `data`, bytes or a file, for making the
+    `scales` of it, dicts as for `scale_pil_image`.
+
+    Decoders which can decode at a reduced resolution, like the one for
+    JPEG, are asked for the smallest power of two reduction which is still
+    larger than the largest of the scales.
+    """
+    if isinstance(data, bytes):
+        data = BytesIO(data)
+    image = PIL.Image.open(data)
+    factors = [f for f in _resize_factors(image.size, scales) if f]
+    if factors and max(factors) < 1:
+        factor = max(factors)
+        image.draft(image.mode, (
+            int(math.ceil(image.size[0] * factor)),
+            int(math.ceil(image.size[1] * factor))))
+    image.load()
+    return image
+
+
+def save_image(image, format_, quality=DEFAULT_QUALITY):
+    """Return the data of the scaled PIL image saved in `format_`, as done
+    by plone.scale.
+    """
+    if format_ == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        # JPEG has no alpha channel, which newer Pillow versions refuse to
+        # drop silently
+        image = image.convert('RGB')
+    result = BytesIO()
+    image.save(
+        result,
+        format_,
+        quality=quality,
+        optimize=True,
+        progressive=True
+    )
+    return result.getvalue()
+
+
+def scale_pil_image(image, scales):
+    """Scale the decoded PIL image to each of the `scales`, dicts with
+    `width`, `height` and `direction` like the arguments of
+    `plone.scale.scale.scalePILImage`. Returns the scaled images in the same
+    order, or an exception for those that failed.
+
+    The scales are made from large to small, and each is derived from the
+    smallest image made so far which is still larger than needed, rather
+    than from the original. Large images are first reduced by an integer
+    factor, down to `REDUCING_GAP` times the largest scale. The image is not
+    changed.
+    """
+    # convert the mode once, as scalePILImage would for every scale
+    if image.mode == '1':
+        image = image.convert('L')
+    elif image.mode == 'P':
+        image = image.convert('RGBA')
+    elif image.mode == 'CMYK':
+        image = image.convert('RGB')
+    factors = _resize_factors(image.size, scales)
+    largest = max([f for f in factors if f] or [1.0])
+    reduction = int(1.0 / (largest * REDUCING_GAP))
+    if reduction > 1 and hasattr(image, 'reduce'):
+        # Image.reduce is available from Pillow 7
+        try:
+            image = image.reduce(reduction)
+        except ValueError:
+            # not supported for the mode of the image
+            pass
+        else:
+            factors = _resize_factors(image.size, scales)
+    size = image.size
+    # images which are the original resized without cropping, by factor
+    sources = [(1.0, image)]
+    results = [None] * len(scales)
+    order = sorted(
+        range(len(scales)), key=lambda i: -(factors[i] or 0))
+    for i in order:
+        scale = scales[i]
+        source = image
+        if factors[i] is not None:
+            for factor, candidate in sources:
+                if factor >= factors[i]:
+                    source = candidate
+        direction = scale.get('direction', 'thumbnail')
+        try:
+            # scalePILImage may change the image it is given
+            scaled = scalePILImage(
+                source.copy(), scale.get('width'), scale.get('height'),
+                direction)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            results[i] = e
+            continue
+        results[i] = scaled
+        if direction in ('thumbnail', 'keep'):
+            factor = float(scaled.size[0]) / size[0]
+            if factor < sources[-1][0]:
+                sources.append((factor, scaled))
+    return results
+
+
+def scale_image(image, scales, quality=DEFAULT_QUALITY):
+    """Make the `scales` of the image, bytes or a file, which are dicts as
+    for `scale_pil_image` and may have a `quality` too.
+
+    Returns a list with the data, format and size of each scale, like
+    `plone.scale.scale.scaleImage` does, or an exception for those that
+    failed.
+    """
+    image = open_image(image, scales)
+    # as done by plone.scale: keep PNG images, make JPEG of others
+    format_ = 'PNG' if image.format == 'PNG' else 'JPEG'
+    results = []
+    for scale, scaled in zip(scales, scale_pil_image(image, scales)):
+        if not isinstance(scaled, Exception):
+            data = save_image(scaled, format_, scale.get('quality', quality))
+            scaled = (data, format_, scaled.size)
+        results.append(scaled)
+    return results
+
+
+def _get_scale(storage, parameters):
+    """Return the info of the scale stored in the `AnnotationStorage` for
+    the `parameters`, or None. A scale stored before the image was modified
+    is removed, as `AnnotationStorage.scale` does.
+    """
+    info = storage.get_info_by_hash(storage.hash(**parameters))
+    if info is None:
+        return None
+    modified = storage.modified_time
+    since = info.get('modified')
+    if (isinstance(modified, numbers.Real) and
+            isinstance(since, numbers.Real) and modified > since):
+        del storage[info['uid']]
+        return None
+    return info
+
+
+def _store_scale(storage, parameters, result):
+    """Store the `result` of the image scale factory for the `parameters` in
+    the `AnnotationStorage` like `AnnotationStorage.scale` does, and return
+    its info.
+    """
+    data, format_, dimensions = result
+    width, height = dimensions
+    info = dict(
+        uid=str(uuid4()),
+        data=data,
+        width=width,
+        height=height,
+        mimetype='image/{0}'.format(format_.lower()),
+        key=storage.hash(**parameters),
+        modified=storage.modified_time,
+    )
+    storage.storage[info['uid']] = info
+    return info
+
+
+class _ComputedScale(object):
+    """The result of the image scale factory for the `context`, handed to
+    the threads waiting for the same scale of the same object in their own
+    connections to the database.
+
+    Persistent values can only be stored in one connection, so their data
+    is read here and a copy of them is made for each of the other threads.
+    """
+
+    def __init__(self, context, result):
+        self.context = context
+        self.result = result
+        self._copy = None
+        if result is not None and isinstance(result[0], Persistent):
+            value = result[0]
+            self._copy = (
+                value.__class__,
+                value.data,
+                value.contentType,
+                value.filename,
+                getattr(value, 'fieldname', None),
+            )
+
+    def resultFor(self, context):
+        """Return the result to store for the `context`.
+        """
+        if context is self.context or self._copy is None:
+            return self.result
+        class_, data, contentType, filename, fieldname = self._copy
+        value = class_(data, contentType=contentType, filename=filename)
+        if fieldname is not None:
+            value.fieldname = fieldname
+        return (value,) + tuple(self.result[1:])
+
+
+class Overloaded(Exception):
+    """Too many scales are computed at the same time.
+    """
+
+
+class _Flight(object):
+    """A call of the `ScalingLimiter` other threads wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = False
+        self.result = None
+
+
+class ScalingLimiter(object):
+    """Limits the computation of scales in this process.
+
+    A scale requested by several threads at the same time is computed by the
+    first one. The others wait for it to finish and get its result, instead
+    of computing the scale again. At most `settings.MAX_CONCURRENT_SCALES`
+    scales are computed at the same time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._slots = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+
+    def run(self, key, function):
+        """Return the result of calling `function`. If it is being called
+        for the same `key` in another thread, the result of that call is
+        returned instead, so it must not belong to the connection to the
+        database of the thread calling it.
+
+        Raises `Overloaded` if there is no room for calling it within
+        `settings.SCALING_WAIT` seconds, or if the call waited for failed.
+        """
+        if key is None:
+            with self._slot():
+                return function()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                leading = True
+                flight = self._flights[key] = _Flight()
+            else:
+                leading = False
+        if not leading:
+            if not flight.done.wait(settings.SCALING_WAIT):
+                raise Overloaded(key)
+            if not flight.finished:
+                raise Overloaded(key)
+            return flight.result
+        try:
+            with self._slot():
+                flight.result = function()
+            flight.finished = True
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @contextmanager
+    def _slot(self):
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self):
+        with self._slots:
+            limit = settings.MAX_CONCURRENT_SCALES
+            if limit is not None and self._running >= limit:
+                if self._waiting >= settings.MAX_WAITING_SCALES:
+                    raise Overloaded()
+                deadline = time.time() + settings.SCALING_WAIT
+                self._waiting += 1
+                try:
+                    while self._running >= limit:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Overloaded()
+                        self._slots.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._running += 1
+
+    def _release(self):
+        with self._slots:
+            self._running -= 1
+            self._slots.notify()
+
+
+limiter = ScalingLimiter()
+
 
 class ImageScale(object):
     def __init__(self, context, request, **info):
@@ -49,9 +390,13 @@ class ImageScale(object):
         """Create a tag including scale
         """
         if height is _marker:
-            height = getattr(self, 'height', self.data._height)
+            height = getattr(self, 'height', None)
+            if height is None:
+                height = self.data.getImageSize()[1]
         if width is _marker:
-            width = getattr(self, 'width', self.data._width)
+            width = getattr(self, 'width', None)
+            if width is None:
+                width = self.data.getImageSize()[0]
 
         if alt is _marker:
             alt = self.context.Title()
@@ -96,13 +441,12 @@ class DefaultImageScalingFactory(object):
         return getScaledImageQuality()
 
     def create_scale(self, data, direction, height, width, **parameters):
-        return scaleImage(
-            data,
-            direction=direction,
-            height=height,
-            width=width,
-            **parameters
-        )
+        scale = dict(direction=direction, height=height, width=width)
+        result = self._scaleImage(
+            data, [scale], parameters.get('quality', DEFAULT_QUALITY))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
 
     def __call__(  # noqa
         self,
@@ -123,20 +467,10 @@ class DefaultImageScalingFactory(object):
         if height is None and width is None:
             dummy, format_ = orig_value.contentType.split('/', 1)
             return None, format_, (orig_value._width, orig_value._height)
-        try:
-            orig_data = orig_value.open()
-        except AttributeError:
-            orig_data = getattr(orig_value, 'data', orig_value)
+        orig_data = self._getOriginalData(orig_value)
         if not orig_data:
             return
 
-        # Handle cases where large image data is stored in FileChunks instead
-        # of plain string
-        if isinstance(orig_data, tuple(FILECHUNK_CLASSES)):
-            # Convert data to 8-bit string
-            # (FileChunk does not provide read() access)
-            orig_data = str(orig_data)
-
         # If quality wasn't in the parameters, try the site's default scaling
         # quality if it exists.
         if 'quality' not in parameters:
@@ -162,7 +496,80 @@ class DefaultImageScalingFactory(object):
         if result is None:
             return
 
-        data, format_, dimensions = result
+        return self._makeValue(orig_value, fieldname, *result)
+
+    def create_scales(self, fieldname, scales):
+        """Create several scales of the image in the field at once.
+
+        `scales` is a list of dicts with the arguments for calling the
+        factory for each scale, except for the `fieldname`. Returns a list
+        of the results of such calls. The image is only decoded once, and
+        smaller scales are made from larger ones.
+        """
+        create_scale = DefaultImageScalingFactory.__dict__['create_scale']
+        if self.create_scale.__func__ is not create_scale:
+            # scales are made in a custom way
+            return [self(fieldname=fieldname, **scale) for scale in scales]
+        orig_value = getattr(self.context, fieldname)
+        if orig_value is None:
+            return [None] * len(scales)
+        results = [None] * len(scales)
+        sized = []
+        for i, scale in enumerate(scales):
+            if scale.get('height') is None and scale.get('width') is None:
+                results[i] = self(fieldname=fieldname, **scale)
+            else:
+                sized.append(i)
+        orig_data = self._getOriginalData(orig_value)
+        if not sized or not orig_data:
+            return results
+        try:
+            scaled = self._scaleImage(
+                orig_data,
+                [scales[i] for i in sized],
+                self.get_quality() or DEFAULT_QUALITY
+            )
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except Exception:
+            logger.exception(
+                'Could not scale "{0!r:s}" of {1!r:s}'.format(
+                    orig_value, self.context.absolute_url()))
+            return results
+        finally:
+            if hasattr(orig_data, 'close'):
+                orig_data.close()
+        for i, result in zip(sized, scaled):
+            if isinstance(result, Exception):
+                logger.error(
+                    'Could not scale "{0!r:s}" of {1!r:s}: {2!r:s}'.format(
+                        orig_value, self.context.absolute_url(), result))
+                continue
+            results[i] = self._makeValue(orig_value, fieldname, *result)
+        return results
+
+    def _scaleImage(self, data, scales, quality):
+        # scale in this thread, unless an executor is registered
+        executor = queryUtility(IImageScalingExecutor)
+        if executor is None:
+            return scale_image(data, scales, quality)
+        return executor(data, scales, quality)
+
+    def _getOriginalData(self, orig_value):
+        try:
+            orig_data = orig_value.open()
+        except AttributeError:
+            orig_data = getattr(orig_value, 'data', orig_value)
+
+        # Handle cases where large image data is stored in FileChunks instead
+        # of plain string
+        if isinstance(orig_data, tuple(FILECHUNK_CLASSES)):
+            # Convert data to 8-bit string
+            # (FileChunk does not provide read() access)
+            orig_data = str(orig_data)
+        return orig_data
+
+    def _makeValue(self, orig_value, fieldname, data, format_, dimensions):
         mimetype = u'image/{0}'.format(format_.lower())
         value = orig_value.__class__(
             data,
@@ -266,20 +673,126 @@ class ImageScaling(object):
                 return None  # 404
             width, height = available[scale]
         storage = AnnotationStorage(self.context, self.modified)
-        info = storage.scale(
+        parameters.update(
             fieldname=fieldname,
             height=height,
             width=width,
             direction=direction,
             scale=scale,
-            **parameters
         )
+        info = _get_scale(storage, parameters)
+        if info is None:
+            factory = queryAdapter(self.context, IImageScaleFactory)
+            if factory is None:
+                return  # 404
+            try:
+                computed = limiter.run(
+                    self._scaleKey(storage.hash(**parameters)),
+                    lambda: _ComputedScale(
+                        self.context, factory(**parameters)))
+            except Overloaded:
+                return self._originalScale(fieldname, width, height)
+            result = computed.resultFor(self.context)
+            if result is not None:
+                info = _store_scale(storage, parameters, result)
         if info is None:
             return  # 404
-        info['fieldname'] = fieldname
+        info = dict(info, fieldname=fieldname)
         scale_view = ImageScale(self.context, self.request, **info)
         return scale_view
 
+    def _scaleKey(self, key):
+        # the same for the context in all connections to the database
+        jar = getattr(self.context, '_p_jar', None)
+        if jar is None or self.context._p_oid is None:
+            return None
+        return (jar.db().database_name, self.context._p_oid, key)
+
+    def _originalScale(self, fieldname, width, height):
+        # shown instead of a scale which can't be computed now, at the size
+        # of a thumbnail
+        value = getattr(self.context, fieldname, None)
+        if value is None:
+            return
+        info = dict(data=value, fieldname=fieldname)
+        size = value.getImageSize()
+        if size[0] > 0 and size[1] > 0 and (width or height):
+            factor = min(
+                1.0, _resize_factor(size, width, height, 'thumbnail'))
+            info['width'] = int(round(size[0] * factor))
+            info['height'] = int(round(size[1] * factor))
+        return ImageScale(self.context, self.request, **info)
+
+    def create_scales(
+        self,
+        fieldname=None,
+        scales=None,
+        direction='thumbnail',
+        **parameters
+    ):
+        """Create the named scales of the image in the field, or all
+        `available_sizes`, and return them by name.
+
+        Scales which are stored already are kept. The missing ones are made
+        together, decoding the image only once, and stored at once.
+        """
+        if fieldname is None:
+            primary_field = IPrimaryFieldInfo(self.context, None)
+            if primary_field is None:
+                return {}
+            fieldname = primary_field.fieldname
+        available = self.available_sizes
+        if scales is None:
+            scales = sorted(available)
+        storage = AnnotationStorage(self.context, self.modified)
+        requested = []
+        for name in scales:
+            if name not in available:
+                continue
+            width, height = available[name]
+            requested.append((name, dict(
+                fieldname=fieldname,
+                height=height,
+                width=width,
+                direction=direction,
+                scale=name,
+                **parameters
+            )))
+        infos = {}
+        missing = []
+        for name, scale_parameters in requested:
+            infos[name] = _get_scale(storage, scale_parameters)
+            if infos[name] is None:
+                missing.append((name, scale_parameters))
+        factory = queryAdapter(self.context, IImageScaleFactory)
+        if missing and factory is not None:
+            create_scales = getattr(factory, 'create_scales', None)
+            if create_scales is None:
+                results = [
+                    factory(**scale_parameters)
+                    for name, scale_parameters in missing
+                ]
+            else:
+                results = create_scales(fieldname, [
+                    dict(
+                        (key, value)
+                        for key, value in scale_parameters.items()
+                        if key != 'fieldname'
+                    )
+                    for name, scale_parameters in missing
+                ])
+            for (name, scale_parameters), result in zip(missing, results):
+                if result is not None:
+                    infos[name] = _store_scale(
+                        storage, scale_parameters, result)
+        scale_views = {}
+        for name, info in infos.items():
+            if info is None:
+                continue
+            info = dict(info, fieldname=fieldname)
+            scale_views[name] = ImageScale(self.context, self.request, **info)
+        return scale_views
+
     def tag(
         self,
         fieldname=None,
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Settings of plone.namedfile.
+
+Each setting is read from the environment variable of the same name with
+the prefix ``PLONE_NAMEDFILE_`` when this module is imported, e.g. from the
+``<environment>`` section of ``zope.conf``. Numbers of bytes and seconds are
+given as numbers, switches as ``on`` or ``off``. Settings which may be None
+are unset by an empty value.
+"""
+import os
+
+
+PREFIX = 'PLONE_NAMEDFILE_'
+
+_TRUE = ('1', 'on', 'true', 'yes')
+_FALSE = ('', '0', 'false', 'no', 'off')
+
+
+def _bool(value):
+    if value.lower() in _TRUE:
+        return True
+    if value.lower() in _FALSE:
+        return False
+    raise ValueError(value)
+
+
+def _optional(parse):
+    def parse_optional(value):
+        if not value:
+            return None
+        return parse(value)
+    return parse_optional
+
+
+def get_setting(name, default, parse=str, environ=None):
+    """Return the value of the environment variable for the setting `name`
+    converted by `parse`, or `default` if it is not set.
+
+    Raises ValueError for values which can't be converted.
+    """
+    if environ is None:
+        environ = os.environ
+    value = environ.get(PREFIX + name)
+    if value is None:
+        return default
+    try:
+        return parse(value.strip())
+    except ValueError:
+        raise ValueError('Invalid value of {0}{1}: {2!r}'.format(
+            PREFIX, name, value))
+
+
+# Data of NamedFile and NamedImage values larger than this number of bytes
+# is stored in a ZODB blob instead of a chain of FileChunk objects. This
+# requires a storage supporting blobs, so it is off (None) by default.
+BLOB_THRESHOLD = get_setting('BLOB_THRESHOLD', None, _optional(int))
+
+# Copies of NamedBlobFile and NamedBlobImage values share the committed blob
+# of the original, until either of them is written to, if this is set and an
+# `IDigestIndex` utility keeps track of the values sharing a blob. Code
+# writing to the blob of a value directly, instead of using its `open`
+# method or `data` property, would change both.
+LAZY_BLOB_COPIES = get_setting('LAZY_BLOB_COPIES', False, _bool)
+
+# Directory the uploads are staged in. If None, a directory in the temporary
+# directory is used. Staged files are linked into blobs, which is cheapest if
+# the directory is on the file system of the blob directory, and it has to be
+# shared by all clients of the database serving uploads.
+UPLOAD_DIRECTORY = get_setting('UPLOAD_DIRECTORY', None, _optional(str))
+
+# Number of seconds after which unfinished uploads are removed
+UPLOAD_EXPIRES = get_setting('UPLOAD_EXPIRES', 24 * 60 * 60, int)
+
+# Largest number of bytes accepted for an upload, or None
+MAX_UPLOAD_SIZE = get_setting('MAX_UPLOAD_SIZE', None, _optional(int))
+
+# Make the scales of images when they are stored, if set
+EAGER_SCALES = get_setting('EAGER_SCALES', False, _bool)
+
+# Number of threads making scales
+EAGER_SCALES_WORKERS = get_setting('EAGER_SCALES_WORKERS', 1, int)
+
+# Number of times storing the scales of an image is retried after conflicts
+EAGER_SCALES_RETRIES = get_setting('EAGER_SCALES_RETRIES', 3, int)
+
+# Largest number of scales computed at the same time in this process, or
+# None. Further requests for scales wait for one of them to finish, up to
+# MAX_WAITING_SCALES of them for up to SCALING_WAIT seconds. Requests beyond
+# that get the original image instead.
+MAX_CONCURRENT_SCALES = get_setting(
+    'MAX_CONCURRENT_SCALES', None, _optional(int))
+MAX_WAITING_SCALES = get_setting('MAX_WAITING_SCALES', 16, int)
+SCALING_WAIT = get_setting('SCALING_WAIT', 30, float)
+
+# Largest number of images scaled at the same time by the
+# `ProcessScalingExecutor`
+SCALING_PROCESSES = get_setting('SCALING_PROCESSES', 2, int)
+
+# Number of seconds after which scaling an image in a child process is given
+# up, or None
+SCALING_TIMEOUT = get_setting('SCALING_TIMEOUT', 60, _optional(float))
+
+# Largest number of bytes of memory a process scaling an image may allocate
+# on top of what it uses when it starts, or None. Only enforced where the
+# resource module and /proc/self/statm are available, i.e. on Linux.
+SCALING_MEMORY_LIMIT = get_setting(
+    'SCALING_MEMORY_LIMIT', None, _optional(int))
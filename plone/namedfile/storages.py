@@ -1,23 +1,114 @@
 # -*- coding: utf-8 -*-
 # This file was borrowed from z3c.blobfile and is licensed under the terms of
 # the ZPL.
-from io import IOBase
+from plone.namedfile.copy import COPY_BUFFER_SIZE
+from plone.namedfile.copy import copyFile
 from plone.namedfile.file import FileChunk
 from plone.namedfile.interfaces import IStorage
 from plone.namedfile.interfaces import NotStorable
+from tempfile import SpooledTemporaryFile
+from uuid import uuid4
 from zope.interface import implementer
 from zope.publisher.browser import FileUpload
 
+import io
+import os
+import stat
+
 
 MAXCHUNKSIZE = 1 << 16
 
 
+def consumeSpoolFile(data, blob):
+    """Let the blob take over the file the upload `data` was spooled to,
+    without copying the data. Returns whether this was possible.
+
+    The spool file is removed when the upload is closed, so instead of
+    moving it, a hard link to it is moved into the blob directory.
+    """
+    filename = getattr(data, 'name', None)
+    if (
+        not isinstance(filename, (bytes, type(u''))) or
+        not os.path.isfile(filename)
+    ):
+        return False
+    flush = getattr(data, 'flush', None)
+    if flush is not None:
+        flush()
+    link = '{0}.{1}'.format(filename, uuid4().hex)
+    try:
+        os.link(filename, link)
+    except (AttributeError, OSError):
+        # not supported by the platform or the file system
+        return False
+    try:
+        blob.consumeFile(link)
+    finally:
+        if os.path.exists(link):
+            os.remove(link)
+    return True
+
+
+def storeFile(data, blob):
+    """Store all data of the file object `data` in the blob.
+
+    In memory files are written at once, the data of files on disk is
+    copied by the kernel if possible (see `copyFile`), and other streams
+    are copied with a large buffer. Files are stored from their start,
+    whatever their position; only streams which can't seek are read from
+    where they are. Text is stored encoded as UTF-8, like `StringStorable`
+    does.
+    """
+    if isinstance(data, SpooledTemporaryFile):
+        # the data is in memory or in an anonymous temporary file
+        data = data._file
+    getbuffer = getattr(data, 'getbuffer', getattr(data, 'getvalue', None))
+    if getbuffer is not None:
+        with blob.open('w') as fp:
+            fp.write(_encode(getbuffer()))
+        return
+    try:
+        fileno = data.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        fileno = None
+    if (
+        fileno is not None and
+        not isinstance(data, io.TextIOBase) and
+        stat.S_ISREG(os.fstat(fileno).st_mode)
+    ):
+        flush = getattr(data, 'flush', None)
+        if flush is not None:
+            flush()
+        with blob.open('w') as fp:
+            copyFile(data, fp)
+        return
+    seekable = getattr(data, 'seekable', lambda: hasattr(data, 'seek'))
+    if seekable():
+        data.seek(0)
+    with blob.open('w') as fp:
+        chunk = data.read(COPY_BUFFER_SIZE)
+        while chunk:
+            fp.write(_encode(chunk))
+            chunk = data.read(COPY_BUFFER_SIZE)
+
+
+def _encode(data):
+    if isinstance(data, type(u'')):
+        return data.encode('UTF-8')
+    return data
+
+
 @implementer(IStorage)
 class BytesStorable(object):
 
     def store(self, data, blob):
         if not isinstance(data, bytes):
-            raise NotStorable('Could not store data (not of "bytes" type).')
+            try:
+                # e.g. a bytearray or a memoryview
+                data = memoryview(data)
+            except TypeError:
+                raise NotStorable(
+                    'Could not store data (not of "bytes" type).')
 
         with blob.open('w') as fp:
             fp.write(data)
@@ -52,13 +143,10 @@ class FileChunkStorable(object):
 class FileDescriptorStorable(object):
 
     def store(self, data, blob):
-        if not isinstance(data, IOBase):
+        if not isinstance(data, io.IOBase) and not hasattr(data, 'read'):
             raise NotStorable('Could not store data (not of "file").')
 
-        filename = getattr(data, 'name', None)
-        if filename is not None:
-            blob.consumeFile(filename)
-            return
+        storeFile(data, blob)
 
 
 @implementer(IStorage)
@@ -68,10 +156,5 @@ class FileUploadStorable(object):
         if not isinstance(data, FileUpload):
             raise NotStorable('Could not store data (not of "FileUpload").')
 
-        data.seek(0)
-
-        with blob.open('w') as fp:
-            block = data.read(MAXCHUNKSIZE)
-            while block:
-                fp.write(block)
-                block = data.read(MAXCHUNKSIZE)
+        if not consumeSpoolFile(data, blob):
+            storeFile(data, blob)
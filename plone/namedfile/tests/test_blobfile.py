@@ -16,6 +16,7 @@
 #
 ##############################################################################
 
+from plone.namedfile import settings
 from plone.namedfile import storages
 from plone.namedfile.file import NamedBlobFile
 from plone.namedfile.file import NamedBlobImage
@@ -122,6 +123,216 @@ class TestImageFunctional(unittest.TestCase):
 
         file_copy = copy(file)
         self.assertEqual(file_copy.data, file.data)
+        self.assertEqual(file_copy._size, file._size)
 
         image_copy = copy(image)
         self.assertEqual(image_copy.data, image.data)
+
+
+class TestBlobThreshold(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.orig_threshold = settings.BLOB_THRESHOLD
+        settings.BLOB_THRESHOLD = 1000
+
+    def tearDown(self):
+        settings.BLOB_THRESHOLD = self.orig_threshold
+
+    def testLargeDataIsStoredInBlob(self):
+        from io import BytesIO
+        from plone.namedfile.file import NamedFile
+        from ZODB.blob import Blob
+        data = b'0123456789' * 500
+        for value in (data, BytesIO(data)):
+            file = NamedFile(value)
+            self.assertTrue(isinstance(file._data, Blob))
+            self.assertEqual(file.getSize(), 5000)
+            self.assertEqual(file.data, data)
+
+    def testSmallDataIsNotStoredInBlob(self):
+        from plone.namedfile.file import FileChunk
+        from plone.namedfile.file import NamedFile
+        file = NamedFile(b'small data')
+        self.assertTrue(isinstance(file._data, FileChunk))
+
+    def testImageInBlob(self):
+        from io import BytesIO
+        from plone.namedfile.file import NamedImage
+        from ZODB.blob import Blob
+        image = NamedImage()
+        image.data = BytesIO(zptlogo * 4)
+        self.assertTrue(isinstance(image._data, Blob))
+        self.assertEqual(image.contentType, 'image/gif')
+        self.assertEqual(image.getImageSize(), (16, 16))
+
+    def testCopyBlob(self):
+        from plone.namedfile.file import NamedFile
+        from zope.copy import copy
+        file = NamedFile(b'0123456789' * 500)
+        transaction.commit()
+        file_copy = copy(file)
+        self.assertFalse(file_copy._data is file._data)
+        self.assertEqual(file_copy.data, file.data)
+
+
+class TestImageSize(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_INTEGRATION_TESTING
+
+    def testDimensionsAreStored(self):
+        image = NamedBlobImage(zptlogo)
+        self.assertEqual((image._width, image._height), (16, 16))
+        self.assertFalse(image._dimensions_unknown)
+
+    def testUnknownDimensionsAreRemembered(self):
+        image = NamedBlobImage(b'not an image')
+        self.assertEqual(image.getImageSize(), (-1, -1))
+        self.assertTrue(image._dimensions_unknown)
+
+        def fail(mode='r'):
+            raise AssertionError('blob opened')
+        image.open = fail
+        self.assertEqual(image.getImageSize(), (-1, -1))
+
+    def testDimensionsAreLookedUpForOlderImages(self):
+        image = NamedBlobImage(zptlogo)
+        # as stored by an older version not recognizing the format
+        image._width = image._height = -1
+        del image._dimensions_unknown
+        self.assertEqual(image.getImageSize(), (16, 16))
+        self.assertEqual((image._width, image._height), (16, 16))
+
+
+class TestIngest(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_INTEGRATION_TESTING
+
+    def _makeImage(self, data):
+        opened = []
+
+        class Image(NamedBlobImage):
+
+            def open(self, mode='r'):
+                opened.append(mode)
+                return super(Image, self).open(mode)
+
+        return Image(data), opened
+
+    def testPropertiesAreFoundWhileStoring(self):
+        import hashlib
+        image, opened = self._makeImage(zptlogo)
+        self.assertEqual(opened, [])
+        self.assertEqual(image.getSize(), len(zptlogo))
+        self.assertEqual(image._digest, hashlib.sha256(zptlogo).hexdigest())
+        self.assertEqual(image.contentType, 'image/gif')
+        self.assertEqual(image.getImageSize(), (16, 16))
+        self.assertEqual(opened, [])
+
+    def testLongHeaderIsReadFromBlob(self):
+        from plone.namedfile.ingest import HEAD_BYTES
+        data = (
+            b'\xff\xd8' +
+            b'\xff\xe1\xff\xff' + b'\x00' * 0xfffd +
+            b'\xff\xe1\xff\xff' + b'\x00' * 0xfffd +
+            b'\xff\xc0\x00\x11\x08\x02\xa8\x04\x00'
+        )
+        self.assertTrue(len(data) > HEAD_BYTES)
+        image, opened = self._makeImage(data)
+        self.assertEqual(opened, ['r'])
+        self.assertEqual(image.getImageSize(), (1024, 680))
+
+    def testWritingUpdatesProperties(self):
+        import hashlib
+        file = NamedBlobFile(b'data')
+        self.assertEqual(file._size, 4)
+        with file.open('w') as fp:
+            fp.write(b'other ')
+            fp.write(b'data')
+        self.assertEqual(file._size, 10)
+        self.assertEqual(
+            file._digest, hashlib.sha256(b'other data').hexdigest())
+
+    def testAppendingResetsProperties(self):
+        file = NamedBlobFile(b'data')
+        with file.open('a') as fp:
+            fp.write(b' appended')
+        self.assertEqual(file._size, None)
+        self.assertEqual(file._digest, None)
+        self.assertEqual(file.getSize(), 13)
+        self.assertEqual(file._size, 13)
+
+    def testSizeIsBackfilled(self):
+        file = NamedBlobFile(b'data')
+        # as stored by an older version
+        del file._size
+        self.assertEqual(file._size, None)
+        self.assertEqual(file.getSize(), 4)
+        self.assertEqual(file._size, 4)
+
+    def testSizeIsNotWrittenWhenRead(self):
+        connection = self.layer['zodbDB'].open()
+        try:
+            connection.root()['file'] = file = NamedBlobFile(b'data')
+            del file._size
+            transaction.savepoint(optimistic=True)
+            self.assertEqual(file.getSize(), 4)
+            self.assertFalse(file._p_changed)
+            self.assertEqual(file._size, None)
+        finally:
+            transaction.abort()
+            connection.close()
+
+
+class TestBuffer(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.connection = self.layer['zodbDB'].open()
+        self.root = self.connection.root()
+
+    def tearDown(self):
+        transaction.abort()
+        self.connection.close()
+
+    def testUncommittedBlob(self):
+        file = NamedBlobFile(b'some data')
+        with file.buffer() as data:
+            self.assertTrue(isinstance(data, memoryview))
+            self.assertEqual(data.tobytes(), b'some data')
+            self.assertEqual(data[5:].tobytes(), b'data')
+
+    def testCommittedBlob(self):
+        self.root['file'] = file = NamedBlobFile(b'some data')
+        transaction.commit()
+        with file.buffer() as data:
+            self.assertTrue(data.readonly)
+            self.assertEqual(data.tobytes(), b'some data')
+
+    def testReadRange(self):
+        file = NamedBlobFile(b'some data')
+        self.assertEqual(file.readRange(5, 2), b'da')
+        self.assertEqual(file.readRange(5), b'data')
+        self.assertEqual(b''.join(file.iterChunks(2, 6)), b'me d')
+        self.root['file'] = file
+        transaction.commit()
+        self.assertEqual(file.readRange(0, 4), b'some')
+
+    def testEmptyBlob(self):
+        file = NamedBlobFile(b'')
+        with file.buffer() as data:
+            self.assertEqual(len(data), 0)
+
+    def testNamedFile(self):
+        from plone.namedfile.file import FileChunk
+        from plone.namedfile.file import NamedFile
+        file = NamedFile(b'some data')
+        with file.buffer() as data:
+            self.assertEqual(data.tobytes(), b'some data')
+        chunk = FileChunk(b'some ')
+        chunk.next = FileChunk(b'data')
+        file._data = chunk
+        with file.buffer() as data:
+            self.assertEqual(data.tobytes(), b'some data')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from plone.namedfile import copy as copy_module
+from plone.namedfile import settings
+from plone.namedfile.copy import BlobFileCopyHook
+from plone.namedfile.copy import copyFile
+from plone.namedfile.digest import DigestIndex
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.interfaces import IDigestIndex
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+from zope.component import getGlobalSiteManager
+from zope.copy import copy
+
+import os
+import tempfile
+import transaction
+import unittest
+
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.data = b'0123456789' * 100000
+        fd, self.src = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        fd, self.dst = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.src)
+        os.remove(self.dst)
+
+    def _copy(self):
+        with open(self.src, 'rb') as fsrc:
+            with open(self.dst, 'wb') as fdst:
+                copyFile(fsrc, fdst)
+        with open(self.dst, 'rb') as fp:
+            return fp.read()
+
+    def test_copy(self):
+        self.assertEqual(self._copy(), self.data)
+
+    def test_copy_in_python(self):
+        fcntl = copy_module.fcntl
+        copy_module.fcntl = None
+        try:
+            self.assertEqual(self._copy(), self.data)
+        finally:
+            copy_module.fcntl = fcntl
+
+
+class TestLazyCopy(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        settings.LAZY_BLOB_COPIES = True
+        getGlobalSiteManager().registerAdapter(BlobFileCopyHook)
+        self.connection = self.layer['zodbDB'].open()
+        self.root = self.connection.root()
+        self.root['index'] = self.index = DigestIndex()
+        transaction.savepoint(optimistic=True)
+        getGlobalSiteManager().registerUtility(self.index, IDigestIndex)
+        self.root['file'] = self.file = NamedBlobFile(b'some data')
+        transaction.commit()
+
+    def tearDown(self):
+        settings.LAZY_BLOB_COPIES = False
+        getGlobalSiteManager().unregisterAdapter(BlobFileCopyHook)
+        getGlobalSiteManager().unregisterUtility(self.index, IDigestIndex)
+        transaction.abort()
+        self.connection.close()
+
+    def test_copy_shares_blob(self):
+        self.root['copy'] = file_copy = copy(self.file)
+        self.assertTrue(file_copy._blob is self.file._blob)
+        transaction.commit()
+        self.assertEqual(file_copy.data, b'some data')
+
+    def test_writing_copy(self):
+        self.root['copy'] = file_copy = copy(self.file)
+        transaction.commit()
+        file_copy.data = b'other data'
+        transaction.commit()
+        self.assertEqual(file_copy.data, b'other data')
+        self.assertEqual(self.file.data, b'some data')
+
+    def test_writing_original(self):
+        self.root['copy'] = file_copy = copy(self.file)
+        transaction.commit()
+        with self.file.open('a') as fp:
+            fp.write(b' appended')
+        transaction.commit()
+        self.assertEqual(file_copy.data, b'some data')
+        self.assertEqual(self.file.data, b'some data appended')
+
+    def test_uncommitted_blob_is_copied(self):
+        file = NamedBlobFile(b'new data')
+        file_copy = copy(file)
+        self.assertFalse(file_copy._blob is file._blob)
+        self.assertEqual(file_copy.data, b'new data')
+
+    def test_blob_is_copied_without_index(self):
+        getGlobalSiteManager().unregisterUtility(self.index, IDigestIndex)
+        file_copy = copy(self.file)
+        self.assertFalse(file_copy._blob is self.file._blob)
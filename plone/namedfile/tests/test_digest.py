@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from persistent import Persistent
+from plone.namedfile.digest import DigestIndex
+from plone.namedfile.digest import remove_values
+from plone.namedfile.field import NamedBlobFile as NamedBlobFileField
+from plone.namedfile.file import FileChunk
+from plone.namedfile.file import MAXCHUNKSIZE
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.file import NamedFile
+from plone.namedfile.interfaces import IDigestIndex
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+from plone.namedfile.utils import get_etag
+from zope.component import getGlobalSiteManager
+from zope.interface import implementer
+from zope.interface import Interface
+from zope.lifecycleevent import ObjectRemovedEvent
+
+import hashlib
+import transaction
+import unittest
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class CountingFile(BytesIO):
+
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+class IHasFile(Interface):
+    file = NamedBlobFileField()
+
+
+@implementer(IHasFile)
+class DummyContent(Persistent):
+    file = None
+
+
+class TestDigest(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.connection = self.layer['zodbDB'].open()
+        self.root = self.connection.root()
+
+    def tearDown(self):
+        transaction.abort()
+        self.connection.close()
+
+    def test_bytes(self):
+        file = NamedFile(b'some data')
+        self.assertEqual(file._digest, sha256(b'some data'))
+        self.assertEqual(file.getDigest(), sha256(b'some data'))
+
+    def test_file_chunk(self):
+        chunk = FileChunk(b'some ')
+        chunk.next = FileChunk(b'data')
+        file = NamedFile(chunk)
+        self.assertEqual(file.getDigest(), sha256(b'some data'))
+
+    def test_large_file(self):
+        data = b'0123456789abcdef' * (MAXCHUNKSIZE // 4)
+        self.root['file'] = file = NamedFile()
+        transaction.savepoint(optimistic=True)
+        file.data = fp = CountingFile(data)
+        self.assertTrue(file._data.next is not None)
+        self.assertEqual(file._digest, sha256(data))
+        self.assertEqual(fp.bytes_read, len(data))
+        transaction.commit()
+        self.assertEqual(b''.join(file.iterChunks()), data)
+
+    def test_legacy_value(self):
+        file = NamedFile(b'some data')
+        # as stored by an older version
+        del file._digest
+        self.assertEqual(file.getDigest(), sha256(b'some data'))
+        self.assertEqual(file._digest, sha256(b'some data'))
+
+    def test_legacy_value_is_not_written_when_read(self):
+        self.root['file'] = file = NamedFile(b'some data')
+        del file._digest
+        transaction.commit()
+        self.assertEqual(file.getDigest(), sha256(b'some data'))
+        self.assertFalse(file._p_changed)
+        self.assertEqual(file._digest, None)
+
+    def test_etag(self):
+        file = NamedFile(b'some data')
+        self.assertEqual(get_etag(file), '"{0}"'.format(sha256(b'some data')))
+
+
+class TestDigestIndex(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.connection = self.layer['zodbDB'].open()
+        self.root = self.connection.root()
+        self.root['index'] = self.index = DigestIndex()
+        transaction.savepoint(optimistic=True)
+        getGlobalSiteManager().registerUtility(self.index, IDigestIndex)
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(self.index, IDigestIndex)
+        transaction.abort()
+        self.connection.close()
+
+    def test_values_are_indexed(self):
+        self.root['a'] = a = NamedFile(b'some data')
+        self.root['b'] = b = NamedFile(b'some data')
+        self.root['c'] = c = NamedFile(b'other data')
+        transaction.commit()
+        self.assertEqual(self.index.values(sha256(b'some data')), [a, b])
+        self.assertEqual(self.index.values(sha256(b'other data')), [c])
+        self.assertFalse(sha256(b'no data') in self.index)
+
+    def test_values_which_are_not_stored(self):
+        file = NamedFile(b'some data')
+        self.assertEqual(self.index.values(sha256(b'some data')), [file])
+        transaction.commit()
+        # the value was not added to the database by the index
+        self.assertEqual(file._p_jar, None)
+        self.assertEqual(self.index.values(sha256(b'some data')), [])
+
+    def test_changed_data(self):
+        file = NamedFile(b'some data')
+        file.data = b'other data'
+        self.assertFalse(sha256(b'some data') in self.index)
+        self.assertEqual(self.index.values(sha256(b'other data')), [file])
+
+    def test_copy(self):
+        from plone.namedfile.copy import FileCopyHook
+        from zope.copy import copy
+        gsm = getGlobalSiteManager()
+        gsm.registerAdapter(FileCopyHook)
+        try:
+            file = NamedFile(b'some data')
+            file_copy = copy(file)
+        finally:
+            gsm.unregisterAdapter(FileCopyHook)
+        self.assertEqual(
+            self.index.values(sha256(b'some data')), [file, file_copy])
+
+
+class TestDeduplication(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.connection = self.layer['zodbDB'].open()
+        self.root = self.connection.root()
+        self.root['index'] = self.index = DigestIndex(deduplicate=True)
+        transaction.savepoint(optimistic=True)
+        getGlobalSiteManager().registerUtility(self.index, IDigestIndex)
+        self.root['a'] = self.a = NamedBlobFile(b'some data')
+        transaction.commit()
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(self.index, IDigestIndex)
+        transaction.abort()
+        self.connection.close()
+
+    def test_blob_is_shared(self):
+        self.root['b'] = b = NamedBlobFile(b'some data')
+        self.assertTrue(b._blob is self.a._blob)
+        self.assertTrue(b._blob_shared)
+        self.assertEqual(self.index.blobReferences(b._blob), 2)
+        transaction.commit()
+        self.assertEqual(b.data, b'some data')
+        # the other value is not written
+        self.assertFalse(self.a._p_changed)
+        self.assertFalse(self.a._blob_shared)
+
+    def test_blob_references_limit(self):
+        self.root['b'] = NamedBlobFile(b'some data')
+        self.root['c'] = NamedBlobFile(b'some data')
+        self.assertEqual(self.index.blobReferences(self.a._blob), 3)
+        self.assertEqual(self.index.blobReferences(self.a._blob, limit=2), 2)
+
+    def test_other_data_is_not_shared(self):
+        b = NamedBlobFile(b'other data')
+        self.assertFalse(b._blob is self.a._blob)
+        self.assertFalse(b._blob_shared)
+
+    def test_not_deduplicating(self):
+        self.index.deduplicate = False
+        b = NamedBlobFile(b'some data')
+        self.assertFalse(b._blob is self.a._blob)
+
+    def test_set_data_copies_on_write(self):
+        self.root['b'] = b = NamedBlobFile(b'some data')
+        transaction.commit()
+        b.data = b'other data'
+        self.assertFalse(b._blob is self.a._blob)
+        self.assertFalse(b._blob_shared)
+        self.assertEqual(self.index.blobReferences(self.a._blob), 1)
+        transaction.commit()
+        self.assertEqual(self.a.data, b'some data')
+        self.assertEqual(b.data, b'other data')
+
+    def test_open_copies_on_write(self):
+        self.root['b'] = b = NamedBlobFile(b'some data')
+        transaction.commit()
+        with b.open('a') as fp:
+            fp.write(b' appended')
+        self.assertFalse(b._blob is self.a._blob)
+        transaction.commit()
+        self.assertEqual(self.a.data, b'some data')
+        self.assertEqual(b.data, b'some data appended')
+
+        # the blob of a is no longer shared, so it is written in place
+        blob = self.a._blob
+        with self.a.open('w') as fp:
+            fp.write(b'new data')
+        self.assertTrue(self.a._blob is blob)
+        self.assertFalse(self.a._blob_shared)
+
+    def test_removed_value_releases_blob(self):
+        self.root['item'] = item = DummyContent()
+        item.file = NamedBlobFile(b'some data')
+        self.assertEqual(self.index.blobReferences(self.a._blob), 2)
+        del self.root['item']
+        remove_values(item, ObjectRemovedEvent(item, self.root, 'item'))
+        self.assertEqual(self.index.values(sha256(b'some data')), [self.a])
+        self.assertEqual(self.index.blobReferences(self.a._blob), 1)
+
+        # so a writes to its blob in place
+        blob = self.a._blob
+        self.a.data = b'new data'
+        self.assertTrue(self.a._blob is blob)
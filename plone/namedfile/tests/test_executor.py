@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.namedfile import executor as executor_module
+from plone.namedfile.executor import ProcessScalingExecutor
+from plone.namedfile.executor import ScalingTimeout
+from plone.namedfile.interfaces import IImageScalingExecutor
+from plone.namedfile.scaling import DefaultImageScalingFactory
+from zope.component import getGlobalSiteManager
+
+import PIL.Image
+import tempfile
+import time
+import unittest
+
+
+def image_data(format_='PNG', size=(200, 100)):
+    data = BytesIO()
+    PIL.Image.new('RGB', size).save(data, format_)
+    return data.getvalue()
+
+
+class TestProcessScalingExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ProcessScalingExecutor(processes=1, timeout=30)
+
+    def test_scale_data(self):
+        [(data, format_, size)] = self.executor(
+            image_data(), [dict(width=50, height=50)], 88)
+        self.assertEqual(format_, 'PNG')
+        self.assertEqual(size, (50, 25))
+        self.assertEqual(PIL.Image.open(BytesIO(data)).size, (50, 25))
+
+    def test_scale_file(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(image_data('JPEG'))
+            fp.flush()
+            results = self.executor(fp, [
+                dict(width=50, height=50),
+                dict(width=None, height=None),
+            ], 88)
+        self.assertEqual(results[0][1:], ('JPEG', (50, 25)))
+        self.assertTrue(isinstance(results[1], Exception))
+
+    def test_error(self):
+        self.assertRaises(ValueError, self.executor.run, int, 'x')
+        self.assertRaises(
+            IOError, self.executor, b'not an image', [dict(width=50)], 88)
+
+    def test_timeout(self):
+        self.executor.timeout = 0.1
+        start = time.time()
+        self.assertRaises(ScalingTimeout, self.executor.run, time.sleep, 10)
+        self.assertTrue(time.time() - start < 5)
+
+    @unittest.skipIf(
+        executor_module.resource is None or
+        executor_module._address_space() is None,
+        'address space not known')
+    def test_memory_limit(self):
+        self.executor.memory_limit = 1 << 29
+        self.assertRaises(MemoryError, self.executor.run, bytearray, 1 << 30)
+        # the limit is on top of the memory the process uses already
+        self.executor.memory_limit = 1 << 22
+        self.assertEqual(len(self.executor.run(bytearray, 1 << 20)), 1 << 20)
+
+
+class TestScalingFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ProcessScalingExecutor(processes=1, timeout=30)
+        getGlobalSiteManager().registerUtility(
+            self.executor, IImageScalingExecutor)
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterUtility(
+            self.executor, IImageScalingExecutor)
+
+    def test_create_scale(self):
+        calls = []
+        run = self.executor.run
+        self.executor.run = lambda *args: calls.append(args) or run(*args)
+        factory = DefaultImageScalingFactory(None)
+        data, format_, size = factory.create_scale(
+            image_data(), direction='thumbnail', height=50, width=50)
+        self.assertEqual(size, (50, 25))
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.namedfile.file import FileChunk
+from plone.namedfile.file import NamedFile
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+import transaction
+import unittest
+
+
+class TestFileChunk(unittest.TestCase):
+
+    def _makeChain(self, *pieces):
+        chunks = [FileChunk(piece) for piece in pieces]
+        for chunk, next in zip(chunks, chunks[1:]):
+            chunk.next = next
+        return chunks[0]
+
+    def test_len(self):
+        self.assertEqual(len(self._makeChain(b'01234', b'abcde', b'xy')), 12)
+
+    def test_slice_across_chunks(self):
+        chain = self._makeChain(b'01234', b'abcde', b'xy')
+        self.assertEqual(chain[3:11], b'34abcdex')
+        self.assertEqual(chain[10:], b'xy')
+        self.assertEqual(chain[-3:], b'exy')
+        self.assertEqual(chain[6:2], b'')
+
+    def test_locate(self):
+        chain = self._makeChain(b'01234', b'abcde', b'xy')
+        chunk, offset = chain.locate(7)
+        self.assertEqual((chunk._data, offset), (b'abcde', 5))
+        chunk, offset = chain.locate(11)
+        self.assertEqual((chunk._data, offset), (b'xy', 10))
+
+    def test_set_data_stores_index(self):
+        chain = self._makeChain(b'01234', b'abcde', b'xy')
+        file = NamedFile()
+        file.data = chain
+        self.assertEqual(file.getSize(), 12)
+        self.assertEqual(chain._offsets, (0, 5, 10, 12))
+
+    def test_read_range(self):
+        file = NamedFile()
+        file.data = self._makeChain(b'01234', b'abcde', b'xy')
+        self.assertEqual(file.readRange(3, 8), b'34abcdex')
+        self.assertEqual(file.readRange(10), b'xy')
+        self.assertEqual(file.readRange(20, 5), b'')
+        self.assertEqual(list(file.iterChunks(3, 8)), [b'34', b'abc'])
+
+    def test_read_range_of_bytes(self):
+        file = NamedFile(b'some data')
+        self.assertEqual(file.readRange(5, 2), b'da')
+        self.assertEqual(b''.join(file.iterChunks(5)), b'data')
+
+
+class TestFileChunkIndex(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.data = b''.join(
+            chr(ord('a') + i % 26).encode('ascii') * 1000
+            for i in range(400)
+        )
+        db = self.layer['zodbDB']
+        connection = db.open()
+        connection.root()['file'] = NamedFile()
+        transaction.savepoint(optimistic=True)
+        connection.root()['file'].data = BytesIO(self.data)
+        transaction.commit()
+        connection.close()
+        self.connection = db.open()
+        self.head = self.connection.root()['file']._data
+
+    def tearDown(self):
+        self.connection.close()
+
+    def _loaded(self):
+        return [chunk._p_changed is not None for chunk in self.head._chunks]
+
+    def test_index_is_stored(self):
+        offsets = self.head._offsets
+        self.assertEqual(offsets[0], 0)
+        self.assertEqual(offsets[-1], len(self.data))
+        self.assertEqual(len(offsets), len(self.head._chunks) + 1)
+
+    def test_len_does_not_load_chunks(self):
+        self.assertEqual(len(self.head), len(self.data))
+        self.assertEqual(self._loaded(), [True] + [False] * (
+            len(self.head._chunks) - 1))
+
+    def test_slice_only_loads_touched_chunks(self):
+        self.assertEqual(
+            self.head[300000:300010], self.data[300000:300010])
+        self.assertEqual(sum(self._loaded()), 2)
+
+    def test_read_range_only_loads_touched_chunks(self):
+        file = self.connection.root()['file']
+        self.assertEqual(
+            file.readRange(300000, 10), self.data[300000:300010])
+        # the chunk read was turned into a ghost again
+        self.assertEqual(sum(self._loaded()), 1)
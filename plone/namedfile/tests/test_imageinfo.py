@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.namedfile.file import FileChunk
+from plone.namedfile.file import NamedImage
+from plone.namedfile.imageinfo import getImageInfo
+from plone.namedfile.imageinfo import PILImage
+
+import os
+import struct
+import unittest
+
+
+def getFile(filename):
+    filename = os.path.join(os.path.dirname(__file__), filename)
+    with open(filename, 'rb') as fp:
+        return fp.read()
+
+
+def jpeg_with_segments(size, count=1, frame=b'\xc0'):
+    """A JPEG header with `count` APP1 segments of `size` bytes before the
+    frame.
+    """
+    segment = b'\xff\xe1' + struct.pack('>H', size + 2) + b'\x00' * size
+    return (
+        b'\xff\xd8' +
+        segment * count +
+        b'\xff' + frame + b'\x00\x11\x08\x02\xa8\x04\x00' +
+        b'\x00' * 100
+    )
+
+
+def box(kind, payload):
+    return struct.pack('>L', len(payload) + 8) + kind + payload
+
+
+def heif(brand, compatible, sizes):
+    properties = b''.join(
+        box(b'ispe', b'\0' * 4 + struct.pack('>LL', w, h)) for w, h in sizes)
+    return (
+        box(b'ftyp', brand + b'\0\0\0\0' + b''.join(compatible)) +
+        box(b'meta', b'\0' * 4 + box(b'hdlr', b'\0' * 24) +
+            box(b'iprp', box(b'ipco', properties))) +
+        box(b'mdat', b'\0' * 1000)
+    )
+
+
+class CountingFile(BytesIO):
+
+    def __init__(self, data):
+        BytesIO.__init__(self, data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+class TestImageInfo(unittest.TestCase):
+
+    def test_gif(self):
+        self.assertEqual(
+            getImageInfo(getFile('image.gif')), ('image/gif', 200, 200))
+
+    def test_jpeg(self):
+        self.assertEqual(
+            getImageInfo(getFile('image.jpg')), ('image/jpeg', 500, 200))
+
+    def test_unknown(self):
+        self.assertEqual(getImageInfo(b'Data'), ('', -1, -1))
+        self.assertEqual(getImageInfo(b''), ('', -1, -1))
+
+    def test_truncated_jpeg(self):
+        data = jpeg_with_segments(1000)[:500]
+        self.assertEqual(getImageInfo(data), ('image/jpeg', -1, -1))
+
+    def test_jpeg_seeks_over_segments(self):
+        fp = CountingFile(jpeg_with_segments(60000, count=100))
+        self.assertEqual(getImageInfo(fp), ('image/jpeg', 1024, 680))
+        self.assertTrue(fp.bytes_read < 2048)
+
+    def test_file_position_is_kept(self):
+        fp = BytesIO(getFile('image.gif'))
+        self.assertEqual(getImageInfo(fp), ('image/gif', 200, 200))
+        self.assertEqual(fp.tell(), 0)
+
+    def test_chunk_chain(self):
+        data = jpeg_with_segments(1000, count=5)
+        head = FileChunk(data[:1000])
+        head.next = FileChunk(data[1000:3000])
+        head.next.next = FileChunk(data[3000:])
+        self.assertEqual(getImageInfo(head), ('image/jpeg', 1024, 680))
+
+    def test_image_from_file(self):
+        image = NamedImage(BytesIO(jpeg_with_segments(60000, count=2)))
+        self.assertEqual(image.contentType, 'image/jpeg')
+        self.assertEqual(image.getImageSize(), (1024, 680))
+
+    def test_progressive_jpeg(self):
+        data = jpeg_with_segments(100, frame=b'\xc2')
+        self.assertEqual(getImageInfo(data), ('image/jpeg', 1024, 680))
+        # lossless, arithmetic coding
+        data = jpeg_with_segments(100, frame=b'\xcb')
+        self.assertEqual(getImageInfo(data), ('image/jpeg', 1024, 680))
+
+    def test_jpeg_huffman_table_is_no_frame(self):
+        data = jpeg_with_segments(100, frame=b'\xc4')
+        self.assertEqual(getImageInfo(data), ('image/jpeg', -1, -1))
+
+    def test_webp(self):
+        lossy = (
+            b'RIFF\0\0\0\0WEBPVP8 \0\0\0\0\0\0\0\x9d\x01\x2a' +
+            struct.pack('<HH', 123, 45) + b'\0' * 10)
+        self.assertEqual(getImageInfo(lossy), ('image/webp', 123, 45))
+        bits = (123 - 1) | (45 - 1) << 14
+        lossless = (
+            b'RIFF\0\0\0\0WEBPVP8L\0\0\0\0\x2f' +
+            struct.pack('<L', bits) + b'\0' * 10)
+        self.assertEqual(getImageInfo(lossless), ('image/webp', 123, 45))
+        extended = (
+            b'RIFF\0\0\0\0WEBPVP8X\0\0\0\0\0\0\0\0' +
+            struct.pack('<L', 3999)[:3] + struct.pack('<L', 2999)[:3] +
+            b'\0' * 10)
+        self.assertEqual(getImageInfo(extended), ('image/webp', 4000, 3000))
+
+    def test_avif(self):
+        data = heif(b'avif', [b'mif1', b'miaf'], [(64, 48), (4000, 3000)])
+        self.assertEqual(getImageInfo(data), ('image/avif', 4000, 3000))
+
+    def test_heic(self):
+        data = heif(b'mif1', [b'mif1', b'heic'], [(4032, 3024)])
+        self.assertEqual(getImageInfo(data), ('image/heic', 4032, 3024))
+
+    def test_other_media_file(self):
+        data = heif(b'isom', [b'mp41'], [])
+        self.assertEqual(getImageInfo(data), ('', -1, -1))
+
+    def test_tiff(self):
+        little = (
+            b'II*\0' + struct.pack('<L', 8) + struct.pack('<H', 2) +
+            struct.pack('<HHLHH', 256, 3, 1, 123, 0) +
+            struct.pack('<HHLL', 257, 4, 1, 45))
+        self.assertEqual(getImageInfo(little), ('image/tiff', 123, 45))
+        big = (
+            b'MM\0*' + struct.pack('>L', 8) + struct.pack('>H', 2) +
+            struct.pack('>HHLL', 256, 4, 1, 123) +
+            struct.pack('>HHLHH', 257, 3, 1, 45, 0))
+        self.assertEqual(getImageInfo(big), ('image/tiff', 123, 45))
+
+    def test_ico(self):
+        data = (
+            b'\0\0\1\0\2\0' +
+            b'\x10\x10\0\0' + b'\0' * 12 +
+            b'\0\0\0\0' + b'\0' * 12)
+        self.assertEqual(getImageInfo(data), ('image/x-icon', 256, 256))
+
+    def test_svg(self):
+        data = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<!-- Created by hand -->\n'
+            b'<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" '
+            b'"http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n'
+            b'<svg xmlns="http://www.w3.org/2000/svg" width="300" '
+            b'height="150px">\n</svg>')
+        self.assertEqual(getImageInfo(data), ('image/svg+xml', 300, 150))
+
+    def test_svg_viewbox(self):
+        data = b'<svg viewBox="0 0 30 20"></svg>'
+        self.assertEqual(getImageInfo(data), ('image/svg+xml', 30, 20))
+        data = b'<svg width="60" viewBox="0,0,30,20"></svg>'
+        self.assertEqual(getImageInfo(data), ('image/svg+xml', 60, 40))
+        data = b'<svg width="100%" height="100%"></svg>'
+        self.assertEqual(getImageInfo(data), ('image/svg+xml', -1, -1))
+
+    def test_html_with_svg(self):
+        data = b'<!DOCTYPE html><html><body><svg width="3" height="4">'
+        self.assertEqual(getImageInfo(data), ('', -1, -1))
+
+    @unittest.skipIf(PILImage is None, 'requires PIL')
+    def test_pil_fallback(self):
+        # PCX is not known to the header parser
+        data = BytesIO()
+        PILImage.new('RGB', (12, 34)).save(data, 'PCX')
+        fp = CountingFile(data.getvalue())
+        content_type, width, height = getImageInfo(fp)
+        self.assertEqual((width, height), (12, 34))
+        self.assertTrue(fp.bytes_read < 1024)
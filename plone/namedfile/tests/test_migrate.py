@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from persistent import Persistent
+from plone.namedfile import utils
+from plone.namedfile.field import NamedFile as NamedFileField
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.file import NamedBlobImage
+from plone.namedfile.file import NamedFile
+from plone.namedfile.file import NamedImage
+from plone.namedfile.migrate import migrate_objects
+from plone.namedfile.migrate import migrate_site
+from plone.namedfile.migrate import walk
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+from zope.annotation import IAttributeAnnotatable
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getGlobalSiteManager
+from zope.interface import implementer
+from zope.interface import Interface
+
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+with open(os.path.join(os.path.dirname(__file__), 'image.gif'), 'rb') as fp:
+    gif = fp.read()
+
+
+@implementer(IAttributeAnnotatable)
+class DummyFolder(Persistent):
+
+    def __init__(self):
+        self.items = {}
+
+    def objectIds(self):
+        return list(self.items)
+
+    def _getOb(self, id, default=None):
+        return self.items.get(id, default)
+
+
+class IAttachment(Interface):
+    attachment = NamedFileField()
+
+
+@implementer(IAttachment)
+class Attachment(object):
+    """A behavior storing its field in an annotation.
+    """
+
+    def __init__(self, context):
+        self.annotations = IAnnotations(context)
+
+    def _get(self):
+        return self.annotations.get('attachment')
+
+    def _set(self, value):
+        self.annotations['attachment'] = value
+
+    attachment = property(_get, _set)
+
+
+class AttachmentBehavior(object):
+    interface = IAttachment
+
+
+class BehaviorAssignable(object):
+
+    def __init__(self, context):
+        self.context = context
+
+    def enumerateBehaviors(self):
+        yield AttachmentBehavior
+
+
+class TestMigrate(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.data = b'0123456789' * 30000
+        self.connection = self.layer['zodbDB'].open()
+        self.site = self.connection.root()['site'] = DummyFolder()
+        for id in ('a', 'b', 'c'):
+            self.site.items[id] = item = DummyFolder()
+            transaction.savepoint(optimistic=True)
+            item.file = NamedFile(filename=u'data.txt')
+            item.file.data = BytesIO(self.data)
+            item.file.contentType = 'text/plain'
+            item.image = NamedImage(filename=u'zpt.gif')
+            item.image.data = BytesIO(gif)
+            item.image.contentType = 'image/gif'
+        self.site._p_changed = True
+        transaction.commit()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        self.connection.close()
+
+    def test_migrate_objects(self):
+        item = self.site.items['a']
+        report = migrate_objects([item])
+        self.assertEqual(report.values, 2)
+        self.assertTrue(isinstance(item.file, NamedBlobFile))
+        self.assertEqual(item.file.data, self.data)
+        self.assertEqual(item.file.filename, u'data.txt')
+        self.assertEqual(item.file.contentType, 'text/plain')
+        self.assertTrue(isinstance(item.image, NamedBlobImage))
+        self.assertEqual(item.image.data, gif)
+        self.assertEqual(item.image.getImageSize(), (200, 200))
+        self.assertEqual(item.image.contentType, 'image/gif')
+
+    def test_migrate_fieldnames(self):
+        item = self.site.items['a']
+        migrate_objects([item], fieldnames=['image'])
+        self.assertTrue(isinstance(item.file, NamedFile))
+        self.assertTrue(isinstance(item.image, NamedBlobImage))
+
+    @unittest.skipIf(
+        utils.IBehaviorAssignable is None, 'plone.behavior is missing')
+    def test_migrate_behavior_fields(self):
+        sm = getGlobalSiteManager()
+        sm.registerAdapter(
+            BehaviorAssignable, (DummyFolder,), utils.IBehaviorAssignable)
+        sm.registerAdapter(Attachment, (DummyFolder,), IAttachment)
+        try:
+            item = self.site.items['a']
+            IAttachment(item).attachment = NamedFile(
+                self.data, filename=u'data.txt')
+            report = migrate_objects([item], fieldnames=['attachment'])
+            self.assertEqual(report.values, 1)
+            attachment = IAnnotations(item)['attachment']
+            self.assertTrue(isinstance(attachment, NamedBlobFile))
+            self.assertEqual(attachment.data, self.data)
+        finally:
+            sm.unregisterAdapter(
+                BehaviorAssignable, (DummyFolder,),
+                utils.IBehaviorAssignable)
+            sm.unregisterAdapter(Attachment, (DummyFolder,), IAttachment)
+
+    def test_migrate_site_is_idempotent(self):
+        report = migrate_site(self.site, batch_size=1)
+        self.assertEqual(report.migrated_objects, 3)
+        report = migrate_site(self.site)
+        self.assertEqual(report.values, 0)
+
+    def test_migrate_site_resumes(self):
+        checkpoint = os.path.join(self.tempdir, 'checkpoint')
+        with open(checkpoint, 'w') as fp:
+            fp.write('a')
+        report = migrate_site(self.site, checkpoint=checkpoint)
+        self.assertEqual(report.objects, 2)
+        self.assertTrue(isinstance(self.site.items['a'].file, NamedFile))
+        self.assertTrue(isinstance(self.site.items['c'].file, NamedBlobFile))
+        with open(checkpoint) as fp:
+            self.assertEqual(fp.read(), 'c')
+
+    def test_walk_order(self):
+        self.assertEqual(
+            [path for path, obj in walk(self.site)],
+            [(), ('a',), ('b',), ('c',)],
+        )
+        self.assertEqual(
+            [path for path, obj in walk(self.site, resume_after=('b',))],
+            [('c',)],
+        )
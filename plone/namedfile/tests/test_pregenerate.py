@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from persistent import Persistent
+from plone.namedfile import pregenerate
+from plone.namedfile import settings
+from plone.namedfile.field import NamedBlobImage as NamedBlobImageField
+from plone.namedfile.file import NamedBlobImage
+from plone.namedfile.interfaces import IImageScaleTraversable
+from plone.namedfile.pregenerate import ScaleQueue
+from plone.namedfile.scaling import ImageScaling
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+from zope.annotation import IAttributeAnnotatable
+from zope.annotation.interfaces import IAnnotations
+from zope.interface import implementer
+from zope.lifecycleevent import ObjectModifiedEvent
+
+import os
+import transaction
+import unittest
+
+
+class IHasImage(IImageScaleTraversable):
+    image = NamedBlobImageField()
+
+
+@implementer(IAttributeAnnotatable, IHasImage)
+class DummyContent(Persistent):
+    image = None
+
+    def absolute_url(self):
+        return 'http://nohost/item'
+
+
+class Job(object):
+
+    def __init__(self, key, done):
+        self.key = key
+        self.done = done
+
+    def __call__(self):
+        self.done.append(self.key)
+
+
+class TestScaleQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = ScaleQueue(workers=0)
+
+    def tearDown(self):
+        self.queue.stop()
+
+    def test_jobs_are_queued_once(self):
+        done = []
+        queue = self.queue
+        self.assertTrue(queue.put(Job('a', done)))
+        self.assertFalse(queue.put(Job('a', done)))
+        self.assertEqual(len(queue), 1)
+        queue.workers = 1
+        self.assertTrue(queue.put(Job('b', done)))
+        queue.join()
+        self.assertEqual(done, ['a', 'b'])
+        self.assertEqual(len(queue), 0)
+
+    def test_stop(self):
+        done = []
+        queue = self.queue
+        queue.workers = 1
+        queue.put(Job('a', done))
+        queue.join()
+        threads = [thread for thread, stopped in queue._threads]
+        self.assertEqual(len(threads), 1)
+        queue.stop()
+        self.assertFalse(threads[0].is_alive())
+        # queued jobs are dropped
+        queue.workers = 0
+        queue.put(Job('b', done))
+        queue.stop()
+        self.assertEqual(len(queue), 0)
+        # and workers are started again for new jobs
+        queue.workers = 1
+        queue.put(Job('c', done))
+        queue.join()
+        self.assertEqual(done, ['a', 'c'])
+
+
+class TestEagerScales(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        settings.EAGER_SCALES = True
+        self._orig_sizes = ImageScaling._sizes
+        ImageScaling._sizes = {'thumb': (60, 60)}
+        self.db = self.layer['zodbDB']
+        self.connection = self.db.open()
+        self.root = self.connection.root()
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        self.root['item'] = self.item = DummyContent()
+        self.item.image = NamedBlobImage(data, 'image/gif', u'image.gif')
+
+    def tearDown(self):
+        pregenerate.queue.stop()
+        settings.EAGER_SCALES = False
+        ImageScaling._sizes = self._orig_sizes
+        transaction.abort()
+        self.connection.close()
+
+    def _scales(self):
+        connection = self.db.open()
+        try:
+            item = connection.root()['item']
+            return list(IAnnotations(item).get('plone.scale', {}).values())
+        finally:
+            connection.close()
+
+    def test_scales_are_made_after_commit(self):
+        pregenerate.queue_scales(self.item, ObjectModifiedEvent(self.item))
+        self.assertEqual(len(pregenerate.queue), 0)
+        transaction.commit()
+        pregenerate.queue.join()
+        scales = self._scales()
+        self.assertEqual(len(scales), 1)
+        self.assertTrue(scales[0]['width'] <= 60)
+
+    def test_not_eager(self):
+        settings.EAGER_SCALES = False
+        pregenerate.queue_scales(self.item, ObjectModifiedEvent(self.item))
+        transaction.commit()
+        pregenerate.queue.join()
+        self.assertEqual(self._scales(), [])
+
+    def test_aborted(self):
+        pregenerate.queue_scales(self.item, ObjectModifiedEvent(self.item))
+        transaction.abort()
+        self.assertEqual(len(pregenerate.queue), 0)
@@ -2,15 +2,21 @@
 from datetime import datetime
 from io import StringIO
 from persistent import Persistent
+from plone.namedfile import settings
 from plone.namedfile.field import NamedImage as NamedImageField
+from plone.namedfile.file import NamedBlobImage
 from plone.namedfile.file import NamedImage
 from plone.namedfile.interfaces import IAvailableSizes
 from plone.namedfile.interfaces import IImageScaleTraversable
+from plone.namedfile.scaling import DefaultImageScalingFactory
 from plone.namedfile.scaling import ImageScaling
+from plone.namedfile.scaling import Overloaded
+from plone.namedfile.scaling import ScalingLimiter
 from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
 from plone.namedfile.testing import PLONE_NAMEDFILE_INTEGRATION_TESTING
 from plone.scale.interfaces import IScaledImageQuality
 from zope.annotation import IAttributeAnnotatable
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getGlobalSiteManager
 from zope.component import getSiteManager
 from zope.interface import implementer
@@ -19,7 +25,9 @@ from zope.traversing.browser.interfaces import IAbsoluteURL
 import os
 import PIL
 import re
+import threading
 import time
+import transaction
 import unittest
 
 
@@ -193,6 +201,57 @@ class ImageScalingTests(unittest.TestCase):
                 base))
         self.assertTrue(re.match(expected, tag).groups())
 
+    def testCreateScales(self):
+        self.scaling.available_sizes = {'foo': (60, 60), 'bar': (20, 20)}
+        scales = self.scaling.create_scales('image')
+        self.assertEqual(sorted(scales), ['bar', 'foo'])
+        self.assertEqual((scales['foo'].width, scales['foo'].height), (60, 60))
+        self.assertEqual((scales['bar'].width, scales['bar'].height), (20, 20))
+        # the scales are stored
+        foo = self.scaling.scale('image', scale='foo')
+        self.assertEqual(foo.uid, scales['foo'].uid)
+        self.assertEqual(
+            self.scaling.create_scales('image', ['foo'])['foo'].uid,
+            foo.uid)
+
+    def testScalePILImage(self):
+        from plone.namedfile.scaling import scale_pil_image
+        image = PIL.Image.new('RGB', (400, 300))
+        results = scale_pil_image(image, [
+            dict(width=64, height=64),
+            dict(width=200, height=200, direction='down'),
+            dict(width=None, height=None, direction='down'),
+        ])
+        self.assertEqual(results[0].size, (64, 48))
+        self.assertEqual(results[1].size, (200, 200))
+        self.assertTrue(isinstance(results[2], ValueError))
+        self.assertEqual(image.size, (400, 300))
+
+    def testOpenImageReducesJPEG(self):
+        from io import BytesIO
+        from plone.namedfile.scaling import open_image
+        data = BytesIO()
+        PIL.Image.new('RGB', (800, 600)).save(data, 'JPEG')
+        # decoded at a reduced size, still as large as the scale
+        image = open_image(data.getvalue(), [dict(width=100, height=100)])
+        width, height = image.size
+        self.assertTrue(100 <= width < 800)
+        self.assertTrue(75 <= height < 600)
+        image = open_image(data.getvalue(), [dict(width=700, height=700)])
+        self.assertEqual(image.size, (800, 600))
+
+    def testCreateScaleOfReducedJPEG(self):
+        from io import BytesIO
+        from plone.namedfile.scaling import DefaultImageScalingFactory
+        data = BytesIO()
+        PIL.Image.new('RGB', (800, 600)).save(data, 'JPEG')
+        factory = DefaultImageScalingFactory(self.item)
+        result, format_, size = factory.create_scale(
+            data.getvalue(), direction='thumbnail', height=100, width=100)
+        self.assertEqual(format_, 'JPEG')
+        self.assertEqual(size, (100, 75))
+        self.assertEqual(PIL.Image.open(BytesIO(result)).size, (100, 75))
+
     def testScaledImageQuality(self):
         # scale an image, record its size
         foo = self.scaling.scale('image', width=100, height=80)
@@ -208,6 +267,19 @@ class ImageScalingTests(unittest.TestCase):
         # first one should be bigger
         self.assertTrue(size_foo > size_bar)
 
+    def testScaleOverloaded(self):
+        settings.MAX_CONCURRENT_SCALES = 0
+        settings.MAX_WAITING_SCALES = 0
+        try:
+            foo = self.scaling.scale('image', width=100, height=80)
+        finally:
+            settings.MAX_CONCURRENT_SCALES = None
+            settings.MAX_WAITING_SCALES = 16
+        # the original is shown at the size of the scale
+        self.assertTrue(foo.data is self.item.image)
+        self.assertEqual((foo.width, foo.height), (80, 80))
+        self.assertFalse(hasattr(foo, 'uid'))
+
 
 class ImageTraverseTests(unittest.TestCase):
 
@@ -286,6 +358,163 @@ class ImageTraverseTests(unittest.TestCase):
         self.assertNotEqual(uid1, uid2, 'scale not updated?')
 
 
+class StoredContent(DummyContent):
+
+    def absolute_url(self):
+        return 'http://nohost/item'
+
+
+class ConcurrentScalingTests(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.db = self.layer['zodbDB']
+        connection = self.db.open()
+        item = connection.root()['item'] = StoredContent()
+        with open(os.path.join(
+                os.path.dirname(__file__), 'image.gif'), 'rb') as fp:
+            item.image = NamedBlobImage(fp.read(), 'image/gif', u'image.gif')
+        transaction.commit()
+        # a first scale, so that the scales of both connections are stored
+        # in the same annotation
+        ImageScaling(item, None).scale('image', width=20, height=20)
+        transaction.commit()
+        connection.close()
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.calls = []
+        self.create_scale = DefaultImageScalingFactory.create_scale
+
+        def create_scale(factory, *args, **kwargs):
+            self.calls.append(None)
+            self.started.set()
+            self.proceed.wait(10)
+            return self.create_scale(factory, *args, **kwargs)
+        DefaultImageScalingFactory.create_scale = create_scale
+
+    def tearDown(self):
+        DefaultImageScalingFactory.create_scale = self.create_scale
+        self.proceed.set()
+
+    def scale(self, results):
+        connection = self.db.open()
+        try:
+            item = connection.root()['item']
+            scale = ImageScaling(item, None).scale(
+                'image', width=100, height=80)
+            results.append(scale)
+            self.assertTrue(IAnnotations(item)['plone.scale'][scale.uid])
+            self.assertEqual(scale.data.getImageSize(), (80, 80))
+            transaction.commit()
+        finally:
+            transaction.abort()
+            connection.close()
+
+    def testScaleIsComputedOnce(self):
+        results = []
+        threads = [threading.Thread(target=self.scale, args=(results,))]
+        threads[0].start()
+        self.started.wait(10)
+        threads.append(threading.Thread(target=self.scale, args=(results,)))
+        threads[1].start()
+        time.sleep(0.1)
+        self.proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(results), 2)
+        # each connection stored a scale of its own
+        self.assertFalse(results[0].data is results[1].data)
+        connection = self.db.open()
+        try:
+            item = connection.root()['item']
+            uids = set(IAnnotations(item)['plone.scale'])
+            self.assertTrue(results[0].uid in uids)
+            self.assertTrue(results[1].uid in uids)
+        finally:
+            connection.close()
+
+
+class ScalingLimiterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = ScalingLimiter()
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.calls = []
+
+    def tearDown(self):
+        settings.MAX_CONCURRENT_SCALES = None
+        settings.MAX_WAITING_SCALES = 16
+        self.proceed.set()
+
+    def call(self, key, results):
+        try:
+            results.append(self.limiter.run(key, self.compute))
+        except Overloaded:
+            pass
+
+    def compute(self):
+        self.calls.append(None)
+        self.started.set()
+        self.proceed.wait(10)
+        return len(self.calls)
+
+    def start(self, key, results):
+        thread = threading.Thread(target=self.call, args=(key, results))
+        thread.start()
+        return thread
+
+    def fail(self):
+        self.started.set()
+        self.proceed.wait(10)
+        raise ValueError()
+
+    def testSingleFlight(self):
+        # the result of the first call is handed to the others
+        results = []
+        threads = [self.start('key', results)]
+        self.started.wait(10)
+        threads.extend(self.start('key', results) for i in range(3))
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        self.proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1, 1, 1, 1])
+        self.assertEqual(len(self.calls), 1)
+
+    def testFailedCall(self):
+        results = []
+        thread = threading.Thread(
+            target=lambda: self.assertRaises(
+                ValueError, self.limiter.run, 'key', self.fail))
+        thread.start()
+        self.started.wait(10)
+        threads = [self.start('key', results) for i in range(2)]
+        time.sleep(0.1)
+        self.proceed.set()
+        thread.join()
+        for thread in threads:
+            thread.join()
+        # the waiting calls are overloaded rather than made again
+        self.assertEqual(results, [])
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.limiter.run('key', self.compute), 1)
+
+    def testOverloaded(self):
+        settings.MAX_CONCURRENT_SCALES = 1
+        settings.MAX_WAITING_SCALES = 0
+        results = []
+        thread = self.start('a', results)
+        self.started.wait(10)
+        self.assertRaises(Overloaded, self.limiter.run, 'b', self.compute)
+        self.proceed.set()
+        thread.join()
+        self.assertEqual(self.limiter.run('b', self.compute), 2)
+
+
 def test_suite():
     from unittest import defaultTestLoader
     return defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from plone.namedfile.settings import _bool
+from plone.namedfile.settings import _optional
+from plone.namedfile.settings import get_setting
+
+import unittest
+
+
+class TestGetSetting(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(get_setting('SCALING_WAIT', 30, float, {}), 30)
+
+    def test_environment(self):
+        environ = {'PLONE_NAMEDFILE_SCALING_WAIT': ' 2.5 '}
+        self.assertEqual(get_setting('SCALING_WAIT', 30, float, environ), 2.5)
+
+    def test_switch(self):
+        for value, expected in [('on', True), ('Yes', True), ('1', True),
+                                ('off', False), ('0', False), ('', False)]:
+            environ = {'PLONE_NAMEDFILE_EAGER_SCALES': value}
+            self.assertEqual(
+                get_setting('EAGER_SCALES', None, _bool, environ), expected)
+
+    def test_optional(self):
+        environ = {'PLONE_NAMEDFILE_BLOB_THRESHOLD': ''}
+        self.assertEqual(
+            get_setting('BLOB_THRESHOLD', 1000, _optional(int), environ),
+            None)
+        environ = {'PLONE_NAMEDFILE_BLOB_THRESHOLD': '65536'}
+        self.assertEqual(
+            get_setting('BLOB_THRESHOLD', None, _optional(int), environ),
+            65536)
+
+    def test_invalid(self):
+        environ = {'PLONE_NAMEDFILE_EAGER_SCALES': 'maybe'}
+        self.assertRaises(
+            ValueError, get_setting, 'EAGER_SCALES', False, _bool, environ)
+        environ = {'PLONE_NAMEDFILE_UPLOAD_EXPIRES': '1h'}
+        self.assertRaises(
+            ValueError, get_setting, 'UPLOAD_EXPIRES', 3600, int, environ)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.namedfile.interfaces import IStorage
+from plone.namedfile.storages import BytesStorable
+from plone.namedfile.storages import FileDescriptorStorable
+from plone.namedfile.storages import FileUploadStorable
+from plone.namedfile.storages import storeFile
+from plone.namedfile.utils import get_storable
+from ZODB.blob import Blob
+from zope.component import ComponentLookupError
+from zope.component import getGlobalSiteManager
+from zope.publisher.browser import FileUpload
+
+import os
+import tempfile
+import unittest
+
+
+DATA = b'0123456789' * 100000
+
+
+class Stream(object):
+    """A file-like object which can only be read."""
+
+    def __init__(self, data):
+        self.fp = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+
+class FieldStorage(object):
+
+    def __init__(self, file, filename='test.bin', headers=None):
+        self.file = file
+        self.filename = filename
+        self.headers = headers or {}
+
+
+class TestStoreFile(unittest.TestCase):
+
+    def _store(self, data):
+        blob = Blob()
+        storeFile(data, blob)
+        with blob.open('r') as fp:
+            return fp.read()
+
+    def test_bytes_io(self):
+        self.assertEqual(self._store(BytesIO(DATA)), DATA)
+
+    def test_file(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(DATA)
+            self.assertEqual(self._store(fp), DATA)
+
+    def test_spooled_file(self):
+        with tempfile.SpooledTemporaryFile(max_size=1 << 10) as fp:
+            fp.write(DATA[:100])
+            self.assertEqual(self._store(fp), DATA[:100])
+            fp.write(DATA[100:])
+            self.assertEqual(self._store(fp), DATA)
+
+    def test_file_is_stored_from_start(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(DATA)
+            self.assertEqual(fp.tell(), len(DATA))
+            self.assertEqual(self._store(fp), DATA)
+        data = BytesIO(DATA)
+        data.seek(100)
+        self.assertEqual(self._store(data), DATA)
+
+    def test_stream(self):
+        self.assertEqual(self._store(Stream(DATA)), DATA)
+
+    def test_text(self):
+        from io import StringIO
+        self.assertEqual(self._store(StringIO(u'd\xe4ta')), b'd\xc3\xa4ta')
+        with tempfile.TemporaryFile('w+') as fp:
+            fp.write(u'data')
+            self.assertEqual(self._store(fp), b'data')
+
+    def test_not_a_file(self):
+        from plone.namedfile.interfaces import NotStorable
+        self.assertRaises(
+            NotStorable, FileDescriptorStorable().store, DATA, Blob())
+
+
+class TestFileUpload(unittest.TestCase):
+
+    def _store(self, upload):
+        blob = Blob()
+        FileUploadStorable().store(upload, blob)
+        with blob.open('r') as fp:
+            return fp.read()
+
+    def test_spooled_upload_is_linked(self):
+        spool = tempfile.NamedTemporaryFile()
+        spool.write(DATA)
+        upload = FileUpload(FieldStorage(spool))
+        self.assertEqual(self._store(upload), DATA)
+        # the spool file is left for the upload to clean up
+        self.assertTrue(os.path.exists(spool.name))
+        directory, name = os.path.split(spool.name)
+        self.assertEqual(
+            [n for n in os.listdir(directory) if n.startswith(name)], [name])
+        spool.close()
+        self.assertFalse(os.path.exists(spool.name))
+
+    def test_upload_in_memory(self):
+        upload = FileUpload(FieldStorage(BytesIO(DATA)))
+        self.assertEqual(self._store(upload), DATA)
+
+
+class TestGetStorable(unittest.TestCase):
+
+    def setUp(self):
+        self.bytes_storable = BytesStorable()
+        self.file_storable = FileDescriptorStorable()
+        bytes_name = '.'.join((bytes.__module__, bytes.__name__))
+        self.utilities = [
+            (self.bytes_storable, bytes_name),
+            (self.file_storable, '_io._IOBase'),
+        ]
+        gsm = getGlobalSiteManager()
+        self.registered = [
+            (gsm.queryUtility(IStorage, name=name), name)
+            for utility, name in self.utilities
+        ]
+        for utility, name in self.utilities:
+            gsm.registerUtility(utility, IStorage, name=name)
+
+    def tearDown(self):
+        gsm = getGlobalSiteManager()
+        for utility, name in self.utilities:
+            gsm.unregisterUtility(utility, IStorage, name=name)
+        for utility, name in self.registered:
+            if utility is not None:
+                gsm.registerUtility(utility, IStorage, name=name)
+
+    def test_type(self):
+        self.assertTrue(get_storable(b'data') is self.bytes_storable)
+
+    def test_base_class(self):
+        self.assertTrue(get_storable(BytesIO()) is self.file_storable)
+        with tempfile.TemporaryFile() as fp:
+            self.assertTrue(get_storable(fp) is self.file_storable)
+
+    def test_buffer(self):
+        data = bytearray(b'data')
+        self.assertTrue(get_storable(data) is self.bytes_storable)
+        blob = Blob()
+        get_storable(data).store(data, blob)
+        with blob.open('r') as fp:
+            self.assertEqual(fp.read(), b'data')
+
+    def test_stream(self):
+        self.assertTrue(get_storable(Stream(b'data')) is self.file_storable)
+
+    def test_not_storable(self):
+        self.assertRaises(ComponentLookupError, get_storable, object())
+
+    def test_registry_changes(self):
+        self.assertTrue(get_storable(Stream(b'data')) is self.file_storable)
+        storable = FileDescriptorStorable()
+        self.utilities.append((storable, __name__ + '.Stream'))
+        getGlobalSiteManager().registerUtility(
+            storable, IStorage, name=__name__ + '.Stream')
+        self.assertTrue(get_storable(Stream(b'data')) is storable)
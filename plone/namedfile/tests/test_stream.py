@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.namedfile.file import NamedFile
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+from plone.namedfile.utils import stream_data
+
+import transaction
+import unittest
+
+
+class DummyResponse(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestStreamChunks(unittest.TestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.data = b''.join(
+            chr(ord('a') + i % 26).encode('ascii') * 1000
+            for i in range(400)
+        )
+        self.connection = self.layer['zodbDB'].open()
+        root = self.connection.root()
+        root['file'] = NamedFile()
+        transaction.savepoint(optimistic=True)
+        root['file'].data = BytesIO(self.data)
+        transaction.commit()
+        self.file = root['file']
+
+    def tearDown(self):
+        self.connection.close()
+
+    def _chunks(self):
+        chunk = self.file._data
+        chunks = []
+        while chunk is not None:
+            chunks.append(chunk)
+            chunk = chunk.next
+        return chunks
+
+    def test_stream_writes_chunks(self):
+        chunks = self._chunks()
+        self.assertTrue(len(chunks) > 1)
+        response = DummyResponse()
+        self.assertEqual(stream_data(self.file, response=response), b'')
+        self.assertEqual(len(response.written), len(chunks))
+        self.assertEqual(b''.join(response.written), self.data)
+
+    def test_stream_deactivates_chunks(self):
+        chunks = self._chunks()
+        for chunk in chunks:
+            chunk._p_activate()
+        stream_data(self.file, response=DummyResponse())
+        self.assertEqual(
+            [chunk._p_changed for chunk in chunks],
+            [None] * len(chunks),
+        )
+
+    def test_stream_range(self):
+        response = DummyResponse()
+        stream_data(self.file, start=70000, end=140001, response=response)
+        self.assertEqual(b''.join(response.written), self.data[70000:140001])
+
+    def test_stream_without_write(self):
+        self.assertEqual(stream_data(self.file, response=None), self.data)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from plone.namedfile import settings
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.file import NamedFile
+from plone.namedfile.testing import PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+from plone.namedfile.upload import parse_upload_metadata
+from plone.namedfile.upload import StagedUpload
+from plone.namedfile.upload import UploadConflict
+from plone.namedfile.upload import UploadTooLarge
+
+import hashlib
+import os
+import shutil
+import tempfile
+import transaction
+import unittest
+
+
+class UploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings.UPLOAD_DIRECTORY = self.directory
+
+    def tearDown(self):
+        settings.UPLOAD_DIRECTORY = None
+        shutil.rmtree(self.directory)
+
+
+class TestStagedUpload(UploadTestCase):
+
+    def test_append(self):
+        upload = StagedUpload.create(9, filename=u'test.txt')
+        self.assertEqual(upload.offset, 0)
+        self.assertEqual(upload.append(BytesIO(b'some '), 0), 5)
+        upload = StagedUpload.get(upload.id)
+        self.assertEqual(upload.info['filename'], u'test.txt')
+        self.assertEqual(upload.offset, 5)
+        self.assertFalse(upload.complete)
+        # data beyond the length is ignored
+        self.assertEqual(upload.append(BytesIO(b'data and more'), 5), 9)
+        self.assertTrue(upload.complete)
+        with open(upload.path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'some data')
+
+    def test_conflict(self):
+        upload = StagedUpload.create(9)
+        upload.append(BytesIO(b'some '), 0)
+        self.assertRaises(UploadConflict, upload.append, BytesIO(b'data'), 2)
+        self.assertEqual(upload.offset, 5)
+
+    def test_too_large(self):
+        settings.MAX_UPLOAD_SIZE = 8
+        try:
+            self.assertRaises(UploadTooLarge, StagedUpload.create, 9)
+        finally:
+            settings.MAX_UPLOAD_SIZE = None
+
+    def test_unknown_upload(self):
+        self.assertEqual(StagedUpload.get('0' * 32), None)
+        self.assertEqual(StagedUpload.get('../' + '0' * 32), None)
+
+    def test_expired_uploads_are_removed(self):
+        old = StagedUpload.create(9)
+        os.utime(old.path, (0, 0))
+        new = StagedUpload.create(9)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted([new.id + '.json', new.id + '.part']))
+        self.assertEqual(StagedUpload.get(old.id), None)
+
+    def test_parse_upload_metadata(self):
+        self.assertEqual(
+            parse_upload_metadata('filename dGVzdC50eHQ=,private'),
+            {'filename': u'test.txt', 'private': u''})
+        self.assertEqual(parse_upload_metadata(None), {})
+        self.assertRaises(ValueError, parse_upload_metadata, 'filename %%%')
+
+
+class TestCreateValue(UploadTestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestCreateValue, self).setUp()
+        self.connection = self.layer['zodbDB'].open()
+        self.root = self.connection.root()
+
+    def tearDown(self):
+        transaction.abort()
+        self.connection.close()
+        super(TestCreateValue, self).tearDown()
+
+    def _upload(self, data):
+        upload = StagedUpload.create(
+            len(data), filename=u'test.txt', contentType='text/plain')
+        upload.append(BytesIO(data), 0)
+        return upload
+
+    def test_blob_takes_over_file(self):
+        upload = self._upload(b'some data')
+        self.root['file'] = file = upload.createValue(NamedBlobFile)
+        # the staged file is kept until the upload is removed
+        self.assertEqual(upload.offset, 9)
+        upload.remove()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(file.filename, u'test.txt')
+        self.assertEqual(file.contentType, 'text/plain')
+        self.assertEqual(file.getSize(), 9)
+        transaction.commit()
+        self.assertEqual(file.data, b'some data')
+        self.assertEqual(file._digest, None)
+        self.assertEqual(
+            file.getDigest(), hashlib.sha256(b'some data').hexdigest())
+
+    def test_file(self):
+        upload = self._upload(b'some data')
+        file = upload.createValue(NamedFile)
+        upload.remove()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(file.data, b'some data')
+        self.assertEqual(file.filename, u'test.txt')
+
+
+class TestUploadView(UploadTestCase):
+
+    layer = PLONE_NAMEDFILE_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from plone.namedfile import field
+        from zope.interface import implementer
+        from zope.interface import Interface
+
+        class IContainer(Interface):
+            blob = field.NamedBlobFile(title=u'Blob')
+
+        @implementer(IContainer)
+        class Container(object):
+            blob = None
+
+        super(TestUploadView, self).setUp()
+        self.context = Container()
+
+    def _request(self, path, method, body=b'', **headers):
+        from plone.namedfile.browser import Upload
+        from zope.publisher.browser import TestRequest
+        environ = {'REQUEST_METHOD': method}
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper()] = value
+        if 'content_type' in headers:
+            environ['CONTENT_TYPE'] = headers['content_type']
+        request = TestRequest(body_instream=BytesIO(body), environ=environ)
+        view = Upload(self.context, request)
+        for name in path:
+            view = view.publishTraverse(request, name)
+        return view, request.response
+
+    def test_upload(self):
+        view, response = self._request(
+            ['blob'], 'POST', upload_length='9',
+            upload_metadata='filename dGVzdC50eHQ=')
+        view()
+        self.assertEqual(response.getStatus(), 201)
+        upload_id = response.getHeader('Location').split('/')[-1]
+
+        view, response = self._request(
+            ['blob', upload_id], 'PATCH', b'some ', upload_offset='0',
+            content_type='application/offset+octet-stream')
+        view.PATCH()
+        self.assertEqual(response.getStatus(), 204)
+        self.assertEqual(response.getHeader('Upload-Offset'), '5')
+        self.assertEqual(self.context.blob, None)
+
+        view, response = self._request(['blob', upload_id], 'HEAD')
+        view.HEAD()
+        self.assertEqual(response.getHeader('Upload-Offset'), '5')
+        self.assertEqual(response.getHeader('Upload-Length'), '9')
+
+        view, response = self._request(
+            ['blob', upload_id], 'PATCH', b'data', upload_offset='5',
+            content_type='application/offset+octet-stream')
+        view.PATCH()
+        self.assertEqual(response.getStatus(), 204)
+        self.assertEqual(self.context.blob.data, b'some data')
+        self.assertEqual(self.context.blob.filename, u'test.txt')
+
+    def test_invalid_value_keeps_upload(self):
+        from plone.namedfile import field
+        from zope.interface import alsoProvides
+        from zope.interface import Interface
+
+        class IImage(Interface):
+            blob = field.NamedBlobImage(title=u'Image')
+
+        alsoProvides(self.context, IImage)
+        upload = StagedUpload.create(
+            4, fieldname='blob', context=None, user=None)
+        view, response = self._request(
+            ['blob', upload.id], 'PATCH', b'data', upload_offset='0',
+            content_type='application/offset+octet-stream')
+        view.PATCH()
+        self.assertEqual(response.getStatus(), 400)
+        self.assertEqual(self.context.blob, None)
+        self.assertEqual(StagedUpload.get(upload.id).offset, 4)
+
+    def test_wrong_offset(self):
+        upload = StagedUpload.create(
+            9, fieldname='blob', context=None, user=None)
+        view, response = self._request(
+            ['blob', upload.id], 'PATCH', b'data', upload_offset='5',
+            content_type='application/offset+octet-stream')
+        view.PATCH()
+        self.assertEqual(response.getStatus(), 409)
+
+    def test_method_not_allowed(self):
+        view, response = self._request(['blob'], 'GET', upload_length='9')
+        view()
+        self.assertEqual(response.getStatus(), 405)
+        self.assertEqual(response.getHeader('Allow'), 'POST, OPTIONS')
+        self.assertEqual(os.listdir(self.directory), [])
+
+        upload = StagedUpload.create(
+            9, fieldname='blob', context=None, user=None)
+        view, response = self._request(
+            ['blob', upload.id], 'POST', upload_length='9')
+        view()
+        self.assertEqual(response.getStatus(), 405)
+        self.assertEqual(
+            response.getHeader('Allow'), 'HEAD, PATCH, DELETE, OPTIONS')
+
+    def test_options_is_public(self):
+        from plone.namedfile.browser import Upload
+        self.assertIsNone(Upload.OPTIONS__roles__)
+        view, response = self._request(['blob'], 'OPTIONS')
+        view.OPTIONS()
+        self.assertEqual(response.getStatus(), 204)
+        self.assertEqual(response.getHeader('Tus-Version'), '1.0.0')
+
+    def test_unknown_field(self):
+        from zope.publisher.interfaces import NotFound
+        view, response = self._request(['other'], 'POST', upload_length='9')
+        self.assertRaises(NotFound, view)
+
+    def test_readonly_field(self):
+        from plone.namedfile import field
+        from zope.interface import alsoProvides
+        from zope.interface import Interface
+
+        class IReadOnly(Interface):
+            blob = field.NamedBlobFile(title=u'Blob', readonly=True)
+
+        alsoProvides(self.context, IReadOnly)
+        view, response = self._request(['blob'], 'POST', upload_length='9')
+        view()
+        self.assertEqual(response.getStatus(), 403)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_write_permission(self):
+        from plone.namedfile import browser
+        from plone.namedfile import field
+        from zope.interface import alsoProvides
+        from zope.interface import Interface
+
+        if browser.WRITE_PERMISSIONS_KEY is None:
+            self.skipTest('plone.autoform is missing')
+
+        class IProtected(Interface):
+            blob = field.NamedBlobFile(title=u'Blob')
+
+        IProtected.setTaggedValue(
+            browser.WRITE_PERMISSIONS_KEY, {'blob': 'cmf.ManagePortal'})
+        alsoProvides(self.context, IProtected)
+        checked = []
+        checkPermission = browser.checkPermission
+        browser.checkPermission = lambda permission, context: (
+            checked.append(permission))
+        try:
+            view, response = self._request(
+                ['blob'], 'POST', upload_length='9')
+            view()
+        finally:
+            browser.checkPermission = checkPermission
+        self.assertEqual(response.getStatus(), 403)
+        self.assertEqual(checked, ['cmf.ManagePortal'])
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Staging of resumable uploads.
+
+The data of an upload is appended to a file in the `UPLOAD_DIRECTORY` of
+the settings as it arrives, in as many requests as the client needs, without
+touching the database. Once complete, the file is hard linked into the blob
+of a new value. See `plone.namedfile.browser.Upload` for the protocol.
+"""
+from plone.namedfile import settings
+from plone.namedfile.copy import COPY_BUFFER_SIZE
+from plone.namedfile.interfaces import IBlobby
+from uuid import uuid4
+
+import base64
+import json
+import os
+import re
+import tempfile
+import time
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Version of the tus protocol for resumable uploads spoken
+TUS_VERSION = '1.0.0'
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+_BASE64 = re.compile(r'^[A-Za-z0-9+/]*={0,2}$')
+
+
+class UploadConflict(Exception):
+    """The data does not continue the upload at its current offset.
+    """
+
+
+class UploadTooLarge(Exception):
+    """The upload is larger than the `MAX_UPLOAD_SIZE` setting.
+    """
+
+
+def parse_upload_metadata(header):
+    """Parse the value of an ``Upload-Metadata`` header: comma separated
+    pairs of a key and a base64 encoded UTF-8 value, which may be missing.
+
+    Raises ValueError for values which can't be decoded.
+    """
+    metadata = {}
+    for pair in (header or '').split(','):
+        parts = pair.split()
+        if not parts:
+            continue
+        if len(parts) > 2:
+            raise ValueError(pair)
+        value = u''
+        if len(parts) == 2:
+            if len(parts[1]) % 4 or not _BASE64.match(parts[1]):
+                raise ValueError(pair)
+            value = base64.b64decode(parts[1]).decode('utf-8')
+        metadata[parts[0]] = value
+    return metadata
+
+
+def get_upload_directory():
+    directory = settings.UPLOAD_DIRECTORY
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'plone.namedfile')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            # created meanwhile
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+class StagedUpload(object):
+    """An upload in progress.
+
+    `info` holds the length of the data and whatever is needed to finish
+    the upload, e.g. the filename and the content type.
+    """
+
+    def __init__(self, id, info):
+        self.id = id
+        self.info = info
+        directory = get_upload_directory()
+        self.path = os.path.join(directory, id + '.part')
+        self.info_path = os.path.join(directory, id + '.json')
+
+    @classmethod
+    def create(cls, length, **info):
+        """Start a new upload of `length` bytes.
+        """
+        limit = settings.MAX_UPLOAD_SIZE
+        if limit is not None and length > limit:
+            raise UploadTooLarge(length)
+        remove_expired_uploads()
+        info['length'] = length
+        upload = cls(uuid4().hex, info)
+        with open(upload.path, 'wb'):
+            pass
+        with open(upload.info_path, 'w') as fp:
+            json.dump(info, fp)
+        return upload
+
+    @classmethod
+    def get(cls, id):
+        """Return the upload with the id, or None if there is none.
+        """
+        if not _UPLOAD_ID.match(id):
+            return None
+        upload = cls(id, None)
+        try:
+            with open(upload.info_path) as fp:
+                upload.info = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if upload.expired:
+            upload.remove()
+            return None
+        return upload
+
+    @property
+    def length(self):
+        return self.info['length']
+
+    @property
+    def offset(self):
+        """The number of bytes received so far.
+        """
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    @property
+    def complete(self):
+        return self.offset >= self.length
+
+    @property
+    def expired(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return True
+        return mtime + settings.UPLOAD_EXPIRES < time.time()
+
+    def append(self, stream, offset):
+        """Append the data read from `stream` to the upload, which must have
+        received `offset` bytes so far. Returns the new offset.
+
+        Data beyond the length of the upload is ignored. Raises
+        `UploadConflict` if the offset does not match.
+        """
+        with open(self.path, 'ab') as fp:
+            if fcntl is not None:
+                # one request appending at a time
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            size = os.fstat(fp.fileno()).st_size
+            if offset != size:
+                raise UploadConflict(offset, size)
+            remaining = self.length - size
+            while remaining > 0:
+                data = stream.read(min(remaining, COPY_BUFFER_SIZE))
+                if not data:
+                    break
+                fp.write(data)
+                remaining -= len(data)
+            fp.flush()
+            return self.length - remaining
+
+    def createValue(self, factory):
+        """Create a value of the type `factory` from the completed upload.
+
+        Blob based values take over a hard link to the file the data was
+        staged in where possible, other values read it in chunks. The upload
+        is kept, so it can be removed once the value is known to be valid.
+        """
+        contentType = str(self.info.get('contentType') or '')
+        filename = self.info.get('filename')
+        if not IBlobby.implementedBy(factory):
+            with open(self.path, 'rb') as fp:
+                return factory(fp, contentType, filename)
+        value = factory(contentType=contentType, filename=filename)
+        link = '{0}.{1}'.format(self.path, uuid4().hex)
+        try:
+            os.link(self.path, link)
+        except (AttributeError, OSError):
+            # not supported by the platform or the file system
+            with open(self.path, 'rb') as fp:
+                value.data = fp
+            return value
+        try:
+            value._consumeFile(link)
+        finally:
+            if os.path.exists(link):
+                os.remove(link)
+        return value
+
+    def remove(self):
+        for path in (self.path, self.info_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def remove_expired_uploads():
+    """Remove the uploads which were not continued for `UPLOAD_EXPIRES`
+    seconds.
+    """
+    directory = get_upload_directory()
+    for name in os.listdir(directory):
+        id, ext = os.path.splitext(name)
+        if ext not in ('.json', '.part') or not _UPLOAD_ID.match(id):
+            continue
+        upload = StagedUpload(id, None)
+        if upload.expired:
+            upload.remove()
@@ -1,17 +1,62 @@
 # -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
 from plone.namedfile.interfaces import IBlobby
+from plone.namedfile.interfaces import IBlobOffload
+from plone.namedfile.interfaces import INamedField
+from plone.namedfile.interfaces import IStorage
+from uuid import uuid4
+from ZODB.blob import Blob
+from ZODB.interfaces import BlobError
+from ZODB.POSException import POSKeyError
+from ZODB.utils import u64
+from ZODB.utils import z64
+from zope.component import ComponentLookupError
+from zope.component import getSiteManager
+from zope.component import queryUtility
+from zope.interface import implementer
+from zope.interface import Interface
+from zope.interface import providedBy
+from zope.schema import getFields
 
+import inspect
+import io
 import mimetypes
+import mmap
 import os.path
 import urllib
+import weakref
 
 
+try:
+    from plone.behavior.interfaces import IBehaviorAssignable
+except ImportError:
+    IBehaviorAssignable = None
+
 try:
     # use this to stream data if we can
     from ZPublisher.Iterators import filestream_iterator
+    from ZPublisher.Iterators import IStreamIterator
 except ImportError:
     filestream_iterator = None
 
+    class IStreamIterator(Interface):
+        """Marker for iterators ZPublisher streams to the client.
+        """
+
+
+STREAM_SIZE = 1 << 16
+
+# IStorage utilities by the type of the data, for each site manager, with the
+# generation of its utility registry they were found in
+_storables = weakref.WeakKeyDictionary()
+
+# Requests asking for more ranges than this are served the full file, as
+# is done by Apache and nginx, to avoid being abused for amplification.
+MAX_RANGES = 20
+
 
 def safe_basename(filename):
     """Get the basename of the given filename, regardless of which platform
@@ -53,6 +98,7 @@ def set_headers(file, response, filename=None):
 
     response.setHeader('Content-Type', contenttype)
     response.setHeader('Content-Length', file.getSize())
+    set_validators(file, response)
 
     if filename is not None:
         if not isinstance(filename, str):
@@ -64,16 +110,647 @@ def set_headers(file, response, filename=None):
         )
 
 
-def stream_data(file):
+def set_validators(file, response):
+    """Set the ``ETag`` and ``Last-Modified`` headers for the file, which are
+    also sent with a ``304 Not Modified`` response.
+    """
+    etag = get_etag(file)
+    if etag is not None:
+        response.setHeader('ETag', etag)
+    mtime = get_mtime(file)
+    if mtime is not None:
+        response.setHeader('Last-Modified', formatdate(mtime, usegmt=True))
+
+
+def get_blob(file):
+    """Return the blob holding the data of the file, or None.
+
+    Besides the blob based types, NamedFile and NamedImage values store
+    large data in a blob if `plone.namedfile.settings.BLOB_THRESHOLD` is set.
+    """
+    if IBlobby.providedBy(file):
+        return file._blob
+    data = getattr(file, '_data', None)
+    if isinstance(data, Blob):
+        return data
+    return None
+
+
+def get_blob_filename(blob):
+    """Return the name of the file holding the data of the blob.
+    """
+    return blob._p_blob_uncommitted or blob.committed()
+
+
+def get_blob_size(blob):
+    """Return the size of the data of a blob, committed or not.
+    """
+    with blob.open('r') as fp:
+        return os.fstat(fp.fileno()).st_size
+
+
+@contextmanager
+def blob_buffer(blob):
+    """Context manager giving a read-only memoryview of the data of a blob,
+    committed or not.
+
+    The blob file is mapped into memory, so the data is not copied. Where
+    that is not possible, e.g. on Python 2, the data is read instead. The
+    view must not be used after leaving the context.
+    """
+    mapped = None
+    with blob.open('r') as fp:
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+        except (EnvironmentError, TypeError, ValueError):
+            # an empty file, or no buffer interface on the map
+            if mapped is not None:
+                mapped.close()
+                mapped = None
+            view = memoryview(fp.read())
+    try:
+        yield view
+    finally:
+        if mapped is not None:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # views of the view are still around, the map is closed
+                # when they are gone
+                pass
+
+
+def _dotted_name(cls):
+    return '.'.join((cls.__module__, cls.__name__))
+
+
+def _find_storable(data):
+    types = inspect.getmro(data.__class__)
+    try:
+        memoryview(data)
+    except TypeError:
+        if hasattr(data, 'read'):
+            # store it like a file
+            types += inspect.getmro(io.BufferedReader)
+    else:
+        # store it like bytes
+        types += (bytes,)
+    for cls in types:
+        storable = queryUtility(IStorage, name=_dotted_name(cls))
+        if storable is not None:
+            return storable
+    return None
+
+
+def get_storable(data):
+    """Return the IStorage utility for storing `data` in a blob.
+
+    The utility is registered with the dotted name of the type of the data
+    or one of its base classes. Other data supporting the buffer protocol is
+    stored like bytes, and other objects with a ``read`` method like files.
+    The utilities found are cached by type until the registry changes.
+    """
+    sm = getSiteManager()
+    generation = sm.utilities._generation
+    cache = _storables.get(sm)
+    if cache is None or cache[0] != generation:
+        cache = _storables[sm] = (generation, {})
+    cls = data.__class__
+    try:
+        storable = cache[1][cls]
+    except KeyError:
+        storable = cache[1][cls] = _find_storable(data)
+    if storable is None:
+        raise ComponentLookupError(IStorage, _dotted_name(cls))
+    return storable
+
+
+def _persistent_parts(file):
+    """Return the persistent objects making up the stored data of the file.
+    """
+    parts = [file]
+    blob = get_blob(file)
+    if blob is not None:
+        # Writing to the blob does not necessarily change the file itself.
+        if blob._p_changed is None:
+            # load the (empty) state of a ghost to get its serial, this does
+            # not open the blob file
+            blob._p_activate()
+        parts.append(blob)
+    return parts
+
+
+def get_etag(file):
+    """Return a strong entity tag for the data of the file.
+
+    The tag is the digest of the data, if it is known. Otherwise it is
+    derived from the transaction ids the file (and its blob) was last
+    stored with, so it is cheap to compute. Returns None for files without
+    a digest which were not stored yet.
+    """
+    digest = getattr(file, '_digest', None)
+    if digest is not None:
+        return '"{0}"'.format(digest)
+    serials = []
+    for part in _persistent_parts(file):
+        serial = getattr(part, '_p_serial', z64)
+        if serial == z64:
+            return None
+        serials.append('{0:x}'.format(u64(serial)))
+    return '"{0}"'.format('-'.join(serials))
+
+
+def get_mtime(file):
+    """Return the time the data of the file was last modified, in seconds
+    since the epoch, or None for files which were not stored yet.
+    """
+    mtimes = [getattr(part, '_p_mtime', None)
+              for part in _persistent_parts(file)]
+    if None in mtimes:
+        return None
+    return max(mtimes)
+
+
+def is_not_modified(file, request):
+    """Check the conditional headers of a GET request against the file.
+
+    Returns True if a ``304 Not Modified`` response can be sent, i.e. the
+    client's copy of the file is still valid. ``If-None-Match`` takes
+    precedence over ``If-Modified-Since``. Neither requires opening a blob.
+    """
+    if_none_match = request.getHeader('If-None-Match', None)
+    if if_none_match is not None:
+        etag = get_etag(file)
+        if etag is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # If-None-Match uses the weak comparison function
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    since = http_date_to_timestamp(
+        request.getHeader('If-Modified-Since', None))
+    mtime = get_mtime(file)
+    if since is None or mtime is None:
+        return False
+    return int(mtime) <= since
+
+
+def get_offload_path(file, settings):
+    """Return the path to send to the front-end web server for the blob of
+    the file, or None if it can not be offloaded.
+
+    Only committed blobs can be offloaded: the file of an uncommitted blob
+    is temporary and may be gone when the front-end web server gets to it.
+    """
+    blob = get_blob(file)
+    if blob is None or blob._p_blob_uncommitted:
+        return None
+    try:
+        filename = blob.committed()
+    except (BlobError, POSKeyError):
+        return None
+
+    prefix = (settings.prefix or '').rstrip('/')
+    directory = settings.blob_directory
+    if not directory:
+        return prefix + filename
+    directory = os.path.join(directory, '')
+    if not filename.startswith(directory):
+        return None
+    return '{0}/{1}'.format(prefix, filename[len(directory):])
+
+
+def offload_data(file, response):
+    """Let the front-end web server deliver the blob of the file, if a
+    `IBlobOffload` utility is configured.
+
+    Sets the header pointing the front-end web server to the blob file and
+    returns True, or returns False if the data has to be streamed.
+    """
+    settings = queryUtility(IBlobOffload)
+    if settings is None:
+        return False
+    path = get_offload_path(file, settings)
+    if path is None:
+        return False
+    response.setHeader(settings.header, path)
+    return True
+
+
+def parse_range(header):
+    """Parse the value of a HTTP ``Range`` header.
+
+    Returns a list of ``(first, last)`` tuples as given in the header: `last`
+    is inclusive and None for open ranges (``500-``), `first` is None for
+    suffix ranges (``-500``). Returns None if the header is invalid or does
+    not ask for bytes, in which case it has to be ignored.
+    """
+    if not header:
+        return None
+    unit, sep, specs = header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            ranges.append((None, int(last)))
+            continue
+        first = int(first)
+        last = int(last) if last else None
+        if last is not None and last < first:
+            return None
+        ranges.append((first, last))
+    return ranges or None
+
+
+def expand_ranges(ranges, size):
+    """Resolve parsed ranges against a file of `size` bytes.
+
+    Returns a list of ``(start, end)`` tuples with an exclusive `end`,
+    suitable for slicing. Unsatisfiable ranges are dropped.
+    """
+    result = []
+    for first, last in ranges:
+        if first is None:
+            if not last:
+                continue
+            start, end = max(size - last, 0), size
+        else:
+            if first >= size:
+                continue
+            start = first
+            end = size if last is None else min(last + 1, size)
+        result.append((start, end))
+    return result
+
+
+def http_date_to_timestamp(value):
+    """Parse a HTTP date, returning seconds since the epoch or None.
+    """
+    if not value:
+        return None
+    parsed = parsedate_tz(value.split(';')[0].strip())
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def if_range_matches(file, value):
+    """Check whether the ``If-Range`` validator still matches the file.
+
+    The validator is either an entity tag, which has to match strongly, or
+    a date.
+    """
+    if value.startswith('"') or value.startswith('W/'):
+        etag = get_etag(file)
+        return etag is not None and value == etag
+    since = http_date_to_timestamp(value)
+    mtime = get_mtime(file)
+    if since is None or mtime is None:
+        return False
+    return int(mtime) <= since
+
+
+def handle_request_range(file, request, response):
+    """Handle the ``Range`` and ``If-Range`` headers of the request.
+
+    Sets the status and the headers of a partial response and returns the
+    keyword arguments to pass to `stream_data`. An empty dict means the
+    whole file is to be sent.
+    """
+    response.setHeader('Accept-Ranges', 'bytes')
+    ranges = parse_range(request.getHeader('Range', None))
+    if ranges is None or len(ranges) > MAX_RANGES:
+        return {}
+    if_range = request.getHeader('If-Range', None)
+    if if_range is not None and not if_range_matches(file, if_range):
+        return {}
+
+    size = file.getSize()
+    ranges = expand_ranges(ranges, size)
+    if not ranges:
+        response.setStatus(416)
+        response.setHeader('Content-Range', 'bytes */{0}'.format(size))
+        response.setHeader('Content-Length', 0)
+        return dict(start=0, end=0)
+    if sum(end - start for start, end in ranges) > size:
+        # overlapping ranges, we do not want to send more than the file
+        return {}
+
+    response.setStatus(206)
+    if len(ranges) == 1:
+        [(start, end)] = ranges
+        response.setHeader(
+            'Content-Range',
+            'bytes {0}-{1}/{2}'.format(start, end - 1, size),
+        )
+        response.setHeader('Content-Length', end - start)
+        return dict(start=start, end=end)
+
+    boundary = uuid4().hex
+    content_type = response.getHeader('Content-Type')
+    parts = byteranges_parts(ranges, size, content_type, boundary)
+    response.setHeader(
+        'Content-Type',
+        'multipart/byteranges; boundary={0}'.format(boundary),
+    )
+    response.setHeader('Content-Length', byteranges_length(parts, boundary))
+    return dict(ranges=parts, boundary=boundary)
+
+
+def byteranges_parts(ranges, size, content_type, boundary):
+    """Return a list of ``(header, start, end)`` for a multipart/byteranges
+    response body.
+    """
+    parts = []
+    for start, end in ranges:
+        header = (
+            '--{0}\r\n'
+            'Content-Type: {1}\r\n'
+            'Content-Range: bytes {2}-{3}/{4}\r\n'
+            '\r\n'
+        ).format(boundary, content_type, start, end - 1, size)
+        parts.append((header.encode('ascii'), start, end))
+    return parts
+
+
+def byteranges_length(parts, boundary):
+    """Return the length of the multipart/byteranges body for `parts`.
+    """
+    length = len(byteranges_trailer(boundary))
+    for header, start, end in parts:
+        length += len(header) + (end - start) + 2
+    return length
+
+
+def byteranges_trailer(boundary):
+    return '--{0}--\r\n'.format(boundary).encode('ascii')
+
+
+if filestream_iterator is not None:
+
+    class filestream_range_iterator(filestream_iterator):
+        """A filestream_iterator which only streams the bytes from `start`
+        up to (but excluding) `end`.
+        """
+
+        def __init__(self, name, mode='rb', bufsize=-1,
+                     streamsize=STREAM_SIZE, start=0, end=None):
+            super(filestream_range_iterator, self).__init__(
+                name, mode, bufsize, streamsize)
+            if end is None:
+                end = os.fstat(self.fileno()).st_size
+            self.start = start
+            self.end = end
+            self.seek(start, 0)
+
+        def next(self):
+            length = max(min(self.end - self.tell(), self.streamsize), 0)
+            data = self.read(length) if length else b''
+            if not data:
+                raise StopIteration
+            return data
+
+        __next__ = next
+
+        def __len__(self):
+            return max(self.end - self.start, 0)
+
+else:
+    filestream_range_iterator = None
+
+
+@implementer(IStreamIterator)
+class stream_iterator(object):
+    """Stream the strings produced by `iterable`, which adds up to `length`
+    bytes, to the client.
+    """
+
+    def __init__(self, iterable, length):
+        self.iterable = iter(iterable)
+        self.length = length
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.iterable)
+
+    __next__ = next
+
+    def __len__(self):
+        return self.length
+
+
+def is_chunk_chain(data):
+    """Check whether the data is a (linked list of) `FileChunk` objects.
+    """
+    return hasattr(data, 'next') and hasattr(data, '_data')
+
+
+def iter_chunk_data(chunk, start=0, end=None):
+    """Iterate over the data of a chain of `FileChunk` objects, restricted
+    to the bytes from `start` up to (but excluding) `end`.
+
+    Only walks the chain as far as needed for `end`, and starts at the chunk
+    holding `start` if the chain has an index. Every chunk is turned
+    into a ghost once its data was handed out, so memory use is bounded by
+    the size of a single chunk rather than the size of the file. As chunks
+    are loaded from the database, the iterator has to be consumed while the
+    database connection is open.
+    """
+    offset = 0
+    locate = getattr(chunk, 'locate', None)
+    if start and locate is not None:
+        # use the index of the chain to skip the chunks before `start`
+        chunk, offset = locate(start)
+    while chunk is not None and (end is None or offset < end):
+        data = chunk._data
+        next = chunk.next
+        length = len(data)
+        if offset + length > start:
+            lo = max(start - offset, 0)
+            hi = length if end is None else min(end - offset, length)
+            yield data[lo:hi]
+        offset += length
+        # changed objects are left alone by _p_deactivate
+        chunk._p_deactivate()
+        chunk = next
+
+
+class FileChunkReader(object):
+    """Read-only file-like access to a chain of `FileChunk` objects.
+
+    Reading only loads the chunks holding the requested bytes (walking the
+    chain up to them, unless it has an index), so seeking over large parts
+    of the data is cheap.
+    """
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        end = None if size is None or size < 0 else start + size
+        data = b''.join(iter_chunk_data(self.chunk, start, end))
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.chunk)
+        self.position = max(offset, 0)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+def iter_blob_file_data(filename, start=0, end=None):
+    """Iterate over the data of a blob file, restricted to the bytes from
+    `start` up to (but excluding) `end`.
+    """
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = STREAM_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            data = fp.read(size)
+            if not data:
+                break
+            yield data
+
+
+def iter_file_data(file, start=0, end=None):
+    """Iterate over the data of the given named file, restricted to the bytes
+    from `start` up to (but excluding) `end`.
+
+    The file name of a blob is looked up right away, so that the iterator
+    for a blob can be consumed after the database connection was closed.
+    """
+    blob = get_blob(file)
+    if blob is not None:
+        return iter_blob_file_data(get_blob_filename(blob), start, end)
+
+    data = file._data
+    if is_chunk_chain(data):
+        return iter_chunk_data(data, start, end)
+    return iter([data[start:end]])
+
+
+def iter_byteranges(file, parts, boundary):
+    for header, start, end in parts:
+        yield header
+        for data in iter_file_data(file, start, end):
+            yield data
+        yield b'\r\n'
+    yield byteranges_trailer(boundary)
+
+
+def write_data(pieces, response):
+    """Write the pieces of data to the response as they are produced, if
+    the response supports streaming. Otherwise they are joined and returned.
+    """
+    write = getattr(response, 'write', None)
+    if write is None:
+        return b''.join(pieces)
+    for data in pieces:
+        write(data)
+    return b''
+
+
+def stream_data(file, start=0, end=None, ranges=None, boundary=None,
+                response=None):
     """Return the given file as a stream if possible.
+
+    If `start` and/or `end` are given, only that range of bytes is returned.
+    If `ranges` is given, a multipart/byteranges body for these parts (as
+    returned by `handle_request_range`) is returned.
+
+    Data stored in a chain of `FileChunk` objects is never joined into one
+    string: if a `response` is given, the chunks are written to it one by
+    one while the database connection is still open.
     """
 
-    if IBlobby.providedBy(file) and filestream_iterator is not None:
+    if ranges is not None:
+        body = iter_byteranges(file, ranges, boundary)
+        if get_blob(file) is not None:
+            return stream_iterator(body, byteranges_length(ranges, boundary))
+        return write_data(body, response)
+
+    blob = get_blob(file)
+    if blob is not None and filestream_iterator is not None:
         # XXX: we may want to use this instead, which would raise  # noqa
         # an error in case of uncomitted changes filename =
         # file._blob.committed()
 
-        filename = file._blob._p_blob_uncommitted or file._blob.committed()
-        return filestream_iterator(filename, 'rb')
+        filename = get_blob_filename(blob)
+        if start == 0 and end is None:
+            return filestream_iterator(filename, 'rb')
+        return filestream_range_iterator(
+            filename, 'rb', start=start, end=end)
+
+    if blob is None:
+        data = file._data
+        if is_chunk_chain(data) and data.next is not None:
+            return write_data(iter_chunk_data(data, start, end), response)
+    if start == 0 and end is None:
+        return file.data
+    return b''.join(iter_file_data(file, start, end))
+
 
-    return file.data
+def iter_schemata(obj):
+    """Yield the schemas of `obj`: the interfaces it provides and, if
+    plone.behavior is available, those of its behaviors.
+    """
+    for iface in providedBy(obj).flattened():
+        yield iface
+    if IBehaviorAssignable is None:
+        return
+    assignable = IBehaviorAssignable(obj, None)
+    if assignable is None:
+        return
+    for behavior in assignable.enumerateBehaviors():
+        yield behavior.interface
+
+
+def iter_named_fields(obj):
+    """Yield ``(name, storage)`` for the file and image fields of the
+    schemas of `obj`, with `storage` the object the schema is adapted to,
+    e.g. a behavior storing its fields in annotations.
+    """
+    seen = set()
+    for schema in iter_schemata(obj):
+        for name, field in getFields(schema).items():
+            if not INamedField.providedBy(field):
+                continue
+            storage = schema(obj, None)
+            if storage is None:
+                continue
+            key = (id(getattr(storage, 'aq_base', storage)), name)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield name, storage
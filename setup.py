@@ -48,6 +48,7 @@ setup(
         'zope.browserpage',
         'zope.component',
         'zope.copy',
+        'zope.lifecycleevent',
         'zope.security',
         'zope.traversing',
     ],
@@ -55,6 +56,8 @@ setup(
         'test': [
             'lxml',
             'Pillow',
+            'plone.autoform',
+            'plone.behavior',
             'plone.testing',
             'ZODB',
         ]